@@ -0,0 +1,176 @@
+"""
+Cold tier for old message history.
+
+Each chat has an append-only segment file of zlib-compressed blocks of
+BSON-encoded messages (oldest first) and a small index file with one
+fixed-size entry per block. Readers memory-map the segment and only
+decompress the blocks a page needs.
+"""
+
+import mmap
+import os
+import re
+import struct
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, List, Set
+
+import bson
+from bson import ObjectId
+from dotenv import load_dotenv
+
+load_dotenv()
+
+COLD_STORAGE_DIR = Path(os.getenv("COLD_STORAGE_DIR", "cold_storage"))
+# Messages older than this are moved to the cold tier by archive_messages.py
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+BLOCK_MESSAGES = int(os.getenv("COLD_BLOCK_MESSAGES", "256"))
+
+# Index entry: first created_at (ms), last created_at (ms), offset, length, message count
+INDEX_ENTRY = struct.Struct("<qqQII")
+
+# Fields that only matter while a message is hot
+HOT_ONLY_FIELDS = ("read_by", "client_msg_id")
+
+def _paths(chat_id: str):
+    if not ObjectId.is_valid(chat_id):
+        raise ValueError(f"Invalid chat id: {chat_id}")
+    return COLD_STORAGE_DIR / f"{chat_id}.seg", COLD_STORAGE_DIR / f"{chat_id}.idx"
+
+def _to_ms(value: datetime) -> int:
+    return int(value.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def read_index(chat_id: str) -> List[tuple]:
+    """Index entries of a chat, oldest block first"""
+    _, index_path = _paths(chat_id)
+    try:
+        data = index_path.read_bytes()
+    except FileNotFoundError:
+        return []
+    # Ignore a trailing entry that is still being written
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    return list(INDEX_ENTRY.iter_unpack(data[:usable]))
+
+def count_messages(chat_id: str) -> int:
+    return sum(entry[4] for entry in read_index(chat_id))
+
+def archived_ids_since(chat_id: str, since: datetime) -> Set[ObjectId]:
+    """Ids of the archived messages in the trailing blocks that reach back to since"""
+    index = read_index(chat_id)
+    since_ms = _to_ms(since)
+    tail = []
+    for entry in reversed(index):
+        if entry[1] < since_ms:
+            break
+        tail.append(entry)
+    if not tail:
+        return set()
+
+    segment = _open_segment(chat_id)
+    try:
+        return {msg["_id"] for entry in tail for msg in _read_block(segment, entry)}
+    finally:
+        segment.close()
+
+def append_messages(chat_id: str, messages: List[dict]) -> int:
+    """Append messages (sorted oldest first) as new blocks. Returns how many were written."""
+    if not messages:
+        return 0
+    segment_path, index_path = _paths(chat_id)
+    COLD_STORAGE_DIR.mkdir(parents=True, exist_ok=True)
+
+    entries = []
+    with open(segment_path, "ab") as segment:
+        offset = segment.tell()
+        for start in range(0, len(messages), BLOCK_MESSAGES):
+            block = messages[start:start + BLOCK_MESSAGES]
+            payload = zlib.compress(b"".join(
+                bson.encode({k: v for k, v in msg.items() if k not in HOT_ONLY_FIELDS})
+                for msg in block
+            ))
+            segment.write(payload)
+            entries.append(INDEX_ENTRY.pack(
+                _to_ms(block[0]["created_at"]),
+                _to_ms(block[-1]["created_at"]),
+                offset,
+                len(payload),
+                len(block)
+            ))
+            offset += len(payload)
+        segment.flush()
+        os.fsync(segment.fileno())
+
+    # The index is written last, so readers never see a block that isn't on disk yet
+    with open(index_path, "ab") as index:
+        index.write(b"".join(entries))
+        index.flush()
+        os.fsync(index.fileno())
+    return len(messages)
+
+def _read_block(segment: mmap.mmap, entry: tuple) -> List[dict]:
+    _, _, offset, length, _ = entry
+    return bson.decode_all(zlib.decompress(segment[offset:offset + length]))
+
+def _open_segment(chat_id: str):
+    segment_path, _ = _paths(chat_id)
+    with open(segment_path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def read_page(chat_id: str, skip: int, limit: int) -> List[dict]:
+    """Archived messages newest first, like the hot query sorted by created_at desc"""
+    index = read_index(chat_id)
+    if not index or limit <= 0:
+        return []
+
+    messages = []
+    segment = _open_segment(chat_id)
+    try:
+        for entry in reversed(index):
+            count = entry[4]
+            # Whole blocks before the page are skipped without decompressing them
+            if skip >= count:
+                skip -= count
+                continue
+            block = _read_block(segment, entry)
+            block.reverse()
+            messages.extend(block[skip:skip + limit - len(messages)])
+            skip = 0
+            if len(messages) >= limit:
+                break
+    finally:
+        segment.close()
+    return messages
+
+def iter_blocks(chat_id: str) -> Iterator[List[dict]]:
+    """Every archived message, oldest first, one decompressed block at a time"""
+    index = read_index(chat_id)
+    if not index:
+        return
+    segment = _open_segment(chat_id)
+    try:
+        for entry in index:
+            yield _read_block(segment, entry)
+    finally:
+        segment.close()
+
+def search(chat_id: str, query: str, limit: int) -> List[dict]:
+    """Slow mode search over archived messages - scans every block, newest first"""
+    index = read_index(chat_id)
+    if not index or limit <= 0:
+        return []
+    pattern = re.compile(query, re.IGNORECASE)
+
+    matches = []
+    segment = _open_segment(chat_id)
+    try:
+        for entry in reversed(index):
+            for msg in reversed(_read_block(segment, entry)):
+                if msg.get("is_deleted") or not pattern.search(msg.get("content", "")):
+                    continue
+                matches.append(msg)
+                if len(matches) >= limit:
+                    return matches
+    finally:
+        segment.close()
+    return matches
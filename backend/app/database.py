@@ -1,16 +1,140 @@
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import MongoClient
+from pymongo import MongoClient, WriteConcern
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 import os
+from typing import Optional
 from dotenv import load_dotenv
 
+from app import events, memberships, metrics, query_stats
+
 load_dotenv()
 
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "chatapp")
+# How long idempotency keys of socket operations are remembered
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_KEY_TTL_SECONDS", "86400"))
+
+# Connection pool (per worker process)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "0")) or None
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "20000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "30000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "0")) or None
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "0")) or None
+
+# Named profiles for get_database(profile)
+HISTORY = "history"      # message pages
+SEARCH = "search"        # message and user search
+CHAT_LIST = "chat_list"  # the chat list and its unread counts
+PRESENCE = "presence"    # last_seen / online status writes
+
+# Read preference of each read profile: primary, primaryPreferred, secondary, secondaryPreferred or nearest.
+# Everything reads from the primary unless configured otherwise.
+READ_PREFERENCES = {
+    HISTORY: os.getenv("MONGO_READ_HISTORY", "primary"),
+    SEARCH: os.getenv("MONGO_READ_SEARCH", "primary"),
+    CHAT_LIST: os.getenv("MONGO_READ_CHAT_LIST", "primary"),
+}
+# How far behind the primary a secondary may be and still serve reads (MongoDB's minimum is 90)
+MONGO_MAX_STALENESS_SECONDS = int(os.getenv("MONGO_MAX_STALENESS_SECONDS", "90"))
+# Presence writes are cheap to lose, so they don't wait for a majority or the journal
+PRESENCE_WRITE_CONCERN = int(os.getenv("MONGO_PRESENCE_WRITE_CONCERN", "1"))
+
+_READ_PREFERENCE_CLASSES = {
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+client = None
+database = None
+_profiles = {}
+
+def _read_preference(mode: str):
+    if mode == "primary":
+        return Primary()
+    if mode not in _READ_PREFERENCE_CLASSES:
+        raise ValueError(f"Unknown read preference: {mode}")
+    return _READ_PREFERENCE_CLASSES[mode](max_staleness=MONGO_MAX_STALENESS_SECONDS)
+
+def _command_listeners() -> list:
+    listeners = []
+    if metrics.METRICS_ENABLED:
+        listeners.append(metrics.MongoCommandListener())
+    if query_stats.QUERY_STATS_ENABLED:
+        listeners.append(query_stats.QueryListener())
+    return listeners
+
+def connect_database():
+    """Create the client (called from the app's lifespan; a no-op if already connected)"""
+    global client, database
+    if client is None:
+        client = AsyncIOMotorClient(
+            MONGODB_URL,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+            waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            event_listeners=_command_listeners()
+        )
+        database = client[DATABASE_NAME]
+
+    _profiles.clear()
+    for profile, mode in READ_PREFERENCES.items():
+        _profiles[profile] = database.with_options(read_preference=_read_preference(mode))
+    _profiles[PRESENCE] = database.with_options(
+        write_concern=WriteConcern(w=PRESENCE_WRITE_CONCERN, j=False)
+    )
 
-client = AsyncIOMotorClient(MONGODB_URL)
-database = client[DATABASE_NAME]
+def close_database():
+    global client, database
+    if client is not None:
+        client.close()
+    client = None
+    database = None
+    _profiles.clear()
 
-def get_database():
-    return database
+def get_database(profile: Optional[str] = None):
+    if not _profiles:
+        # Scripts and tools that never run the app's lifespan
+        connect_database()
+    if profile is None:
+        return database
+    return _profiles[profile]
 
+async def ensure_indexes():
+    """Create the indexes the app relies on (no-op if they already exist)"""
+    db = get_database()
+    # History pages of a chat, newest first
+    await db.messages.create_index([("chat_id", 1), ("created_at", -1)])
+    # Unread counts: messages of a chat after the reader's last read seq
+    await db.messages.create_index([("chat_id", 1), ("seq", 1)])
+    # Deduplicates retried sends carrying a client-generated idempotency key
+    await db.messages.create_index(
+        [("chat_id", 1), ("sender_id", 1), ("client_msg_id", 1)],
+        unique=True,
+        partialFilterExpression={"client_msg_id": {"$type": "string"}}
+    )
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_KEY_TTL_SECONDS)
+    # Finds the replies whose stored preview must follow edits and deletes
+    await db.messages.create_index(
+        "reply_to",
+        partialFilterExpression={"reply_to": {"$type": "string"}}
+    )
+    # Bucketed storage mode - see app/message_store.py
+    await db.message_buckets.create_index([("chat_id", 1), ("bucket_start", 1)], unique=True)
+    # Per-message operations find the bucket holding a message...
+    await db.message_buckets.create_index([("chat_id", 1), ("messages._id", 1)])
+    # ...and the replies whose previews follow it
+    await db.message_buckets.create_index([("chat_id", 1), ("messages.reply_to", 1)])
+    # Message counts summed without reading the buckets
+    await db.message_buckets.create_index([("chat_id", 1), ("bucket_start", -1), ("count", 1)])
+    # Capped log of chat events for resuming clients - see app/events.py
+    await events.ensure_event_log(db)
+    # Per-user chat state and the chat list - see app/memberships.py
+    await memberships.ensure_indexes(db)
@@ -0,0 +1,91 @@
+"""
+Per-chat event log for reconnect-and-resume sync.
+
+State-changing events broadcast to a chat (new, edited and deleted
+messages, reactions, read receipts, removed participants) get the chat's
+next event_seq and are stored, already encoded, in the capped `events`
+collection. A client that remembers the last event_seq it saw asks for
+the events after it instead of reloading its message pages. Once those
+events have been rotated out of the log it is told to reset instead.
+Typing indicators, presence and delivered receipts are only sent live.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+from pymongo.errors import CollectionInvalid
+
+load_dotenv()
+
+EVENT_LOG_SIZE_MB = int(os.getenv("EVENT_LOG_SIZE_MB", "256"))
+# Most events returned by one sync call - the client asks again while has_more is set
+SYNC_BATCH_LIMIT = int(os.getenv("SYNC_BATCH_LIMIT", "500"))
+# An event that is missing for longer than this was rotated out, not still being written
+IN_FLIGHT_GRACE = timedelta(seconds=5)
+
+async def ensure_event_log(db):
+    if "events" not in await db.list_collection_names():
+        try:
+            await db.create_collection("events", capped=True, size=EVENT_LOG_SIZE_MB * 1024 * 1024)
+        except CollectionInvalid:
+            pass  # Created by another worker
+    await db.events.create_index([("chat_id", 1), ("seq", 1)], unique=True)
+
+async def next_event_seq(db, chat_id: str) -> int:
+    counter = await db.counters.find_one_and_update(
+        {"_id": f"events:{chat_id}"},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+async def last_event_seq(db, chat_id: str) -> int:
+    counter = await db.counters.find_one({"_id": f"events:{chat_id}"})
+    return counter["seq"] if counter else 0
+
+async def append(db, chat_id: str, seq: int, frame: str):
+    await db.events.insert_one({
+        "chat_id": chat_id,
+        "seq": seq,
+        "frame": frame,
+        "created_at": datetime.now()
+    })
+
+async def read_since(db, chat_id: str, since: int, limit: int = SYNC_BATCH_LIMIT) -> dict:
+    """Encoded events of a chat after since, oldest first.
+
+    Only a gapless run starting at since + 1 is returned, so an event that is
+    still being written is never skipped. reset means the client must reload
+    its pages and continue from last_seq.
+    """
+    current = await last_event_seq(db, chat_id)
+    if since > current:
+        # The client's seq is from another log (e.g. a restored database)
+        return {"frames": [], "last_seq": current, "has_more": False, "reset": True}
+    if since == current:
+        return {"frames": [], "last_seq": since, "has_more": False, "reset": False}
+
+    docs = await db.events.find(
+        {"chat_id": chat_id, "seq": {"$gt": since}},
+        {"seq": 1, "frame": 1, "created_at": 1}
+    ).sort("seq", 1).limit(limit + 1).to_list(length=limit + 1)
+
+    frames = []
+    last_seq = since
+    for doc in docs[:limit]:
+        if doc["seq"] != last_seq + 1:
+            break
+        frames.append(doc["frame"])
+        last_seq = doc["seq"]
+
+    if not frames and (not docs or docs[0]["created_at"] < datetime.now() - IN_FLIGHT_GRACE):
+        return {"frames": [], "last_seq": current, "has_more": False, "reset": True}
+    return {
+        "frames": frames,
+        "last_seq": last_seq,
+        "has_more": len(frames) == limit and len(docs) > limit,
+        "reset": False
+    }
@@ -0,0 +1,160 @@
+"""
+Streaming export of chat history as NDJSON.
+
+An export is one JSON object per line: an "export" header, then for each
+chat a "chat" line followed by its messages ("message" lines, the same
+fields as GET /api/chats/{chat_id}/messages rows), oldest first. Archived
+messages come from the cold tier block by block, the rest from one Mongo
+cursor per chat read EXPORT_BATCH_SIZE messages at a time. Each batch is
+rendered, encoded (and gzip-compressed when asked) and handed to the
+response before the next one is read, so memory stays flat however long
+the chat is.
+
+Sender names go through a small LRU cache instead of the per-request
+loaders, which keep every document they load. Reply previews are the ones
+stored on the message; replies from before previews were stored export
+with reply_to only.
+"""
+
+import asyncio
+import os
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from typing import AsyncIterator, Callable, Iterable, List, Optional
+
+from bson import ObjectId
+from dotenv import load_dotenv
+
+from app import cold_storage, message_store, metrics
+from app.serialization import dumps
+
+load_dotenv()
+
+# Messages read, rendered and written per step
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# Sender names kept while an export runs
+EXPORT_NAME_CACHE_SIZE = int(os.getenv("EXPORT_NAME_CACHE_SIZE", "5000"))
+EXPORT_GZIP_LEVEL = int(os.getenv("EXPORT_GZIP_LEVEL", "6"))
+
+FORMAT_VERSION = 1
+CHAT_PROJECTION = {"chat_type": 1, "group_name": 1, "participants": 1, "created_at": 1}
+NAME_PROJECTION = {"username": 1, "full_name": 1}
+
+exported_messages = metrics.Counter("export_messages_total", "Messages written by chat exports")
+active_exports = 0
+metrics.Gauge("exports_in_progress", "Chat exports currently streaming", lambda: active_exports)
+
+class SenderNames:
+    """Display names by user id, least recently used dropped first"""
+    def __init__(self, users, name_of: Callable[[Optional[dict]], str], size: int = EXPORT_NAME_CACHE_SIZE):
+        self.users = users
+        self.name_of = name_of
+        self.size = max(1, size)
+        self._names: "OrderedDict[str, str]" = OrderedDict()
+
+    async def resolve(self, user_ids: Iterable[str]):
+        """Load the names not cached yet with one $in query"""
+        missing = {user_id for user_id in user_ids if user_id not in self._names}
+        if not missing:
+            return
+        ids = [ObjectId(user_id) for user_id in missing if ObjectId.is_valid(user_id)]
+        found = {}
+        if ids:
+            async for user in self.users.find({"_id": {"$in": ids}}, NAME_PROJECTION):
+                found[str(user["_id"])] = user
+        for user_id in missing:
+            self._names[user_id] = self.name_of(found.get(user_id))
+        while len(self._names) > self.size:
+            self._names.popitem(last=False)
+
+    def get(self, user_id: str) -> str:
+        name = self._names.get(user_id)
+        if name is None:
+            # Evicted within the batch that needed it (a batch with more senders than the cache)
+            return self.name_of(None)
+        self._names.move_to_end(user_id)
+        return name
+
+class NDJSONWriter:
+    """Encodes records as lines, through a gzip stream when compress is set"""
+    def __init__(self, compress: bool):
+        self._compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+
+    async def write(self, records: List[dict]) -> bytes:
+        data = b"".join(dumps(record) + b"\n" for record in records)
+        if self._compressor is None:
+            return data
+        # Compressing a batch takes a few milliseconds; keep it off the event loop
+        return await asyncio.to_thread(self._compressor.compress, data)
+
+    def close(self) -> bytes:
+        return self._compressor.flush() if self._compressor is not None else b""
+
+async def message_batches(db, chat_id: str, projection: dict) -> AsyncIterator[List[dict]]:
+    """Every message of a chat, oldest first: the archived tier, then MongoDB"""
+    blocks = cold_storage.iter_blocks(chat_id)
+    try:
+        while True:
+            block = await asyncio.to_thread(next, blocks, None)
+            if block is None:
+                break
+            yield block
+    finally:
+        blocks.close()
+    async for batch in message_store.iter_messages(db, chat_id, projection, EXPORT_BATCH_SIZE):
+        yield batch
+
+async def stream(
+    db,
+    user_id: str,
+    chat_ids: List[str],
+    build_row: Callable[[dict, str, Optional[dict]], dict],
+    name_of: Callable[[Optional[dict]], str],
+    projection: dict,
+    compress: bool = False
+) -> AsyncIterator[bytes]:
+    """NDJSON export of the chats the user is still a participant of, in the given order"""
+    global active_exports
+    active_exports += 1
+    try:
+        writer = NDJSONWriter(compress)
+        names = SenderNames(db.users, name_of)
+        yield await writer.write([{
+            "type": "export",
+            "version": FORMAT_VERSION,
+            "user_id": user_id,
+            "exported_at": datetime.now()
+        }])
+
+        for chat_id in chat_ids:
+            # Read when its turn comes, so a chat left during a long export is skipped
+            chat = await db.chats.find_one({"_id": ObjectId(chat_id), "participants": user_id}, CHAT_PROJECTION)
+            if not chat:
+                continue
+            await names.resolve(chat["participants"])
+            yield await writer.write([{
+                "type": "chat",
+                "id": chat_id,
+                "chat_type": chat["chat_type"],
+                "group_name": chat.get("group_name"),
+                "participants": [{"id": member, "name": names.get(member)} for member in chat["participants"]],
+                "created_at": chat.get("created_at")
+            }])
+
+            async for batch in message_batches(db, chat_id, projection):
+                await names.resolve(msg["sender_id"] for msg in batch if not msg.get("is_deleted", False))
+                chunk = await writer.write([
+                    {"type": "message", **build_row(msg, names.get(msg["sender_id"]), msg.get("reply_to_message"))}
+                    for msg in batch
+                ])
+                exported_messages.inc(amount=len(batch))
+                # gzip holds small batches back until it has a block to emit
+                if chunk:
+                    yield chunk
+
+        tail = writer.close()
+        if tail:
+            yield tail
+    finally:
+        active_exports -= 1
@@ -0,0 +1,70 @@
+import asyncio
+from typing import Optional
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+class BatchLoader:
+    """DataLoader-style loader for documents by _id.
+
+    Every load() issued before the event loop gets a chance to run the dispatch
+    is resolved with a single $in query, and each id is fetched at most once.
+    """
+    def __init__(self, collection, projection: Optional[dict] = None):
+        self.collection = collection
+        self.projection = projection
+        self._futures: dict[str, asyncio.Future] = {}
+        self._pending: list[str] = []
+        self._dispatch_task = None
+
+    def load(self, key: str) -> asyncio.Future:
+        """Future resolving to the document with this id, or None if there isn't one"""
+        if key in self._futures:
+            return self._futures[key]
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._futures[key] = future
+        self._pending.append(key)
+        if self._dispatch_task is None:
+            self._dispatch_task = loop.create_task(self._dispatch())
+        return future
+
+    async def load_many(self, keys) -> list:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    async def _dispatch(self):
+        keys, self._pending = self._pending, []
+        self._dispatch_task = None
+        
+        ids = []
+        for key in keys:
+            try:
+                ids.append(ObjectId(key))
+            except (InvalidId, TypeError):
+                pass  # Resolves to None like a missing document
+        
+        try:
+            documents = []
+            if ids:
+                documents = await self.collection.find(
+                    {"_id": {"$in": ids}}, self.projection
+                ).to_list(length=None)
+        except Exception as e:
+            for key in keys:
+                future = self._futures.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        by_id = {str(document["_id"]): document for document in documents}
+        for key in keys:
+            future = self._futures[key]
+            if not future.done():
+                future.set_result(by_id.get(key))
+
+class Loaders:
+    """Loaders scoped to one request, so a page of messages costs one query per collection"""
+    def __init__(self, db, user_projection: Optional[dict] = None, message_projection: Optional[dict] = None):
+        self.users = BatchLoader(db.users, user_projection)
+        self.messages = BatchLoader(db.messages, message_projection)
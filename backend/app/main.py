@@ -1,32 +1,80 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, WebSocket, WebSocketDisconnect, Form
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, WebSocket, WebSocketDisconnect, Form, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from typing import List, Optional
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import shutil
 import asyncio
-import json
+import random
+import re
+import secrets
+import time
 from pathlib import Path
 
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
-from app.database import get_database
+from app.database import (
+    get_database, ensure_indexes, connect_database, close_database,
+    HISTORY, SEARCH, CHAT_LIST, PRESENCE
+)
 from app.models import (
     RegisterRequest, LoginRequest, User, UserResponse,
-    UpdateProfileRequest, Chat, Message, MessageResponse,
+    UpdateProfileRequest, Chat, Message,
     CreateGroupRequest, AddParticipantsRequest,
     ReplyMessageRequest, EditMessageRequest, ReactToMessageRequest,
     UpdateGroupRequest, RemoveParticipantRequest,
-    SearchMessagesRequest, ForwardMessageRequest, TypingIndicatorRequest
+    SearchMessagesRequest, ForwardMessageRequest, TypingIndicatorRequest, SyncRequest
 )
 from app.auth import get_password_hash, create_access_token, decode_access_token
 from app.login_strategy import login_factory
+from app.loaders import Loaders
+from app import (
+    cold_storage, events, export, memberships, message_store, metrics, query_stats, rate_limit, recent_messages,
+    tasks, versions, write_pipeline, ws_protocol
+)
+from app.serialization import encode_frame, encode_global_frame, encode_sync_batch, FastJSONResponse
+
+# Seconds between warm-up attempts while MongoDB is unreachable
+WARM_UP_RETRY_SECONDS = int(os.getenv("WARM_UP_RETRY_SECONDS", "5"))
+
+async def warm_up(app: FastAPI):
+    """Ensure indexes and open the connection pool, then report ready on /api/ready"""
+    while True:
+        try:
+            await ensure_indexes()
+            await get_database().command("ping")
+            break
+        except Exception as e:
+            print(f"⚠️  Warm-up failed, retrying in {WARM_UP_RETRY_SECONDS}s: {e}")
+            await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+    app.state.ready = True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    connect_database()
+    tasks.runner.start()
+    warm_up_task = asyncio.create_task(warm_up(app))
+    loop_lag_task = asyncio.create_task(metrics.monitor_event_loop_lag())
+    yield
+    app.state.ready = False
+    warm_up_task.cancel()
+    loop_lag_task.cancel()
+    await manager.drain()
+    await tasks.runner.drain()
+    await write_pipeline.flush_all()
+    close_database()
 
 app = FastAPI(
     title="Chat App API",
     description="Real-time chat application API with FastAPI and MongoDB",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -43,6 +91,8 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(query_stats.QueryStatsMiddleware)
 
 security = HTTPBearer()
 UPLOAD_DIR = Path("uploads")
@@ -52,6 +102,35 @@ UPLOAD_DIR.mkdir(exist_ok=True)
 
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 
+# Draining: clients are told to reconnect after DRAIN_RECONNECT_AFTER_MS plus a random
+# jitter of up to DRAIN_RECONNECT_JITTER_MS, so they don't all come back at once
+DRAIN_RECONNECT_AFTER_MS = int(os.getenv("DRAIN_RECONNECT_AFTER_MS", "1000"))
+DRAIN_RECONNECT_JITTER_MS = int(os.getenv("DRAIN_RECONNECT_JITTER_MS", "15000"))
+# How long a drain waits for broadcasts that are still being sent
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "10"))
+# Shared secret for /api/admin/drain (the endpoint is disabled when empty)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# Most chats one POST /api/sync may ask for
+MAX_SYNC_CHATS = int(os.getenv("MAX_SYNC_CHATS", "200"))
+# A socket operation retried while its first run is still going is told to try again after this
+OPERATION_RETRY_AFTER_MS = int(os.getenv("OPERATION_RETRY_AFTER_MS", "500"))
+# A first run still pending after this long died with its worker; a retry runs it again
+OPERATION_PENDING_TIMEOUT_SECONDS = int(os.getenv("OPERATION_PENDING_TIMEOUT_SECONDS", "30"))
+
+# Projections for hot read paths - only the fields the responses use
+MESSAGE_PROJECTION = {
+    "chat_id": 1, "sender_id": 1, "message_type": 1, "content": 1, "file_url": 1,
+    "reply_to": 1, "reply_to_message": 1, "edited_at": 1, "is_deleted": 1, "status": 1,
+    "reactions": 1, "seq": 1, "created_at": 1
+}
+REPLY_PROJECTION = {"sender_id": 1, "content": 1, "message_type": 1, "is_deleted": 1}
+SENDER_PROJECTION = {"username": 1, "full_name": 1}
+USER_PROJECTION = {"username": 1, "email": 1, "full_name": 1, "profile_image": 1, "is_online": 1, "last_seen": 1}
+# Largest page of GET /api/chats and /api/chats/archived
+MAX_CHAT_PAGE_SIZE = int(os.getenv("MAX_CHAT_PAGE_SIZE", "200"))
+# Responses with an ETag may be stored by the client but must be revalidated
+CONDITIONAL_CACHE_CONTROL = "private, no-cache"
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
     payload = decode_access_token(token)
@@ -78,9 +157,17 @@ class ConnectionManager:
         self.global_connections: dict[str, WebSocket] = {}  # user_id -> websocket for global updates
         self.typing_users: dict[str, dict[str, datetime]] = {}  # chat_id -> {user_id: timestamp}
         self.online_users: set[str] = set()
+        # Multiplexed /ws sockets: one per device, subscribed to the chats it shows
+        self.device_connections: dict[str, List[WebSocket]] = {}  # user_id -> sockets
+        self.chat_subscribers: dict[str, set] = {}  # chat_id -> subscribed sockets
+        self.device_subscriptions: dict[WebSocket, set] = {}  # socket -> chat_ids
+        self.draining = False
+        self.in_flight = 0  # Broadcasts currently being sent
+        self._idle = asyncio.Event()
+        self._idle.set()
 
     async def connect(self, websocket: WebSocket, chat_id: str, user_id: str = None):
-        await websocket.accept()
+        await ws_protocol.accept(websocket)
         if chat_id not in self.active_connections:
             self.active_connections[chat_id] = []
         self.active_connections[chat_id].append(websocket)
@@ -100,42 +187,152 @@ class ConnectionManager:
                 del self.user_connections[user_id]
             if user_id in self.online_users:
                 self.online_users.remove(user_id)
-            # Notify others in chat that user is offline
-            asyncio.create_task(self.broadcast_online_status(chat_id, user_id, False))
+            # Notify others in chat that user is offline (not while draining - they are reconnecting)
+            if not self.draining:
+                self.broadcast_offline(chat_id, user_id)
+
+    def connect_device(self, websocket: WebSocket, user_id: str):
+        self.device_connections.setdefault(user_id, []).append(websocket)
+        self.device_subscriptions[websocket] = set()
+        self.online_users.add(user_id)
+
+    def disconnect_device(self, websocket: WebSocket, user_id: str):
+        for chat_id in list(self.device_subscriptions.get(websocket, ())):
+            self.unsubscribe(websocket, chat_id, user_id)
+        self.device_subscriptions.pop(websocket, None)
+        devices = self.device_connections.get(user_id, [])
+        if websocket in devices:
+            devices.remove(websocket)
+        if not devices:
+            self.device_connections.pop(user_id, None)
+            self.online_users.discard(user_id)
+
+    async def subscribe(self, websocket: WebSocket, chat_id: str, user_id: str):
+        if chat_id in self.device_subscriptions[websocket]:
+            return
+        self.device_subscriptions[websocket].add(chat_id)
+        self.chat_subscribers.setdefault(chat_id, set()).add(websocket)
+        await self.broadcast_online_status(chat_id, user_id, True)
+
+    def unsubscribe(self, websocket: WebSocket, chat_id: str, user_id: str):
+        subscriptions = self.device_subscriptions.get(websocket, set())
+        if chat_id not in subscriptions:
+            return
+        subscriptions.discard(chat_id)
+        subscribers = self.chat_subscribers.get(chat_id, set())
+        subscribers.discard(websocket)
+        if not subscribers:
+            self.chat_subscribers.pop(chat_id, None)
+        if not self.draining:
+            self.broadcast_offline(chat_id, user_id)
+
+    def broadcast_offline(self, chat_id: str, user_id: str):
+        # In the background, since disconnects happen outside a coroutine; a user who drops
+        # several sockets of a chat at once is announced once
+        tasks.runner.submit(
+            "presence", lambda: self.broadcast_online_status(chat_id, user_id, False),
+            key=f"offline:{chat_id}:{user_id}"
+        )
 
     async def send_personal_message(self, message: dict, websocket: WebSocket):
-        await websocket.send_json(message)
+        await ws_protocol.send(websocket, encode_frame(message))
 
     async def broadcast(self, message: dict, chat_id: str):
-        if chat_id in self.active_connections:
-            for connection in self.active_connections[chat_id]:
+        # Encode once and send the same frame to every socket
+        await self.broadcast_frame(encode_frame(message), chat_id)
+
+    async def publish(self, message: dict, chat_id: str):
+        """Broadcast a state-changing event, stamped with the chat's next event_seq
+        and kept in the event log so reconnecting clients can catch up"""
+        db = get_database()
+        # A copy, so callers returning the same dict keep their documented response shape
+        message = {**message, "event_seq": await events.next_event_seq(db, chat_id)}
+        frame = encode_frame(message)
+        try:
+            await events.append(db, chat_id, message["event_seq"], frame)
+        except Exception as e:
+            # Live clients still get the event; resuming ones will be told to reset
+            print(f"⚠️  Could not log event {message['event_seq']} of chat {chat_id}: {e}")
+        await self.broadcast_frame(frame, chat_id)
+
+    async def broadcast_frame(self, frame: str, chat_id: str):
+        self.in_flight += 1
+        self._idle.clear()
+        start = time.perf_counter()
+        recipients = 0
+        # Packed at most once, for the first socket on the binary protocol
+        outgoing = ws_protocol.Frame(frame)
+        try:
+            chat_sockets = list(self.active_connections.get(chat_id, ()))
+            chat_sockets += self.chat_subscribers.get(chat_id, ())
+            for connection in chat_sockets:
                 try:
-                    await connection.send_json(message)
+                    await ws_protocol.send(connection, outgoing)
                 except:
                     pass
+            recipients = len(chat_sockets)
+            
+            # Also broadcast to global connections for chat list updates
+            recipients += await self.broadcast_to_global(encode_global_frame("new_message", chat_id, frame), chat_id)
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self._idle.set()
+            metrics.fanout_recipients.observe(recipients)
+            metrics.fanout_duration.observe(time.perf_counter() - start)
+
+    async def drain(self) -> int:
+        """Stop taking sockets, let in-flight broadcasts finish, then send every socket a
+        reconnect frame with a jittered delay and close it. Returns how many were closed."""
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), DRAIN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            pass
         
-        # Also broadcast to global connections for chat list updates
-        await self.broadcast_to_global({
-            "type": "new_message",
-            "chat_id": chat_id,
-            "message": message
-        }, chat_id)
+        sockets = [ws for connections in self.active_connections.values() for ws in connections]
+        sockets += list(self.global_connections.values())
+        sockets += [ws for devices in self.device_connections.values() for ws in devices]
+        for websocket in sockets:
+            after_ms = DRAIN_RECONNECT_AFTER_MS + random.randint(0, DRAIN_RECONNECT_JITTER_MS)
+            try:
+                await ws_protocol.send(websocket, encode_frame({"type": "reconnect", "after_ms": after_ms}))
+                # 1012 = service restart
+                await websocket.close(code=1012, reason="Server restarting")
+            except:
+                pass
+        return len(sockets)
 
-    async def broadcast_to_global(self, message: dict, chat_id: str):
-        """Broadcast message to all users who have this chat in their list"""
+    async def broadcast_to_global(self, frame: str, chat_id: str) -> int:
+        """Broadcast an encoded frame to all users who have this chat in their list. Returns the number of sockets."""
+        if not self.global_connections and not self.device_connections:
+            return 0
         db = get_database()
+        sent = 0
+        outgoing = ws_protocol.Frame(frame)
         try:
-            chat = await db.chats.find_one({"_id": ObjectId(chat_id)})
+            chat = await db.chats.find_one({"_id": ObjectId(chat_id)}, {"participants": 1})
             if chat:
-                # Send to all participants who have global connection
+                subscribers = self.chat_subscribers.get(chat_id, ())
                 for participant_id in chat.get("participants", []):
+                    # Send to all participants who have global connection
                     if participant_id in self.global_connections:
+                        sent += 1
                         try:
-                            await self.global_connections[participant_id].send_json(message)
+                            await ws_protocol.send(self.global_connections[participant_id], outgoing)
                         except:
                             pass
+                    # Devices subscribed to the chat already got the event itself
+                    for device in self.device_connections.get(participant_id, ()):
+                        if device not in subscribers:
+                            sent += 1
+                            try:
+                                await ws_protocol.send(device, outgoing)
+                            except:
+                                pass
         except:
             pass
+        return sent
 
     async def broadcast_typing(self, chat_id: str, user_id: str, is_typing: bool):
         typing_data = {
@@ -163,37 +360,299 @@ class ConnectionManager:
             "status": status,
             "user_id": user_id
         }
-        await self.broadcast(status_data, chat_id)
+        if status == "delivered":
+            # One per recipient of every message and nothing stored changes - sent live
+            # like typing, so a big group doesn't flood the event log and chat versions
+            await self.broadcast(status_data, chat_id)
+        else:
+            await self.publish(status_data, chat_id)
 
 manager = ConnectionManager()
+metrics.register_connection_gauges(manager)
 
 # Helper function to update message status
-async def update_message_status(message_id: str, user_id: str, status: str):
+async def update_message_status(chat_id: str, message_id: str, user_id: str, status: str):
+    if status == "delivered":
+        # Only sent right after the message was stored - nothing to look up or record
+        await manager.broadcast_message_status(chat_id, message_id, status, user_id)
+        return
+    db = get_database()
+    message = await message_store.find_message(db, chat_id, ObjectId(message_id), {"seq": 1})
+    if message:
+        # Update read_by list for read status
+        if status == "read":
+            await message_store.mark_read(db, chat_id, message["_id"], user_id)
+            if message.get("seq") is not None:
+                await memberships.mark_read(db, chat_id, user_id, message["seq"])
+        # Broadcast the status update
+        await manager.broadcast_message_status(
+            chat_id,
+            message_id,
+            status,
+            user_id
+        )
+
+def submit_status_update(chat_id: str, message_id: str, user_id: str, status: str):
+    tasks.runner.submit(
+        "message_status", lambda: update_message_status(chat_id, message_id, user_id, status),
+        key=f"status:{message_id}:{user_id}:{status}", retries=2
+    )
+
+# Helper function to resolve emails/usernames to user IDs in one query
+async def resolve_participant_identifiers(identifiers: List[str]):
+    """Resolve emails or usernames to user IDs with a single $in query.
+
+    Returns (user_ids, not_found), both in the order the identifiers were given.
+    """
     db = get_database()
+    identifiers = list(dict.fromkeys(identifiers))  # Drop duplicates, keep order
+    if not identifiers:
+        return [], []
+    
+    users = await db.users.find(
+        {"$or": [
+            {"email": {"$in": identifiers}},
+            {"username": {"$in": identifiers}}
+        ]},
+        {"email": 1, "username": 1}
+    ).to_list(length=None)
+    
+    by_identifier = {}
+    for user in users:
+        by_identifier[user["email"]] = str(user["_id"])
+        by_identifier.setdefault(user["username"], str(user["_id"]))
+    
+    user_ids = []
+    not_found = []
+    for identifier in identifiers:
+        user_id = by_identifier.get(identifier)
+        if user_id is None:
+            not_found.append(identifier)
+        elif user_id not in user_ids:
+            user_ids.append(user_id)
+    return user_ids, not_found
+
+# Helper function to allocate the next sequence number of a chat
+async def next_chat_seq(chat_id: str) -> int:
+    db = get_database()
+    counter = await db.counters.find_one_and_update(
+        {"_id": f"chat:{chat_id}"},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+# Helper function to collect the missed events of the given chats the user is in
+async def sync_frames(user_id: str, since_by_chat: dict) -> List[str]:
+    """One encoded sync batch per chat, see app/events.py. Chats the user isn't in are left out."""
+    db = get_database()
+    chat_ids = [chat_id for chat_id in since_by_chat if ObjectId.is_valid(chat_id)]
+    member_chats = await db.chats.find(
+        {"_id": {"$in": [ObjectId(chat_id) for chat_id in chat_ids]}, "participants": user_id},
+        {"_id": 1}
+    ).to_list(length=None)
+    member_ids = {str(chat["_id"]) for chat in member_chats}
+    
+    frames = []
+    for chat_id in chat_ids:
+        if chat_id in member_ids:
+            batch = await events.read_since(db, chat_id, int(since_by_chat[chat_id]))
+            frames.append(encode_sync_batch(chat_id, batch))
+    return frames
+
+class OperationInProgress(HTTPException):
+    """The first run of a retried operation hasn't finished yet - its outcome is still unknown"""
+    def __init__(self):
+        super().__init__(status_code=409, detail="Operation still in progress")
+
+# Helper function to run a client operation at most once per idempotency key
+async def run_idempotent(user_id: str, key: str, op: str, operation):
+    """Run operation() once per (user, key) and return its result.
+
+    A retried key returns the stored result of the first run instead of running again,
+    or raises OperationInProgress while that run is still pending.
+    """
+    db = get_database()
+    record_id = f"{user_id}:{key}"
+    started_at = datetime.now()
     try:
-        message = await db.messages.find_one({"_id": ObjectId(message_id)})
-        if message:
-            # Update read_by list for read status
-            if status == "read":
-                await db.messages.update_one(
-                    {"_id": ObjectId(message_id)},
-                    {"$addToSet": {"read_by": user_id}}  # Add user_id to read_by list if not exists
-                )
-            # Broadcast the status update
-            await manager.broadcast_message_status(
-                message["chat_id"],
-                message_id,
-                status,
-                user_id
-            )
+        await db.idempotency_keys.insert_one({
+            "_id": record_id,
+            "op": op,
+            "status": "pending",
+            "result": None,
+            "created_at": started_at
+        })
+    except DuplicateKeyError:
+        record = await db.idempotency_keys.find_one({"_id": record_id})
+        if record and record.get("status") == "done":
+            return record.get("result")
+        # Pending, or just failed and removed - either way the client asks again later
+        if not record or record["created_at"] > started_at - timedelta(seconds=OPERATION_PENDING_TIMEOUT_SECONDS):
+            raise OperationInProgress()
+        # Left pending by a worker that died mid-run; the first retry to claim it runs it
+        claimed = await db.idempotency_keys.update_one(
+            {"_id": record_id, "status": "pending", "created_at": record["created_at"]},
+            {"$set": {"created_at": started_at}}
+        )
+        if not claimed.modified_count:
+            raise OperationInProgress()
+    
+    try:
+        result = await operation()
     except:
-        pass
+        # Let the client retry an operation that didn't go through
+        await db.idempotency_keys.delete_one({"_id": record_id})
+        raise
+    
+    await db.idempotency_keys.update_one({"_id": record_id}, {"$set": {"status": "done", "result": result}})
+    return result
+
+# Helper function to get the name shown for a sender
+def display_name(user: Optional[dict]) -> str:
+    if not user:
+        return "Unknown"
+    return user.get("full_name") or user["username"]
+
+def build_reply_preview(reply_msg: dict, reply_sender: Optional[dict]):
+    return {
+        "id": str(reply_msg["_id"]),
+        "sender_id": reply_msg["sender_id"],
+        "sender_name": display_name(reply_sender),
+        "content": reply_msg["content"] if not reply_msg.get("is_deleted") else "This message was deleted",
+        "message_type": reply_msg["message_type"]
+    }
+
+# Helper function to refresh the reply previews stored on replies to a message
+async def refresh_reply_previews(chat_id: str, message_id: str):
+    """Copy the replied-to message's current content into its replies' previews"""
+    db = get_database()
+    message = await message_store.find_message(db, chat_id, ObjectId(message_id), {"content": 1})
+    if not message:
+        return
+    modified = await message_store.refresh_reply_previews(db, chat_id, message_id, message["content"])
+    recent_messages.cache.refresh_replies(chat_id, message_id, message["content"])
+    if modified:
+        await versions.bump_chat(db, chat_id)
+
+def submit_reply_preview_refresh(chat_id: str, message_id: str):
+    # The job reads the content when it runs, so a waiting refresh also covers later edits
+    tasks.runner.submit(
+        "reply_previews", lambda: refresh_reply_previews(chat_id, message_id),
+        key=f"replies:{message_id}", retries=3
+    )
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CONDITIONAL_CACHE_CONTROL})
+
+def get_loaders(db) -> Loaders:
+    """Fresh batch loaders for one request"""
+    return Loaders(db, user_projection=SENDER_PROJECTION, message_projection=REPLY_PROJECTION)
+
+async def render_messages(messages: List[dict], loaders: Loaders):
+    """Build response rows for messages, resolving senders and replies in batches"""
+    live = [msg for msg in messages if not msg.get("is_deleted", False)]
+    
+    # One $in query for every sender and one for replied-to messages without a stored preview...
+    _, replies = await asyncio.gather(
+        loaders.users.load_many([msg["sender_id"] for msg in live]),
+        loaders.messages.load_many([
+            msg["reply_to"] for msg in live
+            if msg.get("reply_to") and msg.get("reply_to_message") is None
+        ])
+    )
+    # ...then one for the reply senders that weren't loaded already
+    await loaders.users.load_many([reply["sender_id"] for reply in replies if reply])
+    
+    message_list = []
+    for msg in messages:
+        if msg.get("is_deleted", False):
+            message_list.append(build_message_row(msg, ""))
+            continue
+        
+        sender = await loaders.users.load(msg["sender_id"])
+        
+        # Replies store their preview since it was persisted at write time
+        reply_to_message = msg.get("reply_to_message")
+        if reply_to_message is None and msg.get("reply_to"):
+            reply_msg = await loaders.messages.load(msg["reply_to"])
+            if reply_msg:
+                reply_sender = await loaders.users.load(reply_msg["sender_id"])
+                reply_to_message = build_reply_preview(reply_msg, reply_sender)
+        
+        message_list.append(build_message_row(msg, display_name(sender), reply_to_message))
+    return message_list
+
+# Helper function to build an app.models.MessageResponse-shaped dict straight from a database document
+def build_message_row(msg: dict, sender_name: str, reply_to_message: Optional[dict] = None):
+    """Same fields and order as MessageResponse, without running model validation"""
+    if msg.get("is_deleted", False):
+        # Return deleted message with minimal info
+        return {
+            "id": str(msg["_id"]),
+            "chat_id": msg["chat_id"],
+            "sender_id": msg["sender_id"],
+            "sender_name": "",
+            "message_type": msg["message_type"],
+            "content": "This message was deleted",
+            "file_url": None,
+            "reply_to": msg.get("reply_to"),
+            "reply_to_message": None,
+            "edited_at": msg.get("edited_at"),
+            "is_deleted": True,
+            "status": msg.get("status", "sent"),
+            "reactions": msg.get("reactions", {}),
+            "seq": msg.get("seq"),
+            "created_at": msg["created_at"]
+        }
+    return {
+        "id": str(msg["_id"]),
+        "chat_id": msg["chat_id"],
+        "sender_id": msg["sender_id"],
+        "sender_name": sender_name,
+        "message_type": msg["message_type"],
+        "content": msg["content"],
+        "file_url": msg.get("file_url"),
+        "reply_to": msg.get("reply_to"),
+        "reply_to_message": reply_to_message,
+        "edited_at": msg.get("edited_at"),
+        "is_deleted": False,
+        "status": msg.get("status", "sent"),
+        "reactions": msg.get("reactions", {}),
+        "seq": msg.get("seq"),
+        "created_at": msg["created_at"]
+    }
 
 # Health check endpoint
 @app.get("/api/health")
 async def health_check():
     return {"status": "ok", "message": "Backend is running"}
 
+# Prometheus metrics, see app/metrics.py
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Readiness for the load balancer: 503 until warmed up and while draining
+@app.get("/api/ready")
+async def readiness_check():
+    if manager.draining:
+        return FastJSONResponse({"status": "draining"}, status_code=503)
+    if not app.state.ready:
+        return FastJSONResponse({"status": "starting"}, status_code=503)
+    return {"status": "ready"}
+
+# Call before stopping a worker: uvicorn's own shutdown closes sockets without a reconnect hint
+@app.post("/api/admin/drain")
+async def drain_connections(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Not allowed")
+    closed = await manager.drain()
+    return {"status": "draining", "closed": closed}
+
 # Auth endpoints
 @app.post("/api/auth/register", response_model=dict)
 async def register(user_data: RegisterRequest):
@@ -246,7 +705,7 @@ async def login(login_data: LoginRequest):
         access_token = create_access_token(data={"sub": str(user.id)})
         
         # Update online status on login
-        db = get_database()
+        db = get_database(PRESENCE)
         await db.users.update_one(
             {"_id": ObjectId(str(user.id))},
             {"$set": {"is_online": True, "last_seen": datetime.now()}}
@@ -314,6 +773,9 @@ async def update_profile(
     
     if update_dict:
         await db.users.update_one({"_id": user_id}, {"$set": update_dict})
+        # Cached message pages show sender names
+        if "username" in update_dict or "full_name" in update_dict:
+            recent_messages.cache.clear()
     
     updated_user = await db.users.find_one({"_id": user_id})
     return UserResponse(
@@ -355,25 +817,28 @@ async def upload_profile_image(
 
 @app.get("/api/users/search")
 async def search_users(query: str, current_user: User = Depends(get_current_user)):
-    db = get_database()
+    db = get_database(SEARCH)
     users = await db.users.find({
         "$or": [
             {"email": {"$regex": query, "$options": "i"}},
             {"username": {"$regex": query, "$options": "i"}}
         ],
         "_id": {"$ne": ObjectId(str(current_user.id))}
-    }).limit(20).to_list(length=20)
-    
-    return [
-        UserResponse(
-            id=str(u["_id"]),
-            username=u["username"],
-            email=u["email"],
-            full_name=u.get("full_name"),
-            profile_image=u.get("profile_image")
-        ).dict()
+    }, {"username": 1, "email": 1, "full_name": 1, "profile_image": 1}).limit(20).to_list(length=20)
+    
+    # Same fields as UserResponse
+    return FastJSONResponse([
+        {
+            "id": str(u["_id"]),
+            "username": u["username"],
+            "email": u["email"],
+            "full_name": u.get("full_name"),
+            "profile_image": u.get("profile_image"),
+            "is_online": False,
+            "last_seen": None
+        }
         for u in users
-    ]
+    ])
 
 # Chat endpoints
 @app.post("/api/chats/single")
@@ -419,6 +884,7 @@ async def create_single_chat(
     }
     
     result = await db.chats.insert_one(chat_dict)
+    await memberships.add_members(db, str(result.inserted_id), chat_dict["participants"])
     return {"chat_id": str(result.inserted_id)}
 
 @app.post("/api/chats/group")
@@ -435,15 +901,8 @@ async def create_group(
     
     # Find participants by email or username
     participant_ids = [str(current_user.id)]
-    for identifier in identifiers_list:
-        user = await db.users.find_one({
-            "$or": [
-                {"email": identifier},
-                {"username": identifier}
-            ]
-        })
-        if user:
-            participant_ids.append(str(user["_id"]))
+    found_ids, not_found = await resolve_participant_identifiers(identifiers_list)
+    participant_ids.extend(pid for pid in found_ids if pid != str(current_user.id))
     
     # Handle group image upload
     group_image_url = None
@@ -471,17 +930,60 @@ async def create_group(
     }
     
     result = await db.chats.insert_one(chat_dict)
-    return {"chat_id": str(result.inserted_id)}
+    await memberships.add_members(db, str(result.inserted_id), participant_ids, admins=chat_dict["admins"])
+    return {"chat_id": str(result.inserted_id), "not_found": not_found}
+
+async def chat_list_page(db, user_id: str, archived: bool, limit: int, cursor: Optional[str], projection: dict = None):
+    """The user's chats, most recent activity first: (member documents, chats, next page cursor)"""
+    if limit < 1 or limit > MAX_CHAT_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_CHAT_PAGE_SIZE}")
+    try:
+        members, next_cursor = await memberships.list_page(db, user_id, archived, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    chats_by_id = {
+        str(chat["_id"]): chat
+        async for chat in db.chats.find({"_id": {"$in": [ObjectId(m["chat_id"]) for m in members]}}, projection)
+    }
+    # In member order; a member document can briefly outlive a chat it was removed from
+    chats = [chats_by_id[m["chat_id"]] for m in members if m["chat_id"] in chats_by_id]
+    return members, chats, next_cursor
 
 @app.get("/api/chats")
-async def get_user_chats(current_user: User = Depends(get_current_user)):
-    db = get_database()
+async def get_user_chats(
+    limit: int = 100,
+    cursor: Optional[str] = None,  # X-Next-Cursor of the previous page
+    current_user: User = Depends(get_current_user),
+    if_none_match: Optional[str] = Header(None)
+):
+    db = get_database(CHAT_LIST)
     user_id = str(current_user.id)
     
-    chats = await db.chats.find({
-        "participants": user_id,
-        "is_archived": {"$ne": True}  # Exclude archived chats
-    }).to_list(length=100)
+    members, chats, next_cursor = await chat_list_page(
+        db, user_id, False, limit, cursor,
+        {"chat_type": 1, "group_name": 1, "group_image": 1, "participants": 1, "created_at": 1}
+    )
+    
+    # Unchanged page, chat documents and chat versions -> unchanged list, without the per-chat queries
+    chat_versions = await versions.chat_versions(db, [str(chat["_id"]) for chat in chats])
+    etag = versions.make_etag(user_id, members, chats, chat_versions)
+    if versions.matches(if_none_match, etag):
+        return not_modified(etag)
+    
+    # Unread counts of the whole page in one query, from each member's last read seq
+    unread_counts = await message_store.count_unread(
+        db, {member["chat_id"]: member.get("last_read_seq", 0) for member in members}, user_id
+    )
+    
+    # Other participants and the last messages of the whole page in batches, then their senders
+    loaders = Loaders(db, user_projection=USER_PROJECTION)
+    last_messages = await message_store.find_last_messages(
+        db, [str(chat["_id"]) for chat in chats],
+        {"content": 1, "message_type": 1, "sender_id": 1, "created_at": 1}
+    )
+    await loaders.users.load_many([pid for chat in chats for pid in chat["participants"] if pid != user_id])
+    await loaders.users.load_many([msg["sender_id"] for msg in last_messages.values()])
     
     chat_list = []
     for chat in chats:
@@ -489,10 +991,7 @@ async def get_user_chats(current_user: User = Depends(get_current_user)):
         participants_info = []
         for pid in chat["participants"]:
             if pid != user_id:
-                try:
-                    user = await db.users.find_one({"_id": ObjectId(pid)})
-                except:
-                    user = None
+                user = await loaders.users.load(pid)
                 if user:
                     participants_info.append({
                         "id": pid,
@@ -506,33 +1005,18 @@ async def get_user_chats(current_user: User = Depends(get_current_user)):
         
         # Get last message
         last_message = None
-        last_msg = await db.messages.find_one(
-            {"chat_id": str(chat["_id"])},
-            sort=[("created_at", -1)]
-        )
+        last_msg = last_messages.get(str(chat["_id"]))
         if last_msg:
-            sender = await db.users.find_one({"_id": ObjectId(last_msg["sender_id"])})
-            sender_name = sender.get("full_name") if sender and sender.get("full_name") else (sender["username"] if sender else "Unknown")
+            sender = await loaders.users.load(last_msg["sender_id"])
             last_message = {
                 "id": str(last_msg["_id"]),
                 "content": last_msg.get("content", ""),
                 "message_type": last_msg.get("message_type", "text"),
                 "sender_id": last_msg["sender_id"],
-                "sender_name": sender_name,
+                "sender_name": display_name(sender),
                 "created_at": last_msg["created_at"]
             }
         
-        # Count unread messages (messages not sent by user and not read by user)
-        # Use $nin to check if user_id is not in read_by array
-        unread_count = await db.messages.count_documents({
-            "chat_id": str(chat["_id"]),
-            "sender_id": {"$ne": user_id},
-            "$or": [
-                {"read_by": {"$exists": False}},  # Old messages without read_by field
-                {"read_by": {"$nin": [user_id]}}  # User is not in read_by array
-            ]
-        })
-        
         chat_list.append({
             "id": str(chat["_id"]),
             "chat_type": chat["chat_type"],
@@ -540,17 +1024,14 @@ async def get_user_chats(current_user: User = Depends(get_current_user)):
             "group_image": chat.get("group_image"),
             "participants": participants_info,
             "last_message": last_message,
-            "unread_count": unread_count,
+            "unread_count": unread_counts.get(str(chat["_id"]), 0),
             "created_at": chat["created_at"]
         })
     
-    # Sort by last message time (most recent first)
-    chat_list.sort(key=lambda x: (
-        x["last_message"]["created_at"] if x.get("last_message") and x["last_message"].get("created_at") 
-        else x.get("created_at", datetime.min)
-    ), reverse=True)
-    
-    return chat_list
+    headers = {"ETag": etag, "Cache-Control": CONDITIONAL_CACHE_CONTROL}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return FastJSONResponse(chat_list, headers=headers)
 
 @app.post("/api/chats/{chat_id}/participants")
 async def add_participants(
@@ -570,24 +1051,19 @@ async def add_participants(
     if str(current_user.id) not in chat["participants"]:
         raise HTTPException(status_code=403, detail="Not a participant")
     
-    new_participants = []
-    for identifier in participants_data.emails:  # Can be email or username
-        user = await db.users.find_one({
-            "$or": [
-                {"email": identifier},
-                {"username": identifier}
-            ]
-        })
-        if user and str(user["_id"]) not in chat["participants"]:
-            new_participants.append(str(user["_id"]))
+    # Can be email or username
+    found_ids, not_found = await resolve_participant_identifiers(participants_data.emails)
+    new_participants = [pid for pid in found_ids if pid not in chat["participants"]]
     
     if new_participants:
         await db.chats.update_one(
             {"_id": ObjectId(chat_id)},
-            {"$push": {"participants": {"$each": new_participants}}}
+            {"$addToSet": {"participants": {"$each": new_participants}}}
         )
+        await memberships.add_members(db, chat_id, new_participants)
+        recent_messages.cache.invalidate(chat_id)
     
-    return {"added": len(new_participants)}
+    return {"added": len(new_participants), "not_found": not_found}
 
 # Message endpoints
 @app.get("/api/chats/{chat_id}/messages")
@@ -595,8 +1071,40 @@ async def get_messages(
     chat_id: str,
     limit: int = 50,
     skip: int = 0,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    if_none_match: Optional[str] = Header(None)
 ):
+    cache = recent_messages.cache
+    if not cache.cacheable(skip, limit):
+        return await read_messages_page(chat_id, limit, skip, current_user, if_none_match)
+    
+    # The newest page of a recently read chat is answered from memory
+    page = cache.get(chat_id)
+    if page is not None and str(current_user.id) in page.participants and page.covers(limit):
+        recent_messages.lookups.inc("hit")
+        etag = versions.make_etag(chat_id, page.version, skip, limit)
+        if versions.matches(if_none_match, etag):
+            return not_modified(etag)
+        return FastJSONResponse({
+            "messages": page.rows[-limit:],
+            "total": page.total,
+            "has_more": limit < page.total,
+            "skip": skip,
+            "limit": limit
+        }, headers={"ETag": etag, "Cache-Control": CONDITIONAL_CACHE_CONTROL})
+    
+    recent_messages.lookups.inc("miss")
+    fill = cache.begin_fill(chat_id)
+    try:
+        return await read_messages_page(chat_id, limit, skip, current_user, if_none_match, fill)
+    finally:
+        cache.end_fill(fill)
+
+async def read_messages_page(
+    chat_id: str, limit: int, skip: int, current_user: User, if_none_match: Optional[str],
+    fill: Optional[recent_messages.Fill] = None
+):
+    """A page of messages from the database; with fill, the chat's newest rows are also cached"""
     db = get_database()
     try:
         chat = await db.chats.find_one({"_id": ObjectId(chat_id)})
@@ -609,86 +1117,72 @@ async def get_messages(
     if str(current_user.id) not in chat["participants"]:
         raise HTTPException(status_code=403, detail="Not a participant")
     
-    # Get total count for pagination
-    total_count = await db.messages.count_documents({"chat_id": chat_id})
+    # Membership is checked on the primary, the history itself may come from a secondary
+    db = get_database(HISTORY)
+    
+    # Read from the same member as the page, so the version never runs ahead of it
+    version = (await versions.chat_versions(db, [chat_id]))[chat_id]
+    etag = versions.make_etag(chat_id, version, skip, limit)
+    if versions.matches(if_none_match, etag):
+        return not_modified(etag)
+    
+    # Get total count for pagination - recent history in MongoDB plus the archived cold tier
+    hot_count = await message_store.count_messages(db, chat_id)
+    cold_count = await asyncio.to_thread(cold_storage.count_messages, chat_id)
+    total_count = hot_count + cold_count
+    
+    # A page that will be cached is read at the cache's size
+    read_limit = recent_messages.cache.per_chat if fill else limit
     
     # Fetch messages (newest first, then reverse for display)
-    messages = await db.messages.find(
-        {"chat_id": chat_id}
-    ).sort("created_at", -1).skip(skip).limit(limit).to_list(length=limit)
+    messages = []
+    if skip < hot_count:
+        messages = await message_store.fetch_page(db, chat_id, skip, read_limit, MESSAGE_PROJECTION)
+    
+    # Scrolled past the hot range - continue with archived messages
+    if len(messages) < read_limit and cold_count:
+        messages += await asyncio.to_thread(
+            cold_storage.read_page, chat_id, max(0, skip - hot_count), read_limit - len(messages)
+        )
     
     # Check if there are more messages
     has_more = (skip + limit) < total_count
     
-    message_list = []
-    for msg in reversed(messages):
-        if msg.get("is_deleted", False):
-            # Return deleted message with minimal info
-            message_list.append(MessageResponse(
-                id=str(msg["_id"]),
-                chat_id=msg["chat_id"],
-                sender_id=msg["sender_id"],
-                sender_name="",
-                message_type=msg["message_type"],
-                content="This message was deleted",
-                file_url=None,
-                reply_to=msg.get("reply_to"),
-                reply_to_message=None,
-                edited_at=msg.get("edited_at"),
-                is_deleted=True,
-                status=msg.get("status", "sent"),
-                reactions=msg.get("reactions", {}),
-                created_at=msg["created_at"]
-            ).dict())
-            continue
-            
-        try:
-            sender = await db.users.find_one({"_id": ObjectId(msg["sender_id"])})
-        except:
-            sender = None
-        sender_name = sender.get("full_name") if sender and sender.get("full_name") else (sender["username"] if sender else "Unknown")
-        
-        # Get reply_to message if exists
-        reply_to_message = None
-        if msg.get("reply_to"):
-            try:
-                reply_msg = await db.messages.find_one({"_id": ObjectId(msg["reply_to"])})
-                if reply_msg:
-                    reply_sender = await db.users.find_one({"_id": ObjectId(reply_msg["sender_id"])})
-                    reply_to_message = {
-                        "id": str(reply_msg["_id"]),
-                        "sender_id": reply_msg["sender_id"],
-                        "sender_name": reply_sender.get("full_name") if reply_sender and reply_sender.get("full_name") else (reply_sender["username"] if reply_sender else "Unknown"),
-                        "content": reply_msg["content"] if not reply_msg.get("is_deleted") else "This message was deleted",
-                        "message_type": reply_msg["message_type"]
-                    }
-            except:
-                pass
-        
-        message_list.append(MessageResponse(
-            id=str(msg["_id"]),
-            chat_id=msg["chat_id"],
-            sender_id=msg["sender_id"],
-            sender_name=sender_name,
-            message_type=msg["message_type"],
-            content=msg["content"],
-            file_url=msg.get("file_url"),
-            reply_to=msg.get("reply_to"),
-            reply_to_message=reply_to_message,
-            edited_at=msg.get("edited_at"),
-            is_deleted=False,
-            status=msg.get("status", "sent"),
-            reactions=msg.get("reactions", {}),
-            created_at=msg["created_at"]
-        ).dict())
+    message_list = await render_messages(list(reversed(messages)), get_loaders(db))
+    if fill:
+        recent_messages.cache.store(fill, message_list, total_count, chat["participants"], version)
+        message_list = message_list[-limit:]
     
-    return {
+    return FastJSONResponse({
         "messages": message_list,
         "total": total_count,
         "has_more": has_more,
         "skip": skip,
         "limit": limit
-    }
+    }, headers={"ETag": etag, "Cache-Control": CONDITIONAL_CACHE_CONTROL})
+
+# Events of a chat after the client's last event_seq, for catching up after a reconnect
+@app.get("/api/chats/{chat_id}/sync")
+async def sync_chat(
+    chat_id: str,
+    since: int = 0,
+    current_user: User = Depends(get_current_user)
+):
+    frames = await sync_frames(str(current_user.id), {chat_id: since})
+    if not frames:
+        raise HTTPException(status_code=403, detail="Not a participant")
+    return Response(content=frames[0], media_type="application/json")
+
+# The same for several chats in one round trip: {"chats": {chat_id: since}}
+@app.post("/api/sync")
+async def sync_chats(
+    sync_data: SyncRequest,
+    current_user: User = Depends(get_current_user)
+):
+    if len(sync_data.chats) > MAX_SYNC_CHATS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SYNC_CHATS} chats per sync")
+    frames = await sync_frames(str(current_user.id), sync_data.chats)
+    return Response(content='{"chats":[%s]}' % ",".join(frames), media_type="application/json")
 
 @app.post("/api/chats/{chat_id}/messages")
 async def send_message(
@@ -696,6 +1190,7 @@ async def send_message(
     content: str,
     message_type: str = "text",
     reply_to: Optional[str] = None,
+    client_msg_id: Optional[str] = None,  # Client-generated idempotency key
     current_user: User = Depends(get_current_user)
 ):
     db = get_database()
@@ -709,21 +1204,17 @@ async def send_message(
     
     if str(current_user.id) not in chat["participants"]:
         raise HTTPException(status_code=403, detail="Not a participant")
+    # After the membership check, so outsiders can't use up the chat's allowance
+    rate_limit.check(rate_limit.MESSAGE, str(current_user.id), chat_id)
     
-    # Get reply_to message if exists
+    # Get reply_to message if exists - its preview is stored on the new message
     reply_to_message = None
     if reply_to:
         try:
-            reply_msg = await db.messages.find_one({"_id": ObjectId(reply_to)})
-            if reply_msg and reply_msg["chat_id"] == chat_id:
-                sender = await db.users.find_one({"_id": ObjectId(reply_msg["sender_id"])})
-                reply_to_message = {
-                    "id": str(reply_msg["_id"]),
-                    "sender_id": reply_msg["sender_id"],
-                    "sender_name": sender.get("full_name") if sender and sender.get("full_name") else (sender["username"] if sender else "Unknown"),
-                    "content": reply_msg["content"],
-                    "message_type": reply_msg["message_type"]
-                }
+            reply_msg = await message_store.find_message(db, chat_id, ObjectId(reply_to), REPLY_PROJECTION)
+            if reply_msg:
+                sender = await db.users.find_one({"_id": ObjectId(reply_msg["sender_id"])}, SENDER_PROJECTION)
+                reply_to_message = build_reply_preview(reply_msg, sender)
         except:
             reply_to = None
     
@@ -734,44 +1225,65 @@ async def send_message(
         "content": content,
         "file_url": None,
         "reply_to": reply_to,
+        "reply_to_message": reply_to_message,
         "edited_at": None,
         "is_deleted": False,
         "status": "sent",
         "reactions": {},
         "read_by": [],  # List of user IDs who have read this message
+        "seq": await next_chat_seq(chat_id),
         "created_at": datetime.now()
     }
+    if client_msg_id:
+        message_dict["client_msg_id"] = client_msg_id
     
-    result = await db.messages.insert_one(message_dict)
-    message_dict["_id"] = result.inserted_id
+    try:
+        inserted_id = await message_store.insert_message(db, message_dict)
+    except DuplicateKeyError:
+        # Retried send (e.g. after a reconnect) - return the stored message instead of a copy
+        message_dict = await message_store.find_by_client_msg_id(
+            db, chat_id, str(current_user.id), client_msg_id
+        )
+        if not message_dict:
+            raise HTTPException(status_code=409, detail="Duplicate message")
+        inserted_id = None
     
     # Get sender name
     sender_name = current_user.full_name if current_user.full_name else current_user.username
     
     message_response = {
-        "id": str(result.inserted_id),
+        "id": str(message_dict["_id"]),
         "chat_id": chat_id,
         "sender_id": str(current_user.id),
         "sender_name": sender_name,
-        "message_type": message_type,
-        "content": content,
+        "message_type": message_dict["message_type"],
+        "content": message_dict["content"],
         "file_url": None,
-        "reply_to": reply_to,
-        "reply_to_message": reply_to_message,
+        "reply_to": message_dict.get("reply_to"),
+        "reply_to_message": message_dict.get("reply_to_message"),
         "edited_at": None,
         "is_deleted": False,
         "status": "sent",
         "reactions": {},
+        "seq": message_dict.get("seq"),
+        "client_msg_id": client_msg_id,
         "created_at": message_dict["created_at"].isoformat()
     }
     
+    if inserted_id is None:
+        return message_response
+    
+    recent_messages.cache.add(chat_id, build_message_row(
+        {**message_dict, "_id": inserted_id}, sender_name, message_dict.get("reply_to_message")
+    ))
+    await memberships.touch(db, chat_id, message_dict["created_at"])
     # Broadcast via WebSocket
-    await manager.broadcast(message_response, chat_id)
+    await manager.publish(message_response, chat_id)
     
     # Update message status to delivered for other participants
     for participant_id in chat["participants"]:
         if participant_id != str(current_user.id):
-            asyncio.create_task(update_message_status(str(result.inserted_id), participant_id, "delivered"))
+            submit_status_update(chat_id, str(inserted_id), participant_id, "delivered")
     
     return message_response
 
@@ -792,6 +1304,8 @@ async def send_file(
     
     if str(current_user.id) not in chat["participants"]:
         raise HTTPException(status_code=403, detail="Not a participant")
+    # After the membership check, so outsiders can't use up the chat's allowance
+    rate_limit.check(rate_limit.FILE, str(current_user.id), chat_id)
     
     file_content = await file.read()
     if len(file_content) > MAX_FILE_SIZE:
@@ -822,15 +1336,16 @@ async def send_file(
         "status": "sent",
         "reactions": {},
         "read_by": [],  # List of user IDs who have read this message
+        "seq": await next_chat_seq(chat_id),
         "created_at": datetime.now()
     }
     
-    result = await db.messages.insert_one(message_dict)
+    inserted_id = await message_store.insert_message(db, message_dict)
     
     sender_name = current_user.full_name if current_user.full_name else current_user.username
     
     message_response = {
-        "id": str(result.inserted_id),
+        "id": str(inserted_id),
         "chat_id": chat_id,
         "sender_id": str(current_user.id),
         "sender_name": sender_name,
@@ -843,18 +1358,105 @@ async def send_file(
         "is_deleted": False,
         "status": "sent",
         "reactions": {},
+        "seq": message_dict["seq"],
         "created_at": message_dict["created_at"].isoformat()
     }
     
-    await manager.broadcast(message_response, chat_id)
+    recent_messages.cache.add(chat_id, build_message_row({**message_dict, "_id": inserted_id}, sender_name))
+    await memberships.touch(db, chat_id, message_dict["created_at"])
+    await manager.publish(message_response, chat_id)
     
     # Update message status to delivered for other participants
     for participant_id in chat["participants"]:
         if participant_id != str(current_user.id):
-            asyncio.create_task(update_message_status(str(result.inserted_id), participant_id, "delivered"))
+            submit_status_update(chat_id, str(inserted_id), participant_id, "delivered")
     
     return message_response
 
+WEBSOCKET_MESSAGE_OPERATIONS = {"send", "edit", "delete", "react"}
+
+async def get_websocket_user(user_id: str):
+    db = get_database()
+    try:
+        user = await db.users.find_one({"_id": ObjectId(user_id)})
+    except:
+        return None
+    if not user:
+        return None
+    user["id"] = str(user["_id"])
+    return User(**user)
+
+async def handle_message_operation(chat_id: str, user: Optional[User], message_data: dict):
+    """Run a send/edit/delete/react frame from a chat socket and build its ack or error reply"""
+    op = message_data["type"]
+    key = message_data.get("key")
+    message_id = message_data.get("message_id")
+    
+    try:
+        if not user:
+            raise HTTPException(status_code=401, detail="Authentication required")
+        if not key or not isinstance(key, str):
+            raise HTTPException(status_code=400, detail="Missing idempotency key")
+        if op != "send" and not isinstance(message_id, str):
+            raise HTTPException(status_code=400, detail="Missing message_id")
+        
+        if op == "send":
+            # Retried sends are deduplicated by the unique client_msg_id index
+            result = await send_message(
+                chat_id,
+                content=str(message_data.get("content", "")),
+                message_type=str(message_data.get("message_type", "text")),
+                reply_to=message_data.get("reply_to") or None,
+                client_msg_id=key,
+                current_user=user
+            )
+        elif op == "edit":
+            edit_data = EditMessageRequest(content=str(message_data.get("content", "")))
+            result = await run_idempotent(str(user.id), key, op, lambda: edit_message(
+                chat_id, message_id, edit_data, current_user=user
+            ))
+        elif op == "delete":
+            result = await run_idempotent(str(user.id), key, op, lambda: delete_message(
+                chat_id, message_id, current_user=user
+            ))
+        else:
+            reaction_data = ReactToMessageRequest(emoji=str(message_data.get("emoji", "")))
+            result = await run_idempotent(str(user.id), key, op, lambda: react_to_message(
+                chat_id, message_id, reaction_data, current_user=user
+            ))
+    except OperationInProgress as e:
+        return {
+            "type": "error", "op": op, "key": key, "status": e.status_code, "detail": e.detail,
+            "retry_after_ms": OPERATION_RETRY_AFTER_MS
+        }
+    except HTTPException as e:
+        return {"type": "error", "op": op, "key": key, "status": e.status_code, "detail": e.detail}
+    
+    result = result or {}
+    return {
+        "type": "ack",
+        "op": op,
+        "key": key,
+        "id": result.get("id", message_id),
+        "seq": result.get("seq"),
+        "data": result
+    }
+
+async def admit_frame(websocket: WebSocket, user_id: Optional[str]) -> bool:
+    """Frame flood control: over-limit frames are dropped with an error, and a socket that
+    keeps flooding after that is closed with 1008 (raises WebSocketDisconnect)"""
+    key = user_id or f"socket:{id(websocket)}"
+    wait = rate_limit.limiter.acquire(rate_limit.FRAME, key)
+    if not wait:
+        return True
+    if rate_limit.limiter.acquire(rate_limit.VIOLATION, key):
+        await websocket.close(code=1008, reason="Rate limit exceeded")
+        raise WebSocketDisconnect(code=1008)
+    await manager.send_personal_message(
+        {"type": "error", "detail": "Rate limited", "retry_after_ms": int(wait * 1000)}, websocket
+    )
+    return False
+
 # Global WebSocket endpoint for chat list updates
 @app.websocket("/ws/global")
 async def global_websocket_endpoint(websocket: WebSocket, token: str = None):
@@ -869,20 +1471,40 @@ async def global_websocket_endpoint(websocket: WebSocket, token: str = None):
         await websocket.close(code=1008, reason="Authentication required")
         return
     
-    await websocket.accept()
+    if manager.draining:
+        # 1013 = try again later
+        await websocket.close(code=1013, reason="Server draining")
+        return
+    
+    await ws_protocol.accept(websocket)
     manager.global_connections[user_id] = websocket
     
     try:
         while True:
             # Keep connection alive with ping/pong
-            await websocket.receive_text()
+            data = await ws_protocol.receive(websocket)
+            if not await admit_frame(websocket, user_id):
+                continue
+            try:
+                message_data = ws_protocol.decode(websocket, data)
+            except ValueError:
+                continue
+            # Resume after a reconnect: {"type": "resume", "chats": {chat_id: last event_seq}}
+            if isinstance(message_data, dict) and message_data.get("type") == "resume":
+                since_by_chat = message_data.get("chats")
+                if isinstance(since_by_chat, dict) and len(since_by_chat) <= MAX_SYNC_CHATS:
+                    try:
+                        for frame in await sync_frames(user_id, since_by_chat):
+                            await ws_protocol.send(websocket, frame)
+                    except (TypeError, ValueError):
+                        await manager.send_personal_message({"type": "error", "detail": "Invalid resume frame"}, websocket)
     except WebSocketDisconnect:
         if user_id in manager.global_connections:
             del manager.global_connections[user_id]
 
 # WebSocket endpoint
 @app.websocket("/ws/{chat_id}")
-async def websocket_endpoint(websocket: WebSocket, chat_id: str, token: str = None):
+async def websocket_endpoint(websocket: WebSocket, chat_id: str, token: str = None, since: Optional[int] = None):
     # Try to get user from token if provided
     user_id = None
     if token:
@@ -890,27 +1512,146 @@ async def websocket_endpoint(websocket: WebSocket, chat_id: str, token: str = No
         if payload:
             user_id = payload.get("sub")
     
+    if manager.draining:
+        await websocket.close(code=1013, reason="Server draining")
+        return
+    
     await manager.connect(websocket, chat_id, user_id)
+    session = {}
     try:
+        # Resuming client: send what it missed (live events may overlap - dedupe by event_seq)
+        if since is not None and user_id:
+            for frame in await sync_frames(user_id, {chat_id: since}):
+                await ws_protocol.send(websocket, frame)
+        
         while True:
-            data = await websocket.receive_text()
+            data = await ws_protocol.receive(websocket)
+            if not await admit_frame(websocket, user_id):
+                continue
             try:
-                message_data = json.loads(data)
-                msg_type = message_data.get("type")
-                
-                if msg_type == "typing" and user_id:
-                    is_typing = message_data.get("is_typing", False)
-                    await manager.broadcast_typing(chat_id, user_id, is_typing)
-                elif msg_type == "read" and user_id:
-                    message_id = message_data.get("message_id")
-                    if message_id:
-                        await update_message_status(message_id, user_id, "read")
-            except:
-                # Echo back or handle incoming messages
-                await manager.broadcast({"type": "ping", "data": data}, chat_id)
+                message_data = ws_protocol.decode(websocket, data)
+            except ValueError:
+                message_data = None
+            if not isinstance(message_data, dict):
+                # Answer only the sender instead of echoing garbage to the chat
+                await manager.send_personal_message({"type": "error", "detail": "Invalid frame"}, websocket)
+                continue
+            
+            await handle_chat_frame(websocket, chat_id, user_id, message_data, session)
     except WebSocketDisconnect:
         manager.disconnect(websocket, chat_id, user_id)
 
+# Frames a client sends about one chat, on /ws/{chat_id} or the multiplexed /ws
+async def handle_chat_frame(websocket: WebSocket, chat_id: str, user_id: Optional[str], message_data: dict, session: dict):
+    msg_type = message_data.get("type")
+    
+    if msg_type == "typing" and user_id:
+        # Over the limit typing indicators are dropped silently - the next one catches up
+        if rate_limit.limiter.acquire(rate_limit.TYPING, user_id, chat_id):
+            return
+        is_typing = message_data.get("is_typing", False)
+        await manager.broadcast_typing(chat_id, user_id, is_typing)
+    elif msg_type == "read" and user_id:
+        message_id = message_data.get("message_id")
+        if message_id:
+            try:
+                await update_message_status(chat_id, str(message_id), user_id, "read")
+            except Exception:
+                await manager.send_personal_message(
+                    {"type": "error", "detail": "Could not mark message as read", "message_id": message_id}, websocket
+                )
+    elif msg_type == "resume" and user_id:
+        try:
+            for frame in await sync_frames(user_id, {chat_id: int(message_data.get("since", 0))}):
+                await ws_protocol.send(websocket, frame)
+        except (TypeError, ValueError):
+            await manager.send_personal_message({"type": "error", "detail": "Invalid resume frame"}, websocket)
+    elif msg_type in WEBSOCKET_MESSAGE_OPERATIONS:
+        # The user is loaded once per socket, on its first operation
+        if session.get("user") is None and user_id:
+            session["user"] = await get_websocket_user(user_id)
+        reply = await handle_message_operation(chat_id, session.get("user"), message_data)
+        await manager.send_personal_message(reply, websocket)
+
+# Multiplexed WebSocket: one socket per device for every chat
+@app.websocket("/ws")
+async def device_websocket_endpoint(websocket: WebSocket, token: str = None):
+    """Chat-list updates for all of the user's chats, plus the full event stream of subscribed chats.
+
+    Each event reaches the socket once: as the chat event if the chat is subscribed,
+    otherwise wrapped in the global envelope.
+    """
+    user_id = None
+    if token:
+        payload = decode_access_token(token)
+        if payload:
+            user_id = payload.get("sub")
+    
+    if not user_id:
+        await websocket.close(code=1008, reason="Authentication required")
+        return
+    
+    if manager.draining:
+        await websocket.close(code=1013, reason="Server draining")
+        return
+    
+    await ws_protocol.accept(websocket)
+    manager.connect_device(websocket, user_id)
+    session = {}
+    db = get_database()
+    try:
+        while True:
+            data = await ws_protocol.receive(websocket)
+            if not await admit_frame(websocket, user_id):
+                continue
+            try:
+                message_data = ws_protocol.decode(websocket, data)
+            except ValueError:
+                message_data = None
+            if not isinstance(message_data, dict):
+                await manager.send_personal_message({"type": "error", "detail": "Invalid frame"}, websocket)
+                continue
+            
+            msg_type = message_data.get("type")
+            chat_id = message_data.get("chat_id")
+            
+            if msg_type == "subscribe":
+                chat = None
+                if isinstance(chat_id, str) and ObjectId.is_valid(chat_id):
+                    chat = await db.chats.find_one({"_id": ObjectId(chat_id), "participants": user_id}, {"_id": 1})
+                if not chat:
+                    await manager.send_personal_message(
+                        {"type": "error", "chat_id": chat_id, "detail": "Not a participant"}, websocket
+                    )
+                    continue
+                await manager.subscribe(websocket, chat_id, user_id)
+                await manager.send_personal_message({"type": "subscribed", "chat_id": chat_id}, websocket)
+                # Optional resume point, like ?since= on /ws/{chat_id}
+                if message_data.get("since") is not None:
+                    await handle_chat_frame(websocket, chat_id, user_id, {"type": "resume", "since": message_data["since"]}, session)
+            elif msg_type == "unsubscribe":
+                manager.unsubscribe(websocket, chat_id, user_id)
+                await manager.send_personal_message({"type": "unsubscribed", "chat_id": chat_id}, websocket)
+            elif msg_type == "resume" and isinstance(message_data.get("chats"), dict):
+                # Several chats at once, subscribed or not
+                since_by_chat = message_data["chats"]
+                if len(since_by_chat) > MAX_SYNC_CHATS:
+                    continue
+                try:
+                    for frame in await sync_frames(user_id, since_by_chat):
+                        await ws_protocol.send(websocket, frame)
+                except (TypeError, ValueError):
+                    await manager.send_personal_message({"type": "error", "detail": "Invalid resume frame"}, websocket)
+            elif chat_id in manager.device_subscriptions.get(websocket, ()):
+                await handle_chat_frame(websocket, chat_id, user_id, message_data, session)
+            else:
+                # Chat frames need a subscription first - it is where membership is checked
+                await manager.send_personal_message(
+                    {"type": "error", "chat_id": chat_id, "detail": "Not subscribed"}, websocket
+                )
+    except WebSocketDisconnect:
+        manager.disconnect_device(websocket, user_id)
+
 # ========== NEW FEATURES ENDPOINTS ==========
 
 # Message Status - Mark as read
@@ -926,7 +1667,7 @@ async def mark_message_read(
         if not chat or str(current_user.id) not in chat["participants"]:
             raise HTTPException(status_code=403, detail="Not a participant")
         
-        await update_message_status(message_id, str(current_user.id), "read")
+        await update_message_status(chat_id, message_id, str(current_user.id), "read")
         return {"status": "read"}
     except:
         raise HTTPException(status_code=404, detail="Message not found")
@@ -944,23 +1685,16 @@ async def mark_all_messages_read(
             raise HTTPException(status_code=403, detail="Not a participant")
         
         user_id = str(current_user.id)
-        # Update all messages in this chat that are not sent by the user
-        # Add user_id to read_by array for all unread messages
-        result = await db.messages.update_many(
-            {
-                "chat_id": chat_id,
-                "sender_id": {"$ne": user_id},
-                "$or": [
-                    {"read_by": {"$exists": False}},
-                    {"read_by": {"$nin": [user_id]}}
-                ]
-            },
-            {
-                "$addToSet": {"read_by": user_id}
-            }
-        )
+        # Mark all messages in this chat that are not sent by the user as read
+        updated_count = await message_store.mark_all_read(db, chat_id, user_id)
+        if updated_count:
+            await versions.bump_chat(db, chat_id)
+        # Everything up to the newest message
+        counter = await db.counters.find_one({"_id": f"chat:{chat_id}"})
+        if counter:
+            await memberships.mark_read(db, chat_id, user_id, counter["seq"])
         
-        return {"status": "success", "updated_count": result.modified_count}
+        return {"status": "success", "updated_count": updated_count}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -972,35 +1706,37 @@ async def edit_message(
     edit_data: EditMessageRequest,
     current_user: User = Depends(get_current_user)
 ):
+    rate_limit.check(rate_limit.MODIFY, str(current_user.id))
     db = get_database()
     try:
-        message = await db.messages.find_one({"_id": ObjectId(message_id)})
+        message = await message_store.find_message(db, chat_id, ObjectId(message_id))
     except:
         raise HTTPException(status_code=404, detail="Message not found")
     
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
-    if message["chat_id"] != chat_id:
-        raise HTTPException(status_code=400, detail="Message does not belong to this chat")
-    
     if message["sender_id"] != str(current_user.id):
         raise HTTPException(status_code=403, detail="You can only edit your own messages")
     
     if message.get("is_deleted"):
         raise HTTPException(status_code=400, detail="Cannot edit deleted message")
     
-    await db.messages.update_one(
-        {"_id": ObjectId(message_id)},
+    updated_message = await message_store.find_and_update_message(
+        db, chat_id, message["_id"],
         {"$set": {
             "content": edit_data.content,
             "edited_at": datetime.now()
         }}
     )
-    
-    updated_message = await db.messages.find_one({"_id": ObjectId(message_id)})
-    sender = await db.users.find_one({"_id": ObjectId(updated_message["sender_id"])})
-    sender_name = sender.get("full_name") if sender and sender.get("full_name") else (sender["username"] if sender else "Unknown")
+    if not updated_message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    recent_messages.cache.update(chat_id, message_id, {
+        "content": updated_message["content"],
+        "edited_at": updated_message.get("edited_at")
+    })
+    sender = await get_loaders(db).users.load(updated_message["sender_id"])
+    sender_name = display_name(sender)
     
     message_response = {
         "id": str(updated_message["_id"]),
@@ -1015,10 +1751,15 @@ async def edit_message(
         "is_deleted": False,
         "status": updated_message.get("status", "sent"),
         "reactions": updated_message.get("reactions", {}),
+        "seq": updated_message.get("seq"),
         "created_at": updated_message["created_at"].isoformat()
     }
     
-    await manager.broadcast({"type": "message_edited", "message": message_response}, chat_id)
+    await manager.publish({"type": "message_edited", "message": message_response}, chat_id)
+    
+    # Replies keep a copy of this message's content
+    submit_reply_preview_refresh(chat_id, message_id)
+    
     return message_response
 
 # Delete Message
@@ -1028,33 +1769,34 @@ async def delete_message(
     message_id: str,
     current_user: User = Depends(get_current_user)
 ):
+    rate_limit.check(rate_limit.MODIFY, str(current_user.id))
     db = get_database()
     try:
-        message = await db.messages.find_one({"_id": ObjectId(message_id)})
+        message = await message_store.find_message(db, chat_id, ObjectId(message_id))
     except:
         raise HTTPException(status_code=404, detail="Message not found")
     
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
-    if message["chat_id"] != chat_id:
-        raise HTTPException(status_code=400, detail="Message does not belong to this chat")
-    
     if message["sender_id"] != str(current_user.id):
         raise HTTPException(status_code=403, detail="You can only delete your own messages")
     
-    await db.messages.update_one(
-        {"_id": ObjectId(message_id)},
+    await message_store.update_message(
+        db, chat_id, message["_id"],
         {"$set": {"is_deleted": True, "content": "This message was deleted"}}
     )
+    recent_messages.cache.update(chat_id, message_id, build_message_row({**message, "is_deleted": True}, ""))
     
-    await manager.broadcast({
+    await manager.publish({
         "type": "message_deleted",
         "message_id": message_id,
         "chat_id": chat_id
     }, chat_id)
     
-    return {"deleted": True}
+    submit_reply_preview_refresh(chat_id, message_id)
+    
+    return {"deleted": True, "id": message_id, "seq": message.get("seq")}
 
 # React to Message
 @app.post("/api/chats/{chat_id}/messages/{message_id}/react")
@@ -1064,45 +1806,88 @@ async def react_to_message(
     reaction_data: ReactToMessageRequest,
     current_user: User = Depends(get_current_user)
 ):
+    rate_limit.check(rate_limit.MODIFY, str(current_user.id))
     db = get_database()
     try:
-        message = await db.messages.find_one({"_id": ObjectId(message_id)})
+        message_oid = ObjectId(message_id)
     except:
         raise HTTPException(status_code=404, detail="Message not found")
     
-    if not message or message["chat_id"] != chat_id:
-        raise HTTPException(status_code=404, detail="Message not found")
-    
-    reactions = message.get("reactions", {})
     user_id = str(current_user.id)
     emoji = reaction_data.emoji
     
-    # Reactions structure: {emoji: [user_ids]}
-    if emoji not in reactions:
-        reactions[emoji] = []
-    
-    # Toggle reaction - if user already reacted with this emoji, remove it
-    if user_id in reactions[emoji]:
-        reactions[emoji] = [uid for uid in reactions[emoji] if uid != user_id]
-        # Remove emoji key if no users left
-        if len(reactions[emoji]) == 0:
-            del reactions[emoji]
-    else:
-        reactions[emoji].append(user_id)
-    
-    await db.messages.update_one(
-        {"_id": ObjectId(message_id)},
-        {"$set": {"reactions": reactions}}
+    # Emoji is used as a field name, so it can't contain "." or start with "$"
+    if not emoji or "." in emoji or emoji.startswith("$"):
+        raise HTTPException(status_code=400, detail="Invalid emoji")
+
+    try:
+        chat = await db.chats.find_one({"_id": ObjectId(chat_id), "participants": user_id}, {"_id": 1})
+    except:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if not chat:
+        raise HTTPException(status_code=403, detail="Not a participant")
+
+    # Reactions structure: {emoji: [user_ids]}, with counts kept in reaction_counts: {emoji: count}
+    reaction_field = f"reactions.{emoji}"
+    count_field = f"reaction_counts.{emoji}"
+    projection = {reaction_field: 1, count_field: 1, "seq": 1}
+    
+    # Toggle reaction atomically - add it if the user hasn't reacted with this emoji yet...
+    updated = await message_store.find_and_update_message(
+        db, chat_id, message_oid,
+        {"$addToSet": {reaction_field: user_id}, "$inc": {count_field: 1}},
+        condition={reaction_field: {"$ne": user_id}},
+        projection=projection
     )
+    added = updated is not None
+    
+    # ...otherwise remove it
+    if not added:
+        updated = await message_store.find_and_update_message(
+            db, chat_id, message_oid,
+            {"$pull": {reaction_field: user_id}, "$inc": {count_field: -1}},
+            condition={reaction_field: user_id},
+            projection=projection
+        )
+        if updated is None:
+            raise HTTPException(status_code=404, detail="Message not found")
+    
+    users = updated.get("reactions", {}).get(emoji, [])
+    count = updated.get("reaction_counts", {}).get(emoji, 0)
+    
+    if not users:
+        # Remove emoji key if no users left (no-op if someone reacted again meanwhile)
+        await message_store.update_message(
+            db, chat_id, message_oid,
+            {"$unset": {reaction_field: "", count_field: ""}},
+            condition={reaction_field: {"$size": 0}}
+        )
+        count = 0
+    elif count != len(users):
+        # Messages reacted to before counts were kept start out of sync
+        await message_store.update_message(
+            db, chat_id, message_oid,
+            {"$set": {count_field: len(users)}},
+            condition={reaction_field: users}
+        )
+        count = len(users)
+    
+    recent_messages.cache.react(chat_id, message_id, emoji, user_id, added)
+    reaction_delta = {
+        "emoji": emoji,
+        "user_id": user_id,
+        "added": added,
+        "count": count
+    }
     
-    await manager.broadcast({
+    await manager.publish({
         "type": "message_reaction",
         "message_id": message_id,
         "chat_id": chat_id,
-        "reactions": reactions
+        **reaction_delta
     }, chat_id)
     
-    return {"reactions": reactions}
+    return {**reaction_delta, "id": message_id, "seq": updated.get("seq")}
 
 # Forward Message
 @app.post("/api/chats/{chat_id}/messages/{message_id}/forward")
@@ -1112,9 +1897,10 @@ async def forward_message(
     forward_data: ForwardMessageRequest,
     current_user: User = Depends(get_current_user)
 ):
+    rate_limit.check(rate_limit.MESSAGE, str(current_user.id))
     db = get_database()
     try:
-        original_message = await db.messages.find_one({"_id": ObjectId(message_id)})
+        original_message = await message_store.find_message(db, chat_id, ObjectId(message_id))
     except:
         raise HTTPException(status_code=404, detail="Message not found")
     
@@ -1141,14 +1927,15 @@ async def forward_message(
                 "is_deleted": False,
                 "status": "sent",
                 "reactions": {},
+                "seq": await next_chat_seq(target_chat_id),
                 "created_at": datetime.now()
             }
             
-            result = await db.messages.insert_one(forwarded_message)
-            forwarded_message["_id"] = result.inserted_id
+            inserted_id = await message_store.insert_message(db, forwarded_message)
+            forwarded_message["_id"] = inserted_id
             
             message_response = {
-                "id": str(result.inserted_id),
+                "id": str(inserted_id),
                 "chat_id": target_chat_id,
                 "sender_id": str(current_user.id),
                 "sender_name": sender_name,
@@ -1160,10 +1947,13 @@ async def forward_message(
                 "is_deleted": False,
                 "status": "sent",
                 "reactions": {},
+                "seq": forwarded_message["seq"],
                 "created_at": forwarded_message["created_at"].isoformat()
             }
             
-            await manager.broadcast(message_response, target_chat_id)
+            recent_messages.cache.add(target_chat_id, build_message_row(forwarded_message, sender_name))
+            await memberships.touch(db, target_chat_id, forwarded_message["created_at"])
+            await manager.publish(message_response, target_chat_id)
             forwarded_messages.append(message_response)
         except:
             continue
@@ -1175,6 +1965,7 @@ async def forward_message(
 async def search_messages(
     chat_id: str,
     query: str,
+    include_archived: bool = False,  # Also scan the cold tier (slow)
     current_user: User = Depends(get_current_user)
 ):
     db = get_database()
@@ -1186,25 +1977,25 @@ async def search_messages(
     if not chat or str(current_user.id) not in chat["participants"]:
         raise HTTPException(status_code=403, detail="Not a participant")
     
-    messages = await db.messages.find({
-        "chat_id": chat_id,
-        "content": {"$regex": query, "$options": "i"},
-        "is_deleted": False
-    }).sort("created_at", -1).limit(50).to_list(length=50)
+    db = get_database(SEARCH)
+    messages = await message_store.search(db, chat_id, query, 50)
     
-    message_list = []
-    for msg in messages:
+    if include_archived and len(messages) < 50:
         try:
-            sender = await db.users.find_one({"_id": ObjectId(msg["sender_id"])})
-        except:
-            sender = None
-        sender_name = sender.get("full_name") if sender and sender.get("full_name") else (sender["username"] if sender else "Unknown")
-        
+            messages += await asyncio.to_thread(cold_storage.search, chat_id, query, 50 - len(messages))
+        except re.error:
+            raise HTTPException(status_code=400, detail="Invalid search query")
+    
+    loaders = get_loaders(db)
+    senders = await loaders.users.load_many([msg["sender_id"] for msg in messages])
+    
+    message_list = []
+    for msg, sender in zip(messages, senders):
         message_list.append({
             "id": str(msg["_id"]),
             "chat_id": msg["chat_id"],
             "sender_id": msg["sender_id"],
-            "sender_name": sender_name,
+            "sender_name": display_name(sender),
             "message_type": msg["message_type"],
             "content": msg["content"],
             "file_url": msg.get("file_url"),
@@ -1213,6 +2004,53 @@ async def search_messages(
     
     return message_list
 
+# Export endpoints - NDJSON streamed batch by batch (see app/export.py)
+def export_response(user_id: str, chat_ids: List[str], filename: str, gzip: bool) -> StreamingResponse:
+    body = export.stream(
+        get_database(HISTORY), user_id, chat_ids, build_message_row, display_name, MESSAGE_PROJECTION, compress=gzip
+    )
+    return StreamingResponse(
+        body,
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}{".gz" if gzip else ""}"',
+            "Cache-Control": "no-store"
+        }
+    )
+
+@app.get("/api/chats/export")
+async def export_all_chats(gzip: bool = False, current_user: User = Depends(get_current_user)):
+    """Every chat of the user, archived ones included, as one NDJSON file"""
+    user_id = str(current_user.id)
+    rate_limit.check(rate_limit.EXPORT, user_id)
+    # Only the ids up front; each chat is read when the stream gets to it
+    members = await get_database().chat_members.find(
+        {"user_id": user_id}, {"chat_id": 1}
+    ).sort("chat_id", 1).to_list(length=None)
+    filename = f"chats-{datetime.now():%Y%m%d}.ndjson"
+    return export_response(user_id, [member["chat_id"] for member in members], filename, gzip)
+
+@app.get("/api/chats/{chat_id}/export")
+async def export_chat(chat_id: str, gzip: bool = False, current_user: User = Depends(get_current_user)):
+    """The chat's whole history, oldest message first, as NDJSON"""
+    db = get_database()
+    try:
+        chat = await db.chats.find_one({"_id": ObjectId(chat_id)}, {"participants": 1})
+    except:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+    if str(current_user.id) not in chat["participants"]:
+        raise HTTPException(status_code=403, detail="Not a participant")
+    
+    rate_limit.check(rate_limit.EXPORT, str(current_user.id))
+    return export_response(str(current_user.id), [chat_id], f"chat-{chat_id}.ndjson", gzip)
+
+query_stats.streamed("GET", "/api/chats/export")
+query_stats.streamed("GET", "/api/chats/{chat_id}/export")
+
 # Archive/Unarchive Chat
 @app.post("/api/chats/{chat_id}/archive")
 async def archive_chat(
@@ -1229,10 +2067,8 @@ async def archive_chat(
     if not chat or str(current_user.id) not in chat["participants"]:
         raise HTTPException(status_code=403, detail="Not a participant")
     
-    await db.chats.update_one(
-        {"_id": ObjectId(chat_id)},
-        {"$set": {"is_archived": archive}}
-    )
+    # Archived for this user only
+    await memberships.set_archived(db, chat_id, str(current_user.id), archive)
     
     return {"archived": archive}
 
@@ -1241,14 +2077,9 @@ async def archive_chat(
 async def unarchive_all_chats(current_user: User = Depends(get_current_user)):
     """Unarchive all chats for the current user"""
     db = get_database()
-    result = await db.chats.update_many(
-        {
-            "participants": str(current_user.id),
-            "is_archived": True
-        },
-        {
-            "$set": {"is_archived": False}
-        }
+    result = await db.chat_members.update_many(
+        {"user_id": str(current_user.id), "archived": True},
+        {"$set": {"archived": False}}
     )
     return {
         "message": f"Unarchived {result.modified_count} chats",
@@ -1260,9 +2091,9 @@ async def unarchive_all_chats(current_user: User = Depends(get_current_user)):
 async def unarchive_all_chats_admin():
     """Unarchive ALL chats in the database (temporary admin endpoint)"""
     db = get_database()
-    result = await db.chats.update_many(
-        {"is_archived": True},
-        {"$set": {"is_archived": False}}
+    result = await db.chat_members.update_many(
+        {"archived": True},
+        {"$set": {"archived": False}}
     )
     return {
         "message": f"Unarchived {result.modified_count} chats",
@@ -1358,13 +2189,18 @@ async def remove_participant(
         {"_id": ObjectId(chat_id)},
         {"$pull": {"participants": user_id, "admins": user_id}}
     )
+    await memberships.remove_member(db, chat_id, user_id)
+    recent_messages.cache.invalidate(chat_id)
     
-    await manager.broadcast({
+    await manager.publish({
         "type": "participant_removed",
         "chat_id": chat_id,
         "user_id": user_id
     }, chat_id)
-    
+    # After the event, so the removed user's devices still hear about it, then nothing more
+    for device in list(manager.device_connections.get(user_id, ())):
+        manager.unsubscribe(device, chat_id, user_id)
+
     return {"removed": True}
 
 # Add Admin to Group
@@ -1396,6 +2232,7 @@ async def add_admin(
             {"_id": ObjectId(chat_id)},
             {"$addToSet": {"admins": user_id}}
         )
+        await memberships.set_role(db, chat_id, user_id, memberships.ADMIN)
     
     return {"added": True}
 
@@ -1425,7 +2262,7 @@ async def get_user_status(
 # Update Last Seen
 @app.post("/api/users/me/last-seen")
 async def update_last_seen(current_user: User = Depends(get_current_user)):
-    db = get_database()
+    db = get_database(PRESENCE)
     await db.users.update_one(
         {"_id": ObjectId(str(current_user.id))},
         {"$set": {"last_seen": datetime.now()}}
@@ -1434,24 +2271,25 @@ async def update_last_seen(current_user: User = Depends(get_current_user)):
 
 # Get Archived Chats
 @app.get("/api/chats/archived")
-async def get_archived_chats(current_user: User = Depends(get_current_user)):
-    db = get_database()
+async def get_archived_chats(
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    db = get_database(CHAT_LIST)
     user_id = str(current_user.id)
     
-    chats = await db.chats.find({
-        "participants": user_id,
-        "is_archived": True
-    }).to_list(length=100)
+    _, chats, next_cursor = await chat_list_page(db, user_id, True, limit, cursor)
+    
+    loaders = Loaders(db, user_projection=USER_PROJECTION)
+    await loaders.users.load_many([pid for chat in chats for pid in chat["participants"] if pid != user_id])
     
     chat_list = []
     for chat in chats:
         participants_info = []
         for pid in chat["participants"]:
             if pid != user_id:
-                try:
-                    user = await db.users.find_one({"_id": ObjectId(pid)})
-                except:
-                    user = None
+                user = await loaders.users.load(pid)
                 if user:
                     participants_info.append({
                         "id": pid,
@@ -1470,7 +2308,7 @@ async def get_archived_chats(current_user: User = Depends(get_current_user)):
             "created_at": chat["created_at"]
         })
     
-    return chat_list
+    return FastJSONResponse(chat_list, headers={"X-Next-Cursor": next_cursor} if next_cursor else None)
 
 # Serve uploaded files
 from fastapi.staticfiles import StaticFiles
@@ -0,0 +1,106 @@
+"""
+Per-user chat state in `chat_members`, one document per (user_id, chat_id).
+
+The chat document's `participants` and `admins` stay the source of truth
+for who may do what; `chat_members` mirrors them with the state that
+belongs to one member: whether they archived the chat, their role, when
+the chat last had activity and the last seq they read. The chat list is
+read from here, newest activity first, with a cursor.
+
+Existing databases are filled by backfill_chat_members.py.
+"""
+
+import base64
+import os
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+import orjson
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+load_dotenv()
+
+MEMBER = "member"
+ADMIN = "admin"
+
+# last_activity is rewritten at most this often per chat, so a busy chat
+# doesn't rewrite every member's document for every message
+ACTIVITY_RESOLUTION = timedelta(milliseconds=int(os.getenv("CHAT_ACTIVITY_RESOLUTION_MS", "1000")))
+
+async def ensure_indexes(db):
+    await db.chat_members.create_index([("user_id", 1), ("chat_id", 1)], unique=True)
+    # The chat list: a user's (un)archived chats, most recent activity first
+    await db.chat_members.create_index([("user_id", 1), ("archived", 1), ("last_activity", -1), ("chat_id", -1)])
+    # Every member of one chat; last_activity keeps touch() from scanning members it won't change
+    await db.chat_members.create_index([("chat_id", 1), ("last_activity", 1)])
+
+async def add_members(db, chat_id: str, user_ids: Iterable[str], admins: Iterable[str] = (), last_activity: datetime = None):
+    """Create the member documents of new members (existing ones are left alone)"""
+    admins = set(admins)
+    last_activity = last_activity or datetime.now()
+    operations = [
+        UpdateOne(
+            {"user_id": user_id, "chat_id": chat_id},
+            {"$setOnInsert": {
+                "role": ADMIN if user_id in admins else MEMBER,
+                "archived": False,
+                "last_activity": last_activity,
+                "last_read_seq": 0,
+                "joined_at": datetime.now()
+            }},
+            upsert=True
+        )
+        for user_id in user_ids
+    ]
+    if operations:
+        await db.chat_members.bulk_write(operations, ordered=False)
+
+async def remove_member(db, chat_id: str, user_id: str):
+    await db.chat_members.delete_one({"user_id": user_id, "chat_id": chat_id})
+
+async def set_role(db, chat_id: str, user_id: str, role: str):
+    await db.chat_members.update_one({"user_id": user_id, "chat_id": chat_id}, {"$set": {"role": role}})
+
+async def set_archived(db, chat_id: str, user_id: str, archived: bool):
+    await db.chat_members.update_one({"user_id": user_id, "chat_id": chat_id}, {"$set": {"archived": archived}})
+
+async def touch(db, chat_id: str, when: datetime):
+    """Move the chat up in every member's list after a new message"""
+    await db.chat_members.update_many(
+        {"chat_id": chat_id, "last_activity": {"$lt": when - ACTIVITY_RESOLUTION}},
+        {"$set": {"last_activity": when}}
+    )
+
+async def mark_read(db, chat_id: str, user_id: str, seq: int):
+    await db.chat_members.update_one(
+        {"user_id": user_id, "chat_id": chat_id},
+        {"$max": {"last_read_seq": seq}}
+    )
+
+def encode_cursor(member: dict) -> str:
+    raw = orjson.dumps([member["last_activity"].isoformat(), member["chat_id"]])
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Raises ValueError for anything that isn't a cursor from encode_cursor"""
+    try:
+        last_activity, chat_id = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(last_activity), str(chat_id)
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+async def list_page(db, user_id: str, archived: bool, limit: int, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """One page of a user's member documents, most recent activity first, and the cursor of the next page"""
+    query = {"user_id": user_id, "archived": archived}
+    if cursor:
+        last_activity, chat_id = decode_cursor(cursor)
+        query["$or"] = [
+            {"last_activity": {"$lt": last_activity}},
+            {"last_activity": last_activity, "chat_id": {"$lt": chat_id}}
+        ]
+    members = await db.chat_members.find(
+        query, {"chat_id": 1, "role": 1, "last_activity": 1, "last_read_seq": 1}
+    ).sort([("last_activity", -1), ("chat_id", -1)]).limit(limit + 1).to_list(length=limit + 1)
+    next_cursor = encode_cursor(members[limit - 1]) if len(members) > limit else None
+    return members[:limit], next_cursor
@@ -0,0 +1,374 @@
+"""
+Storage layout of chat messages.
+
+"documents" (default) keeps one document per message in `messages`.
+"buckets" packs consecutive messages of a chat into `message_buckets`
+documents of up to MESSAGE_BUCKET_SIZE messages, keyed by
+(chat_id, bucket_start) where bucket_start is derived from the message's
+per-chat seq. Every read and write of messages goes through this module,
+so handlers work the same in both modes. Per-message operations find the
+message by (chat_id, messages._id) and update it in place with the
+positional operator.
+
+Read receipts only move the reader's last_read_seq in `chat_members` in
+the bucket mode; the per-message read_by list is kept in documents mode
+only.
+"""
+
+import os
+from typing import AsyncIterator, Dict, List, Optional
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app import write_pipeline
+
+load_dotenv()
+
+DOCUMENTS = "documents"
+BUCKETS = "buckets"
+
+MESSAGE_STORAGE_MODE = os.getenv("MESSAGE_STORAGE_MODE", DOCUMENTS)
+MESSAGE_BUCKET_SIZE = int(os.getenv("MESSAGE_BUCKET_SIZE", "100"))
+
+def bucket_start(seq: int) -> int:
+    """First seq of the bucket holding seq (seq 1-100 -> 1, 101-200 -> 101, 0 to -99 -> -99)"""
+    return ((seq - 1) // MESSAGE_BUCKET_SIZE) * MESSAGE_BUCKET_SIZE + 1
+
+def _bucket_projection(projection: Optional[dict]):
+    if projection is None:
+        return {"messages": 1}
+    return {"messages._id": 1, **{f"messages.{field}": value for field, value in projection.items()}}
+
+def _in_bucket(update: dict, element: str = "$") -> dict:
+    """An update of one message, rewritten for the element of its bucket's messages array"""
+    return {
+        operator: {f"messages.{element}.{field}": value for field, value in fields.items()}
+        for operator, fields in update.items()
+    }
+
+async def insert_message(db, message_dict: dict, mode: str = None):
+    """Store a new message and return its id.
+
+    Raises DuplicateKeyError if the sender already sent a message with the same client_msg_id.
+    """
+    mode = mode or MESSAGE_STORAGE_MODE
+    if mode != BUCKETS:
+        if write_pipeline.WRITE_PIPELINE_ENABLED:
+            return await write_pipeline.insert(db.messages, message_dict)
+        result = await db.messages.insert_one(message_dict)
+        return result.inserted_id
+
+    message_dict.setdefault("_id", ObjectId())
+    claim_id = None
+    if message_dict.get("client_msg_id"):
+        # Buckets have no per-message unique index, so claim the key separately
+        claim_id = f"send:{message_dict['chat_id']}:{message_dict['sender_id']}:{message_dict['client_msg_id']}"
+        await db.idempotency_keys.insert_one({
+            "_id": claim_id,
+            "op": "send",
+            "result": {"id": str(message_dict["_id"])},
+            "created_at": message_dict["created_at"]
+        })
+
+    update = {
+        "$push": {"messages": {"$each": [message_dict], "$sort": {"seq": 1}}},
+        "$inc": {"count": 1}
+    }
+    bucket_filter = {"chat_id": message_dict["chat_id"], "bucket_start": bucket_start(message_dict["seq"])}
+    try:
+        try:
+            await db.message_buckets.update_one(bucket_filter, update, upsert=True)
+        except DuplicateKeyError:
+            # Another insert created the bucket at the same moment - it exists now
+            await db.message_buckets.update_one(bucket_filter, update)
+    except:
+        if claim_id:
+            await db.idempotency_keys.delete_one({"_id": claim_id})
+        raise
+    return message_dict["_id"]
+
+async def find_by_client_msg_id(db, chat_id: str, sender_id: str, client_msg_id: str, mode: str = None):
+    mode = mode or MESSAGE_STORAGE_MODE
+    if mode != BUCKETS:
+        return await db.messages.find_one({
+            "chat_id": chat_id,
+            "sender_id": sender_id,
+            "client_msg_id": client_msg_id
+        })
+
+    claim = await db.idempotency_keys.find_one({"_id": f"send:{chat_id}:{sender_id}:{client_msg_id}"})
+    if not claim or not claim.get("result"):
+        return None
+    return await find_message(db, chat_id, ObjectId(claim["result"]["id"]), mode=mode)
+
+async def find_message(db, chat_id: str, message_id: ObjectId, projection: Optional[dict] = None, mode: str = None):
+    mode = mode or MESSAGE_STORAGE_MODE
+    if mode != BUCKETS:
+        return await db.messages.find_one({"_id": message_id, "chat_id": chat_id}, projection)
+
+    bucket = await db.message_buckets.find_one(
+        {"chat_id": chat_id, "messages._id": message_id},
+        {"messages": {"$elemMatch": {"_id": message_id}}}
+    )
+    return bucket["messages"][0] if bucket and bucket.get("messages") else None
+
+async def update_message(db, chat_id: str, message_id: ObjectId, update: dict, condition: Optional[dict] = None,
+                         mode: str = None) -> bool:
+    """Apply an update (field paths relative to the message) to one message of the chat.
+
+    condition adds filters on the message's own fields. True if the message matched.
+    """
+    mode = mode or MESSAGE_STORAGE_MODE
+    if mode != BUCKETS:
+        result = await db.messages.update_one({"_id": message_id, "chat_id": chat_id, **(condition or {})}, update)
+    else:
+        result = await db.message_buckets.update_one(
+            {"chat_id": chat_id, "messages": {"$elemMatch": {"_id": message_id, **(condition or {})}}},
+            _in_bucket(update)
+        )
+    return result.matched_count > 0
+
+async def find_and_update_message(db, chat_id: str, message_id: ObjectId, update: dict, condition: Optional[dict] = None,
+                                  projection: Optional[dict] = None, mode: str = None) -> Optional[dict]:
+    """update_message returning the message as it is afterwards, or None if it didn't match"""
+    mode = mode or MESSAGE_STORAGE_MODE
+    if mode != BUCKETS:
+        return await db.messages.find_one_and_update(
+            {"_id": message_id, "chat_id": chat_id, **(condition or {})}, update,
+            projection=projection, return_document=ReturnDocument.AFTER
+        )
+    bucket = await db.message_buckets.find_one_and_update(
+        {"chat_id": chat_id, "messages": {"$elemMatch": {"_id": message_id, **(condition or {})}}},
+        _in_bucket(update),
+        projection={"messages": {"$elemMatch": {"_id": message_id}}},
+        return_document=ReturnDocument.AFTER
+    )
+    return bucket["messages"][0] if bucket and bucket.get("messages") else None
+
+async def mark_read(db, chat_id: str, message_id: ObjectId, user_id: str, mode: str = None):
+    """Record a read receipt on the message itself (documents mode only, see the module docstring)"""
+    mode = mode or MESSAGE_STORAGE_MODE
+    if mode != BUCKETS:
+        await db.messages.update_one({"_id": message_id, "chat_id": chat_id}, {"$addToSet": {"read_by": user_id}})
+
+async def mark_all_read(db, chat_id: str, user_id: str, mode: str = None) -> int:
+    """Mark every message from others as read by the user; returns how many were unread"""
+    mode = mode or MESSAGE_STORAGE_MODE
+    if mode != BUCKETS:
+        result = await db.messages.update_many(
+            {
+                "chat_id": chat_id,
+                "sender_id": {"$ne": user_id},
+                "$or": [
+                    {"read_by": {"$exists": False}},
+                    {"read_by": {"$nin": [user_id]}}
+                ]
+            },
+            {"$addToSet": {"read_by": user_id}}
+        )
+        return result.modified_count
+
+    # Nothing to write per message; the caller moves last_read_seq
+    member = await db.chat_members.find_one({"user_id": user_id, "chat_id": chat_id}, {"last_read_seq": 1})
+    unread = await count_unread(db, {chat_id: (member or {}).get("last_read_seq", 0)}, user_id, mode=mode)
+    return unread.get(chat_id, 0)
+
+async def refresh_reply_previews(db, chat_id: str, message_id: str, content: str, mode: str = None) -> int:
+    """Copy a message's content into the stored previews of the replies to it; returns how many changed"""
+    mode = mode or MESSAGE_STORAGE_MODE
+    if mode != BUCKETS:
+        result = await db.messages.update_many(
+            {"reply_to": message_id, "reply_to_message": {"$ne": None}},
+            {"$set": {"reply_to_message.content": content}}
+        )
+    else:
+        result = await db.message_buckets.update_many(
+            {"chat_id": chat_id, "messages.reply_to": message_id},
+            _in_bucket({"$set": {"reply_to_message.content": content}}, "$[reply]"),
+            array_filters=[{"reply.reply_to": message_id, "reply.reply_to_message": {"$ne": None}}]
+        )
+    return result.modified_count
+
+async def search(db, chat_id: str, query: str, limit: int, mode: str = None) -> List[dict]:
+    """Live messages whose content matches the regex query, newest first"""
+    mode = mode or MESSAGE_STORAGE_MODE
+    condition = {"$regex": query, "$options": "i"}
+    if mode != BUCKETS:
+        return await db.messages.find({
+            "chat_id": chat_id,
+            "content": condition,
+            "is_deleted": False
+        }).sort("created_at", -1).limit(limit).to_list(length=limit)
+
+    rows = await db.message_buckets.aggregate([
+        {"$match": {"chat_id": chat_id, "messages.content": condition}},
+        {"$unwind": "$messages"},
+        {"$match": {"messages.content": condition, "messages.is_deleted": False}},
+        {"$sort": {"messages.seq": -1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "messages": 1}}
+    ]).to_list(length=limit)
+    return [row["messages"] for row in rows]
+
+async def count_messages(db, chat_id: str, mode: str = None) -> int:
+    mode = mode or MESSAGE_STORAGE_MODE
+    if mode != BUCKETS:
+        return await db.messages.count_documents({"chat_id": chat_id})
+
+    # Summed by the server from the (chat_id, bucket_start, count) index
+    rows = await db.message_buckets.aggregate([
+        {"$match": {"chat_id": chat_id}},
+        {"$group": {"_id": None, "count": {"$sum": "$count"}}}
+    ]).to_list(length=1)
+    return rows[0]["count"] if rows else 0
+
+async def count_unread(db, last_read: Dict[str, int], user_id: str, mode: str = None) -> Dict[str, int]:
+    """Messages from others after the reader's last read seq, for many chats in one query.
+
+    last_read maps chat ids to the reader's last_read_seq; chats without unread messages are left out.
+    """
+    mode = mode or MESSAGE_STORAGE_MODE
+    if not last_read:
+        return {}
+    if mode != BUCKETS:
+        rows = await db.messages.aggregate([
+            {"$match": {
+                "$or": [{"chat_id": chat_id, "seq": {"$gt": seq}} for chat_id, seq in last_read.items()],
+                "sender_id": {"$ne": user_id}
+            }},
+            {"$group": {"_id": "$chat_id", "count": {"$sum": 1}}}
+        ]).to_list(length=None)
+        return {row["_id"]: row["count"] for row in rows}
+
+    # Only the buckets that can hold a seq past the last read one
+    rows = await db.message_buckets.aggregate([
+        {"$match": {"$or": [
+            {"chat_id": chat_id, "bucket_start": {"$gt": seq - MESSAGE_BUCKET_SIZE + 1}}
+            for chat_id, seq in last_read.items()
+        ]}},
+        {"$project": {"chat_id": 1, "messages.seq": 1, "messages.sender_id": 1}},
+        {"$unwind": "$messages"},
+        {"$match": {
+            "$or": [{"chat_id": chat_id, "messages.seq": {"$gt": seq}} for chat_id, seq in last_read.items()],
+            "messages.sender_id": {"$ne": user_id}
+        }},
+        {"$group": {"_id": "$chat_id", "count": {"$sum": 1}}}
+    ]).to_list(length=None)
+    return {row["_id"]: row["count"] for row in rows}
+
+async def fetch_page(db, chat_id: str, skip: int, limit: int, projection: Optional[dict] = None, mode: str = None) -> List[dict]:
+    """Messages of a chat, newest first"""
+    mode = mode or MESSAGE_STORAGE_MODE
+    if limit <= 0:
+        return []
+    if mode != BUCKETS:
+        return await db.messages.find(
+            {"chat_id": chat_id}, projection
+        ).sort("created_at", -1).skip(skip).limit(limit).to_list(length=limit)
+
+    # Work out which buckets hold the page from their counts, reading headers
+    # newest first only as far back as the page reaches...
+    needed = []
+    first_skip = skip  # Messages to skip in the newest needed bucket
+    collected = 0
+    before = None
+    done = False
+    while not done:
+        batch = (first_skip + limit - collected) // MESSAGE_BUCKET_SIZE + 2
+        query = {"chat_id": chat_id}
+        if before is not None:
+            query["bucket_start"] = {"$lt": before}
+        headers = await db.message_buckets.find(
+            query, {"_id": 0, "bucket_start": 1, "count": 1}
+        ).sort("bucket_start", -1).limit(batch).to_list(length=batch)
+        for bucket in headers:
+            count = bucket.get("count", 0)
+            if not needed and first_skip >= count:
+                first_skip -= count
+                continue
+            needed.append(bucket["bucket_start"])
+            collected += count
+            if collected - first_skip >= limit:
+                done = True
+                break
+        if len(headers) < batch:
+            break
+        before = headers[-1]["bucket_start"]
+    if not needed:
+        return []
+
+    # ...then fetch only those
+    full_buckets = await db.message_buckets.find(
+        {"chat_id": chat_id, "bucket_start": {"$in": needed}},
+        _bucket_projection(projection)
+    ).sort("bucket_start", -1).to_list(length=len(needed))
+
+    messages = []
+    for bucket in full_buckets:
+        messages.extend(reversed(bucket.get("messages", [])))
+    return messages[first_skip:first_skip + limit]
+
+async def iter_messages(db, chat_id: str, projection: Optional[dict] = None, batch_size: int = 1000,
+                        mode: str = None) -> AsyncIterator[List[dict]]:
+    """Every message of a chat, oldest first, in lists of about batch_size read from one cursor"""
+    mode = mode or MESSAGE_STORAGE_MODE
+    if mode != BUCKETS:
+        cursor = db.messages.find({"chat_id": chat_id}, projection).sort("created_at", 1).batch_size(batch_size)
+    else:
+        cursor = db.message_buckets.find(
+            {"chat_id": chat_id}, _bucket_projection(projection)
+        ).sort("bucket_start", 1).batch_size(max(1, batch_size // MESSAGE_BUCKET_SIZE))
+
+    batch = []
+    async for doc in cursor:
+        if mode != BUCKETS:
+            batch.append(doc)
+        else:
+            batch.extend(doc.get("messages", []))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def find_last_messages(db, chat_ids: List[str], projection: dict, mode: str = None) -> Dict[str, dict]:
+    """The newest message of each chat (with _id and the projected fields), in one or two queries"""
+    mode = mode or MESSAGE_STORAGE_MODE
+    if not chat_ids:
+        return {}
+    if mode != BUCKETS:
+        # Walks the (chat_id, created_at) index, one entry per chat
+        rows = await db.messages.aggregate([
+            {"$match": {"chat_id": {"$in": chat_ids}}},
+            {"$sort": {"chat_id": 1, "created_at": -1}},
+            {"$group": {
+                "_id": "$chat_id",
+                "message_id": {"$first": "$_id"},
+                **{field: {"$first": f"${field}"} for field in projection if field != "_id"}
+            }}
+        ]).to_list(length=None)
+        return {
+            row["_id"]: {
+                "_id": row["message_id"], "chat_id": row["_id"],
+                **{field: row[field] for field in projection if field not in ("_id", "chat_id") and row.get(field) is not None}
+            }
+            for row in rows
+        }
+
+    # The newest bucket of each chat, then the last message of those
+    newest = await db.message_buckets.aggregate([
+        {"$match": {"chat_id": {"$in": chat_ids}}},
+        {"$sort": {"chat_id": 1, "bucket_start": -1}},
+        {"$group": {"_id": "$chat_id", "bucket_start": {"$first": "$bucket_start"}}}
+    ]).to_list(length=None)
+    if not newest:
+        return {}
+    buckets = await db.message_buckets.find(
+        {"$or": [{"chat_id": row["_id"], "bucket_start": row["bucket_start"]} for row in newest]},
+        {"chat_id": 1, "messages": {"$slice": -1}}
+    ).to_list(length=len(newest))
+    return {bucket["chat_id"]: bucket["messages"][-1] for bucket in buckets if bucket.get("messages")}
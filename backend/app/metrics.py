@@ -0,0 +1,237 @@
+"""
+Prometheus metrics, rendered in the text exposition format on /metrics.
+
+A deliberately small registry instead of a client library: histograms
+only increment one bucket per observation and gauges are callbacks
+evaluated at scrape time, so collection can stay on in production.
+Mongo command latency comes from a pymongo CommandListener passed to
+the client, route latency from an ASGI middleware.
+"""
+
+import asyncio
+import os
+import resource
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+from dotenv import load_dotenv
+from pymongo import monitoring
+
+load_dotenv()
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# How often the event loop lag probe wakes up
+LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FANOUT_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_registry = []
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._series: Dict[Tuple, list] = {}
+        # Observed from pymongo's threads as well as the event loop
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(s[0]), s[1], s[2]) for labels, s in self._series.items()]
+        for labels, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = list(self._values.items())
+        for labels, value in snapshot:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+class Gauge:
+    """Either set() directly or computed by a callback when scraped"""
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float] = None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.value = 0
+        _registry.append(self)
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self) -> List[str]:
+        value = self.value
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception:
+                return []
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {_format_value(value)}"
+        ]
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# HTTP
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status")
+)
+
+# MongoDB
+mongo_command_duration = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency", ("command", "collection")
+)
+mongo_command_failures = Counter(
+    "mongo_command_failures_total", "MongoDB commands that failed", ("command", "collection")
+)
+
+# WebSocket fan-out
+fanout_recipients = Histogram(
+    "websocket_fanout_recipients", "Sockets one broadcast was sent to", buckets=FANOUT_SIZE_BUCKETS
+)
+fanout_duration = Histogram("websocket_fanout_duration_seconds", "Time to send one broadcast to every recipient")
+
+# Event loop
+event_loop_lag = Histogram("event_loop_lag_seconds", "How late the event loop ran a timer")
+event_loop_lag_last = Gauge("event_loop_lag_last_seconds", "Lag of the most recent event loop probe")
+
+def _resident_memory_bytes() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak instead of current where /proc is missing (ru_maxrss is KB on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+Gauge("process_resident_memory_bytes", "Resident memory of this worker", _resident_memory_bytes)
+
+def register_connection_gauges(manager):
+    """Socket gauges read straight from the ConnectionManager when scraped"""
+    Gauge("websocket_chat_sockets", "Open /ws/{chat_id} sockets",
+          lambda: sum(len(sockets) for sockets in manager.active_connections.values()))
+    Gauge("websocket_chats", "Chats with at least one open or subscribed socket",
+          lambda: len({c for c, s in manager.active_connections.items() if s} | set(manager.chat_subscribers)))
+    Gauge("websocket_global_sockets", "Open /ws/global sockets", lambda: len(manager.global_connections))
+    Gauge("websocket_device_sockets", "Open multiplexed /ws sockets",
+          lambda: sum(len(sockets) for sockets in manager.device_connections.values()))
+    Gauge("websocket_online_users", "Users marked online", lambda: len(manager.online_users))
+    Gauge("websocket_broadcasts_in_flight", "Broadcasts currently being sent", lambda: manager.in_flight)
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every command by name and collection. Pass it to the client's event_listeners."""
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        value = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            value = event.command.get("collection")
+        self._collections[(event.connection_id, event.request_id)] = value if isinstance(value, str) else ""
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        mongo_command_duration.observe(event.duration_micros / 1e6, event.command_name, collection)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        mongo_command_duration.observe(event.duration_micros / 1e6, event.command_name, collection)
+        mongo_command_failures.inc(event.command_name, collection)
+
+class MetricsMiddleware:
+    """Times HTTP requests by route template (not raw path, to keep label cardinality bounded)"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            http_request_duration.observe(
+                time.perf_counter() - start,
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                status[0]
+            )
+
+async def monitor_event_loop_lag():
+    """Run for the app's lifetime: a timer that fires late means the loop was blocked"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL_SECONDS
+        await asyncio.sleep(LOOP_LAG_INTERVAL_SECONDS)
+        lag = max(0.0, loop.time() - expected)
+        event_loop_lag.observe(lag)
+        event_loop_lag_last.set(lag)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr, ConfigDict
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 from bson import ObjectId
 
@@ -59,10 +59,14 @@ class Message(BaseModel):
     content: str
     file_url: Optional[str] = None
     reply_to: Optional[str] = None  # Message ID that this message replies to
+    reply_to_message: Optional[dict] = None  # Preview of the replied-to message, kept in sync on edit/delete
     edited_at: Optional[datetime] = None
     is_deleted: bool = False
     status: str = "sent"  # "sent", "delivered", "read"
-    reactions: dict = {}  # {user_id: emoji}
+    reactions: dict = {}  # {emoji: [user_ids]}
+    reaction_counts: dict = {}  # {emoji: count}
+    seq: Optional[int] = None  # Per-chat sequence number
+    client_msg_id: Optional[str] = None  # Client-generated idempotency key
     created_at: datetime = datetime.now()
 
 class MessageResponse(BaseModel):
@@ -79,6 +83,7 @@ class MessageResponse(BaseModel):
     is_deleted: bool = False
     status: str = "sent"
     reactions: dict = {}
+    seq: Optional[int] = None  # Per-chat sequence number
     created_at: datetime
 
 class CreateGroupRequest(BaseModel):
@@ -118,3 +123,5 @@ class ForwardMessageRequest(BaseModel):
 class TypingIndicatorRequest(BaseModel):
     is_typing: bool
 
+class SyncRequest(BaseModel):
+    chats: Dict[str, int]  # chat_id -> last event_seq the client has seen
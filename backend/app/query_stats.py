@@ -0,0 +1,211 @@
+"""
+Per-request MongoDB accounting: round trips, time spent in Mongo and
+repeated query shapes (the usual sign of an N+1 loop).
+
+The middleware puts a RequestQueries in a context variable; Motor copies
+the context into the thread that runs each command, so the command
+listener can attribute it to the request that issued it. Commands with
+no request in context (warm-up, background tasks started elsewhere,
+server monitoring) are not counted.
+"""
+
+import os
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional
+
+import orjson
+from dotenv import load_dotenv
+from pymongo import monitoring
+
+load_dotenv()
+
+QUERY_STATS_ENABLED = os.getenv("QUERY_STATS_ENABLED", "true").lower() == "true"
+# Adds X-DB-Queries, X-DB-Time-Ms and X-DB-Repeated to every response (development only)
+QUERY_DEBUG_HEADERS = os.getenv("QUERY_DEBUG_HEADERS", "false").lower() == "true"
+# Requests slower than this are logged with their query breakdown
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "500"))
+# Round trips one request may make before it is logged as over budget (0 = no budget)
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", "25"))
+# Per-endpoint allowances, e.g. "GET /api/chats=120;POST /api/chats/{chat_id}/messages=10"
+QUERY_BUDGET_OVERRIDES = {
+    route.strip(): int(budget)
+    for route, budget in (
+        item.rsplit("=", 1) for item in os.getenv("QUERY_BUDGET_OVERRIDES", "").split(";") if "=" in item
+    )
+}
+# Answer 500 instead of just logging when a request goes over budget (for tests and CI)
+QUERY_BUDGET_STRICT = os.getenv("QUERY_BUDGET_STRICT", "false").lower() == "true"
+
+# Where the query of each command lives
+_FILTER_FIELDS = {
+    "find": "filter",
+    "findAndModify": "query",
+    "count": "query",
+    "distinct": "query",
+    "aggregate": "pipeline",
+}
+
+class RequestQueries:
+    def __init__(self):
+        self.count = 0
+        self.duration_micros = 0
+        self.shapes = Counter()
+        # Commands of one request can run on several executor threads at once (asyncio.gather)
+        self._lock = threading.Lock()
+
+    def record(self, shape: str):
+        with self._lock:
+            self.count += 1
+            self.shapes[shape] += 1
+
+    def add_duration(self, micros: int):
+        with self._lock:
+            self.duration_micros += micros
+
+    @property
+    def mongo_ms(self) -> float:
+        return self.duration_micros / 1000
+
+    def repeated(self, limit: int = 3) -> list:
+        """Query shapes issued more than once, most repeated first"""
+        return [
+            {"shape": shape, "count": count}
+            for shape, count in self.shapes.most_common(limit) if count > 1
+        ]
+
+current_queries: ContextVar[Optional[RequestQueries]] = ContextVar("current_queries", default=None)
+
+def _normalize(value):
+    """Keep field names and operators, drop the values"""
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        if value and all(isinstance(item, dict) for item in value):
+            return [_normalize(item) for item in value]
+        return ["?"]
+    return "?"
+
+def query_shape(command_name: str, command) -> str:
+    collection = command.get(command_name)
+    if command_name == "getMore":
+        collection = command.get("collection")
+    if command_name in ("update", "delete"):
+        statements = command.get("updates" if command_name == "update" else "deletes") or [{}]
+        query = statements[0].get("q", {})
+    else:
+        query = command.get(_FILTER_FIELDS.get(command_name, ""), {})
+    shape = orjson.dumps(_normalize(query), option=orjson.OPT_SORT_KEYS).decode() if query else ""
+    return f"{command_name} {collection if isinstance(collection, str) else ''} {shape}".strip()
+
+class QueryListener(monitoring.CommandListener):
+    """Counts commands against the request in context. Pass it to the client's event_listeners."""
+    def started(self, event):
+        queries = current_queries.get()
+        if queries is not None:
+            queries.record(query_shape(event.command_name, event.command))
+
+    def succeeded(self, event):
+        queries = current_queries.get()
+        if queries is not None:
+            queries.add_duration(event.duration_micros)
+
+    def failed(self, event):
+        queries = current_queries.get()
+        if queries is not None:
+            queries.add_duration(event.duration_micros)
+
+# Endpoints streaming an unbounded body (exports): no budget, not held back, never "slow"
+_streamed_routes = set()
+
+def streamed(method: str, route: str):
+    _streamed_routes.add(f"{method} {route}")
+
+def _route_of(scope) -> str:
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+def budget_for(method: str, route: str) -> int:
+    return QUERY_BUDGET_OVERRIDES.get(f"{method} {route}", QUERY_BUDGET)
+
+class QueryStatsMiddleware:
+    """Tracks the queries of each HTTP request; headers in debug mode, a log line when slow or over budget"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not QUERY_STATS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        queries = RequestQueries()
+        token = current_queries.set(queries)
+        start = time.perf_counter()
+        status = [500]
+        # Strict mode holds the response back until the budget can be checked
+        held = [] if QUERY_BUDGET_STRICT else None
+        streaming = [False]
+
+        async def send_wrapper(message):
+            nonlocal held
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                # The router has matched by now
+                streaming[0] = f"{scope['method']} {_route_of(scope)}" in _streamed_routes
+                if streaming[0]:
+                    held = None
+                if QUERY_DEBUG_HEADERS:
+                    repeated = queries.repeated(1)
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-db-queries", str(queries.count).encode()),
+                        (b"x-db-time-ms", f"{queries.mongo_ms:.1f}".encode()),
+                        (b"x-db-repeated", str(repeated[0]["count"] if repeated else 0).encode()),
+                    ]
+            if held is not None:
+                held.append(message)
+            else:
+                await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_queries.reset(token)
+
+        if streaming[0]:
+            return
+        route = _route_of(scope)
+        budget = budget_for(scope["method"], route)
+        over_budget = bool(budget) and queries.count > budget
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        if over_budget or duration_ms >= SLOW_REQUEST_MS:
+            print(orjson.dumps({
+                "event": "over_query_budget" if over_budget else "slow_request",
+                "method": scope["method"],
+                "route": route,
+                "path": scope["path"],
+                "status": status[0],
+                "duration_ms": round(duration_ms, 1),
+                "db_queries": queries.count,
+                "db_time_ms": round(queries.mongo_ms, 1),
+                "query_budget": budget,
+                "repeated": queries.repeated(),
+            }).decode(), flush=True)
+
+        if held is None:
+            return
+        if over_budget:
+            body = orjson.dumps({
+                "detail": f"Query budget exceeded: {queries.count} queries on {scope['method']} {route} (budget {budget})"
+            })
+            await send({
+                "type": "http.response.start",
+                "status": 500,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+        for message in held:
+            await send(message)
@@ -0,0 +1,114 @@
+"""
+In-memory token buckets for flood control, per user and per chat.
+
+Each operation class has a per-user limit and optionally a per-chat one
+(the total across all members, which is what bounds fan-out). A limit is
+"rate,burst": tokens refilled per second and bucket capacity. Checks are
+O(1); buckets that have refilled completely are equivalent to new ones,
+so they are swept once the table grows past RATE_LIMIT_MAX_BUCKETS.
+
+Limits are per worker process.
+"""
+
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+load_dotenv()
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+
+# Operation classes
+MESSAGE = "message"    # send and forward
+FILE = "file"          # file uploads
+MODIFY = "modify"      # edit, delete, react
+TYPING = "typing"      # typing indicators
+FRAME = "frame"        # any frame received on a WebSocket
+EXPORT = "export"      # chat history exports
+VIOLATION = "violation"  # rate-limited WebSocket frames; the socket is closed when these run out
+
+def _limit(name: str, default: str) -> Optional[Tuple[float, float]]:
+    """"rate,burst" from the environment; empty or "off" disables the limit"""
+    value = os.getenv(name, default).strip()
+    if not value or value == "off":
+        return None
+    rate, burst = value.split(",")
+    return float(rate), float(burst)
+
+# class -> (per-user limit, per-chat limit)
+LIMITS = {
+    MESSAGE: (_limit("RATE_LIMIT_MESSAGE", "2,20"), _limit("RATE_LIMIT_MESSAGE_PER_CHAT", "20,100")),
+    FILE: (_limit("RATE_LIMIT_FILE", "0.2,5"), _limit("RATE_LIMIT_FILE_PER_CHAT", "2,20")),
+    MODIFY: (_limit("RATE_LIMIT_MODIFY", "2,20"), None),
+    TYPING: (_limit("RATE_LIMIT_TYPING", "1,5"), _limit("RATE_LIMIT_TYPING_PER_CHAT", "10,30")),
+    FRAME: (_limit("RATE_LIMIT_FRAME", "20,60"), None),
+    EXPORT: (_limit("RATE_LIMIT_EXPORT", "0.01,3"), None),
+    VIOLATION: (_limit("RATE_LIMIT_VIOLATION", "1,20"), None),
+}
+
+class RateLimiter:
+    def __init__(self, limits: Dict[str, tuple] = None):
+        self.limits = limits if limits is not None else LIMITS
+        # (class, scope, key) -> [tokens, last refill time]
+        self._buckets: Dict[tuple, list] = {}
+
+    def _wait(self, key: tuple, limit: Tuple[float, float], now: float) -> float:
+        """Refill the bucket; seconds until it has a token (0 if it has one now)"""
+        rate, burst = limit
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            return 0.0
+        return (1 - bucket[0]) / rate if rate > 0 else float("inf")
+
+    def acquire(self, op_class: str, user_key: str, chat_id: Optional[str] = None) -> float:
+        """Take a token from the user's (and chat's) bucket.
+
+        Returns 0 when allowed, otherwise the seconds to wait; nothing is taken when refused.
+        """
+        if not RATE_LIMIT_ENABLED:
+            return 0.0
+        user_limit, chat_limit = self.limits.get(op_class, (None, None))
+        now = time.monotonic()
+        keys = []
+        wait = 0.0
+        if user_limit:
+            keys.append((op_class, "user", user_key))
+            wait = self._wait(keys[-1], user_limit, now)
+        if chat_limit and chat_id:
+            keys.append((op_class, "chat", chat_id))
+            wait = max(wait, self._wait(keys[-1], chat_limit, now))
+        if wait:
+            return wait
+        for key in keys:
+            self._buckets[key][0] -= 1
+        if len(self._buckets) > RATE_LIMIT_MAX_BUCKETS:
+            self._sweep(now)
+        return 0.0
+
+    def _sweep(self, now: float):
+        for key, bucket in list(self._buckets.items()):
+            limits = self.limits.get(key[0], (None, None))
+            rate, burst = limits[0] if key[1] == "user" else limits[1]
+            if bucket[0] + (now - bucket[1]) * rate >= burst:
+                del self._buckets[key]
+
+limiter = RateLimiter()
+
+def check(op_class: str, user_id: str, chat_id: Optional[str] = None):
+    """For HTTP handlers: raise 429 with Retry-After when over the limit"""
+    wait = limiter.acquire(op_class, user_id, chat_id)
+    if wait:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(max(1, int(min(wait, 3600) + 0.999)))}
+        )
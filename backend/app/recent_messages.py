@@ -0,0 +1,226 @@
+"""
+In-memory first page of recently read chats.
+
+For each chat whose newest page was read recently, the app keeps the last
+RECENT_MESSAGES_PER_CHAT rendered rows, the message total, the participants
+and the page's version, so the next first-page read of that chat needs no
+database access at all. Entries are filled by get_messages and then
+followed by the handlers that change them: new messages are added, edits,
+deletes, reactions and reply preview refreshes are applied to the cached
+rows, and writes the cache can't follow (membership changes, renames)
+drop it.
+
+The cache is per process, like ConnectionManager: writes made by another
+process (or by scripts) are not seen. Chats are evicted least recently
+read first once the encoded size of all cached rows passes
+RECENT_MESSAGES_MEMORY_MB; the Python objects take a few times that.
+"""
+
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from dotenv import load_dotenv
+
+from app import metrics
+from app.serialization import dumps
+
+load_dotenv()
+
+RECENT_MESSAGES_ENABLED = os.getenv("RECENT_MESSAGES_ENABLED", "true").lower() == "true"
+RECENT_MESSAGES_PER_CHAT = int(os.getenv("RECENT_MESSAGES_PER_CHAT", "50"))
+RECENT_MESSAGES_MEMORY_MB = float(os.getenv("RECENT_MESSAGES_MEMORY_MB", "64"))
+
+lookups = metrics.Counter("recent_messages_lookups_total", "First-page reads by cache outcome", ("outcome",))
+
+def _row_size(row: dict) -> int:
+    return len(dumps(row))
+
+def _as_stored(value: datetime) -> datetime:
+    # BSON dates have millisecond precision, so a row read back from the database has no more
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+class RecentPage:
+    """The newest rows of one chat, oldest first"""
+    __slots__ = ("rows", "total", "participants", "base_version", "revision", "size")
+
+    def __init__(self, rows: List[dict], total: int, participants: Iterable[str], version: str):
+        self.rows = rows
+        self.total = total
+        self.participants = frozenset(participants)
+        self.base_version = version
+        self.revision = 0  # Changes applied in memory since the fill
+        self.size = sum(_row_size(row) for row in rows)
+
+    @property
+    def version(self) -> str:
+        # Never equal to a version read from the database once changed in memory
+        return self.base_version if not self.revision else f"{self.base_version}+{self.revision}"
+
+    def covers(self, limit: int) -> bool:
+        return limit <= len(self.rows) or len(self.rows) >= self.total
+
+    def index_of(self, message_id: str) -> int:
+        for i in range(len(self.rows) - 1, -1, -1):
+            if self.rows[i]["id"] == message_id:
+                return i
+        return -1
+
+class Fill:
+    """One get_messages call loading a page that may be cached; stale once the chat changes meanwhile"""
+    __slots__ = ("chat_id", "stale")
+
+    def __init__(self, chat_id: str):
+        self.chat_id = chat_id
+        self.stale = False
+
+class RecentMessages:
+    def __init__(self, per_chat: int = RECENT_MESSAGES_PER_CHAT, memory_mb: float = RECENT_MESSAGES_MEMORY_MB,
+                 enabled: bool = RECENT_MESSAGES_ENABLED):
+        self.per_chat = per_chat
+        self.budget = int(memory_mb * 1024 * 1024)
+        self.enabled = enabled and per_chat > 0 and self.budget > 0
+        self._pages: "OrderedDict[str, RecentPage]" = OrderedDict()
+        self._fills: Dict[str, List[Fill]] = {}
+        self.size = 0
+
+    def cacheable(self, skip: int, limit: int) -> bool:
+        return self.enabled and skip == 0 and 0 < limit <= self.per_chat
+
+    def get(self, chat_id: str) -> Optional[RecentPage]:
+        page = self._pages.get(chat_id)
+        if page is not None:
+            self._pages.move_to_end(chat_id)
+        return page
+
+    def begin_fill(self, chat_id: str) -> Fill:
+        """Call before reading anything the page is built from"""
+        fill = Fill(chat_id)
+        self._fills.setdefault(chat_id, []).append(fill)
+        return fill
+
+    def end_fill(self, fill: Optional[Fill]):
+        if fill is None:
+            return
+        fills = self._fills.get(fill.chat_id, [])
+        if fill in fills:
+            fills.remove(fill)
+        if not fills:
+            self._fills.pop(fill.chat_id, None)
+
+    def store(self, fill: Fill, rows: List[dict], total: int, participants: Iterable[str], version: str):
+        """Cache a freshly rendered newest page (oldest row first) unless the chat changed while it was read"""
+        if fill.stale:
+            return
+        self._drop(fill.chat_id)
+        page = RecentPage(rows[-self.per_chat:], total, participants, version)
+        self._pages[fill.chat_id] = page
+        self.size += page.size
+        self._evict()
+
+    def add(self, chat_id: str, row: dict):
+        """A new message was stored in the chat"""
+        self._changed(chat_id)
+        page = self._pages.get(chat_id)
+        if page is None:
+            return
+        row = {**row, "created_at": _as_stored(row["created_at"])}
+        existing = page.index_of(row["id"])
+        if existing >= 0:
+            # Already read back by the fill
+            self._replace(page, existing, row)
+            return
+        # Concurrent sends can finish out of order; rows stay in created_at order like the query's
+        position = len(page.rows)
+        while position and page.rows[position - 1]["created_at"] > row["created_at"]:
+            position -= 1
+        page.rows.insert(position, row)
+        page.size += _row_size(row)
+        self.size += _row_size(row)
+        page.total += 1
+        page.revision += 1
+        while len(page.rows) > self.per_chat:
+            dropped = page.rows.pop(0)
+            page.size -= _row_size(dropped)
+            self.size -= _row_size(dropped)
+        self._evict()
+
+    def update(self, chat_id: str, message_id: str, fields: dict):
+        """A stored message changed; fields replace those of its cached row"""
+        self._changed(chat_id)
+        page = self._pages.get(chat_id)
+        if page is None:
+            return
+        index = page.index_of(message_id)
+        if index >= 0:
+            self._replace(page, index, {**page.rows[index], **fields})
+
+    def react(self, chat_id: str, message_id: str, emoji: str, user_id: str, added: bool):
+        """A reaction was toggled; applied as a delta so concurrent reactions can land in any order"""
+        self._changed(chat_id)
+        page = self._pages.get(chat_id)
+        if page is None:
+            return
+        index = page.index_of(message_id)
+        if index < 0:
+            return
+        reactions = dict(page.rows[index].get("reactions") or {})
+        users = [uid for uid in reactions.get(emoji, []) if uid != user_id]
+        if added:
+            users.append(user_id)
+        if users:
+            reactions[emoji] = users
+        else:
+            reactions.pop(emoji, None)
+        self._replace(page, index, {**page.rows[index], "reactions": reactions})
+
+    def refresh_replies(self, chat_id: str, message_id: str, content: str):
+        """The message replied to changed; update the previews of cached replies to it"""
+        self._changed(chat_id)
+        page = self._pages.get(chat_id)
+        if page is None:
+            return
+        for index, row in enumerate(page.rows):
+            preview = row.get("reply_to_message")
+            if row.get("reply_to") == message_id and preview:
+                self._replace(page, index, {**row, "reply_to_message": {**preview, "content": content}})
+
+    def invalidate(self, chat_id: str):
+        """The chat changed in a way the cache doesn't follow"""
+        self._changed(chat_id)
+        self._drop(chat_id)
+
+    def clear(self):
+        """Something every page may show changed (a user's name)"""
+        for fills in self._fills.values():
+            for fill in fills:
+                fill.stale = True
+        self._pages.clear()
+        self.size = 0
+
+    def _changed(self, chat_id: str):
+        for fill in self._fills.get(chat_id, ()):
+            fill.stale = True
+
+    def _replace(self, page: RecentPage, index: int, row: dict):
+        delta = _row_size(row) - _row_size(page.rows[index])
+        page.rows[index] = row
+        page.size += delta
+        self.size += delta
+        page.revision += 1
+
+    def _drop(self, chat_id: str):
+        page = self._pages.pop(chat_id, None)
+        if page is not None:
+            self.size -= page.size
+
+    def _evict(self):
+        while self.size > self.budget and self._pages:
+            _, page = self._pages.popitem(last=False)
+            self.size -= page.size
+
+cache = RecentMessages()
+
+metrics.Gauge("recent_messages_chats", "Chats with their newest page in memory", lambda: len(cache._pages))
+metrics.Gauge("recent_messages_bytes", "Encoded size of the cached rows", lambda: cache.size)
@@ -0,0 +1,42 @@
+import orjson
+from fastapi.responses import Response
+from bson import ObjectId
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dumps(obj) -> bytes:
+    """Encode obj as JSON bytes. datetimes are written in ISO format and ObjectIds as strings."""
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+def encode_frame(message: dict) -> str:
+    """Encode a WebSocket event once so the same text frame can be sent to every recipient"""
+    return dumps(message).decode()
+
+def encode_global_frame(event_type: str, chat_id: str, frame: str) -> str:
+    """Wrap an already encoded event in the global envelope without encoding it again"""
+    return '{"type":%s,"chat_id":%s,"message":%s}' % (
+        dumps(event_type).decode(), dumps(chat_id).decode(), frame
+    )
+
+def encode_sync_batch(chat_id: str, batch: dict) -> str:
+    """Encode the result of events.read_since around its already encoded event frames"""
+    return '{"type":"sync","chat_id":%s,"events":[%s],"last_seq":%d,"has_more":%s,"reset":%s}' % (
+        dumps(chat_id).decode(),
+        ",".join(batch["frames"]),
+        batch["last_seq"],
+        "true" if batch["has_more"] else "false",
+        "true" if batch["reset"] else "false"
+    )
+
+class FastJSONResponse(Response):
+    """JSON response rendered straight from dicts, for trusted database output.
+
+    Returning it from an endpoint skips FastAPI's jsonable_encoder and response model validation.
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
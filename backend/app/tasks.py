@@ -0,0 +1,152 @@
+"""
+Bounded in-process runner for fire-and-forget work (delivery receipts,
+presence broadcasts, reply preview refreshes).
+
+Jobs go into a bounded queue served by a fixed pool of workers. A full
+queue drops the new job instead of growing without limit. A job
+submitted with a key is skipped while an identical job is still waiting.
+Failures are logged and retried with exponential backoff when the job
+asks for retries. On shutdown the runner stops taking jobs and drains
+the queue for up to TASK_DRAIN_TIMEOUT_SECONDS.
+"""
+
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+from dotenv import load_dotenv
+
+from app import metrics
+
+load_dotenv()
+
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", "16"))
+TASK_QUEUE_SIZE = int(os.getenv("TASK_QUEUE_SIZE", "10000"))
+# Delay before the first retry; doubles with every further attempt
+TASK_RETRY_BACKOFF_SECONDS = float(os.getenv("TASK_RETRY_BACKOFF_SECONDS", "0.5"))
+TASK_DRAIN_TIMEOUT_SECONDS = float(os.getenv("TASK_DRAIN_TIMEOUT_SECONDS", "10"))
+
+task_outcomes = metrics.Counter(
+    "background_tasks_total", "Background jobs by name and outcome", ("name", "outcome")
+)
+task_duration = metrics.Histogram("background_task_duration_seconds", "Run time of one background job", ("name",))
+
+class Job:
+    __slots__ = ("name", "factory", "key", "retries", "attempt")
+
+    def __init__(self, name: str, factory: Callable[[], Awaitable], key: Optional[str], retries: int):
+        self.name = name
+        self.factory = factory
+        self.key = key
+        self.retries = retries
+        self.attempt = 0
+
+class TaskRunner:
+    def __init__(self, workers: int = TASK_WORKERS, queue_size: int = TASK_QUEUE_SIZE):
+        self.worker_count = workers
+        self.queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers = []
+        self._waiting_keys = set()
+        self._retrying = set()
+        self.running = 0
+        self.accepting = False
+
+    def start(self):
+        """Start the workers on the running loop (called from the app's lifespan)"""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._waiting_keys.clear()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.worker_count)]
+        self.accepting = True
+
+    def submit(self, name: str, factory: Callable[[], Awaitable], key: str = None, retries: int = 0) -> bool:
+        """Queue factory() to run in the background; False if it was dropped or deduplicated"""
+        if self._queue is None:
+            # Scripts and tools that never run the app's lifespan
+            self.start()
+        if not self.accepting:
+            task_outcomes.inc(name, "dropped")
+            return False
+        if key is not None and key in self._waiting_keys:
+            task_outcomes.inc(name, "deduplicated")
+            return False
+        return self._enqueue(Job(name, factory, key, retries))
+
+    def _enqueue(self, job: Job) -> bool:
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            task_outcomes.inc(job.name, "dropped")
+            return False
+        if job.key is not None:
+            self._waiting_keys.add(job.key)
+        return True
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            # A job that has started may be submitted again - its inputs may have changed since
+            self._waiting_keys.discard(job.key)
+            self.running += 1
+            start = time.perf_counter()
+            try:
+                await job.factory()
+                task_outcomes.inc(job.name, "ok")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if job.attempt < job.retries:
+                    task_outcomes.inc(job.name, "retried")
+                    self._retry_later(job)
+                else:
+                    task_outcomes.inc(job.name, "failed")
+                    print(f"⚠️  Background task {job.name} failed: {e!r}")
+            finally:
+                task_duration.observe(time.perf_counter() - start, job.name)
+                self.running -= 1
+                self._queue.task_done()
+
+    def _retry_later(self, job: Job):
+        delay = TASK_RETRY_BACKOFF_SECONDS * (2 ** job.attempt)
+        job.attempt += 1
+        handle = None
+
+        def requeue():
+            self._retrying.discard(handle)
+            if self.accepting:
+                self._enqueue(job)
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retrying.add(handle)
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def join(self):
+        """Wait until everything queued so far has run (retries scheduled for later are not awaited)"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def drain(self, timeout: float = TASK_DRAIN_TIMEOUT_SECONDS):
+        """Stop taking jobs, give queued ones up to timeout seconds, then stop the workers"""
+        self.accepting = False
+        for handle in self._retrying:
+            handle.cancel()
+        self._retrying.clear()
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️  Dropped {self.queued + self.running} background tasks unfinished at shutdown")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+runner = TaskRunner()
+
+metrics.Gauge("background_tasks_queued", "Background jobs waiting for a worker", lambda: runner.queued)
+metrics.Gauge("background_tasks_running", "Background jobs being run", lambda: runner.running)
@@ -0,0 +1,58 @@
+"""
+Version tokens for conditional GETs of the chat list and message pages.
+
+A chat's version is its event_seq (bumped by every event broadcast to
+the chat) plus a small counter for the writes that change stored
+messages without an event: mark-all-read and reply preview refreshes.
+Both live in `counters` and are read in one query. Handlers read versions
+before the data they describe, so a tag may be older than its response
+but never newer - a stale tag only costs one more full response.
+
+Presence (pushed over the WebSocket) and other users' profile changes
+are not versioned.
+"""
+
+import hashlib
+from typing import Dict, Iterable, Optional
+
+import orjson
+
+def _changes_key(chat_id: str) -> str:
+    return f"changes:{chat_id}"
+
+async def bump_chat(db, chat_id: str):
+    """Call after a write that changes a chat's messages without publishing an event"""
+    await db.counters.update_one({"_id": _changes_key(chat_id)}, {"$inc": {"seq": 1}}, upsert=True)
+
+async def chat_versions(db, chat_ids: Iterable[str]) -> Dict[str, str]:
+    """chat_id -> "<event_seq>.<changes>" for each chat, in one round trip"""
+    chat_ids = list(chat_ids)
+    keys = [f"events:{chat_id}" for chat_id in chat_ids] + [_changes_key(chat_id) for chat_id in chat_ids]
+    counters = {
+        doc["_id"]: doc.get("seq", 0)
+        async for doc in db.counters.find({"_id": {"$in": keys}}, {"seq": 1})
+    }
+    return {
+        chat_id: f"{counters.get(f'events:{chat_id}', 0)}.{counters.get(_changes_key(chat_id), 0)}"
+        for chat_id in chat_ids
+    }
+
+def make_etag(*parts) -> str:
+    """Weak ETag from anything orjson can encode"""
+    digest = hashlib.blake2b(orjson.dumps(parts, default=str), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+def matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check with weak comparison"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
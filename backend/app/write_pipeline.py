@@ -0,0 +1,118 @@
+"""
+Micro-batched inserts for busy chats.
+
+With WRITE_PIPELINE_ENABLED, concurrent message inserts are collected for
+up to WRITE_BATCH_WINDOW_MS (or until WRITE_BATCH_MAX_DOCS are waiting)
+and written with one unordered insert_many. Each caller awaits a future
+that resolves with its own _id or raises its own error, e.g.
+DuplicateKeyError for a retried client_msg_id, exactly like insert_one.
+
+Batches of one collection are written one at a time, so the next batch
+fills up while the previous one is in flight. Inside a batch, callers are
+resumed in (chat_id, seq) order. Messages of a chat therefore come back
+in the order they were queued, and their broadcasts go out in that order.
+"""
+
+import asyncio
+import os
+from typing import Dict, List, Tuple
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
+
+from app import metrics
+
+load_dotenv()
+
+WRITE_PIPELINE_ENABLED = os.getenv("WRITE_PIPELINE_ENABLED", "false").lower() == "true"
+# How long the first insert of a batch waits for company
+WRITE_BATCH_WINDOW_MS = float(os.getenv("WRITE_BATCH_WINDOW_MS", "2"))
+# A batch is written as soon as this many inserts are waiting
+WRITE_BATCH_MAX_DOCS = int(os.getenv("WRITE_BATCH_MAX_DOCS", "100"))
+
+insert_batch_size = metrics.Histogram(
+    "mongo_insert_batch_size", "Documents per batched insert_many", buckets=metrics.FANOUT_SIZE_BUCKETS
+)
+
+class InsertBatcher:
+    def __init__(self, window_ms: float = WRITE_BATCH_WINDOW_MS, max_docs: int = WRITE_BATCH_MAX_DOCS):
+        self.window = window_ms / 1000
+        self.max_docs = max_docs
+        self.collection = None
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._timer = None
+        self._lock = None
+        self._flushes = set()
+
+    async def insert(self, collection, doc: dict):
+        """insert_one, batched with whatever else arrives within the window. Returns the _id."""
+        loop = asyncio.get_running_loop()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        doc.setdefault("_id", ObjectId())
+        future = loop.create_future()
+        # Every caller passes the same collection; keep the latest handle (it changes after a reconnect)
+        self.collection = collection
+        self._pending.append((doc, future))
+        if len(self._pending) >= self.max_docs:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._flush(self.collection, batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, collection, batch: List[Tuple[dict, asyncio.Future]]):
+        async with self._lock:
+            batch.sort(key=lambda item: (str(item[0].get("chat_id")), item[0].get("seq") or 0))
+            insert_batch_size.observe(len(batch))
+            errors = {}
+            try:
+                await collection.insert_many([doc for doc, _ in batch], ordered=False)
+            except BulkWriteError as e:
+                errors = {error["index"]: error for error in e.details.get("writeErrors", [])}
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            for index, (doc, future) in enumerate(batch):
+                if future.done():
+                    # The caller went away; its document is stored all the same
+                    continue
+                error = errors.get(index)
+                if error is None:
+                    future.set_result(doc["_id"])
+                elif error.get("code") == 11000:
+                    future.set_exception(DuplicateKeyError(error.get("errmsg", "duplicate key"), 11000, error))
+                else:
+                    future.set_exception(WriteError(error.get("errmsg", "write error"), error.get("code"), error))
+
+    async def flush(self):
+        """Write whatever is waiting now and wait for batches in flight (on shutdown)"""
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+# One batcher per collection name
+_batchers: Dict[str, InsertBatcher] = {}
+
+async def insert(collection, doc: dict):
+    batcher = _batchers.get(collection.name)
+    if batcher is None:
+        batcher = _batchers[collection.name] = InsertBatcher()
+    return await batcher.insert(collection, doc)
+
+async def flush_all():
+    for batcher in list(_batchers.values()):
+        await batcher.flush()
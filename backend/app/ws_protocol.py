@@ -0,0 +1,166 @@
+"""
+WebSocket framing: JSON text frames by default, MessagePack binary frames on request.
+
+A client opts in by offering the "chat.msgpack.v1" subprotocol
+(`new WebSocket(url, ["chat.msgpack.v1", "chat.json.v1"])`); the first
+offered protocol the server supports is accepted. "chat.json.v1" is the
+default format under an explicit name, for clients that always send a
+protocol list. The same events are sent either way:
+
+- every frame is one flag byte followed by the MessagePack body; flag 1
+  means the body is raw-deflate compressed (bodies over
+  WS_DEFLATE_THRESHOLD_BYTES), flag 0 that it isn't
+- map keys listed in FIELDS are sent as their index in it; any other key
+  (and every key of reactions and resume maps) stays a string
+- created_at, edited_at and last_seen are MessagePack timestamps (the
+  JSON form's wall-clock time, read as UTC)
+
+Clients on the binary protocol may send JSON text frames or binary frames
+in the same format. New fields only get a tag in the next protocol
+version, so v1 clients keep decoding them as string keys.
+
+Events are encoded as JSON once, as before; the binary form of a
+broadcast is built from it at most once, for the first binary recipient.
+"""
+
+import json
+import os
+import zlib
+from datetime import datetime, timezone
+from typing import Awaitable, Union
+
+import msgpack
+import orjson
+from dotenv import load_dotenv
+from fastapi import WebSocket, WebSocketDisconnect
+
+load_dotenv()
+
+MSGPACK_SUBPROTOCOL = "chat.msgpack.v1"
+JSON_SUBPROTOCOL = "chat.json.v1"
+
+WS_MSGPACK_ENABLED = os.getenv("WS_MSGPACK_ENABLED", "true").lower() == "true"
+# Binary frames with a larger MessagePack body are deflated; 0 turns compression off
+WS_DEFLATE_THRESHOLD_BYTES = int(os.getenv("WS_DEFLATE_THRESHOLD_BYTES", "512"))
+# Largest inflated frame accepted from a client
+MAX_INFLATED_FRAME_BYTES = 1024 * 1024
+
+PLAIN = 0
+DEFLATED = 1
+
+# Tag of a field = its position. Append only, and only in a new protocol version.
+FIELDS = (
+    "type", "chat_id", "message", "id", "sender_id", "sender_name", "message_type", "content",
+    "file_url", "reply_to", "reply_to_message", "edited_at", "is_deleted", "status", "reactions",
+    "seq", "created_at", "client_msg_id", "event_seq", "user_id", "message_id", "is_online",
+    "is_typing", "emoji", "added", "count", "events", "last_seq", "has_more", "reset", "op", "key",
+    "data", "detail", "retry_after_ms", "after_ms", "deleted", "since", "chats", "last_seen"
+)
+FIELD_TAGS = {name: tag for tag, name in enumerate(FIELDS)}
+TIMESTAMP_FIELDS = {"created_at", "edited_at", "last_seen"}
+# Maps keyed by data (emoji, chat ids), not by field names
+OPAQUE_MAPS = {"reactions", "chats"}
+
+# Set on sockets accepted with the binary protocol - one attribute read per send
+BINARY_FLAG = "chat_msgpack"
+
+def _pack_value(value, field: str = None):
+    if isinstance(value, dict):
+        if field in OPAQUE_MAPS:
+            return {key: _pack_value(item) for key, item in value.items()}
+        return {FIELD_TAGS.get(key, key): _pack_value(item, key) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_pack_value(item) for item in value]
+    if field in TIMESTAMP_FIELDS and isinstance(value, str):
+        try:
+            moment = datetime.fromisoformat(value)
+        except ValueError:
+            return value
+        return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+    return value
+
+def _unpack_value(value):
+    if isinstance(value, dict):
+        unpacked = {}
+        for key, item in value.items():
+            name = FIELDS[key] if isinstance(key, int) and 0 <= key < len(FIELDS) else key
+            unpacked[name] = item if name in OPAQUE_MAPS else _unpack_value(item)
+        return unpacked
+    if isinstance(value, list):
+        return [_unpack_value(item) for item in value]
+    return value
+
+def pack(event) -> bytes:
+    """Binary frame of a decoded JSON event"""
+    body = msgpack.packb(_pack_value(event), datetime=True)
+    if WS_DEFLATE_THRESHOLD_BYTES and len(body) > WS_DEFLATE_THRESHOLD_BYTES:
+        compressor = zlib.compressobj(wbits=-15)
+        return bytes((DEFLATED,)) + compressor.compress(body) + compressor.flush()
+    return bytes((PLAIN,)) + body
+
+def unpack(data: bytes):
+    """Event of a binary frame; ValueError for anything that isn't one"""
+    try:
+        flag, body = data[0], data[1:]
+        if flag == DEFLATED:
+            inflater = zlib.decompressobj(wbits=-15)
+            body = inflater.decompress(body, MAX_INFLATED_FRAME_BYTES)
+            if inflater.unconsumed_tail:
+                raise ValueError("Frame too large")
+        elif flag != PLAIN:
+            raise ValueError("Unknown frame flag")
+        return _unpack_value(msgpack.unpackb(body, strict_map_key=False))
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError("Invalid frame") from e
+
+class Frame:
+    """One outgoing event, encoded as JSON and, when a binary socket needs it, as MessagePack once"""
+    __slots__ = ("text", "_packed")
+
+    def __init__(self, text: str):
+        self.text = text
+        self._packed = None
+
+    def packed(self) -> bytes:
+        if self._packed is None:
+            self._packed = pack(orjson.loads(self.text))
+        return self._packed
+
+async def accept(websocket: WebSocket):
+    """Accept the socket with the first subprotocol the client offers that the server supports"""
+    chosen = None
+    for protocol in websocket.scope.get("subprotocols", ()):
+        if protocol == JSON_SUBPROTOCOL or (protocol == MSGPACK_SUBPROTOCOL and WS_MSGPACK_ENABLED):
+            chosen = protocol
+            break
+    await websocket.accept(subprotocol=chosen)
+    if chosen == MSGPACK_SUBPROTOCOL:
+        setattr(websocket, BINARY_FLAG, True)
+
+def send(websocket, frame: Union[Frame, str]) -> Awaitable:
+    """The socket's own send call for the frame in its format (a plain function, so a broadcast
+    to thousands of sockets doesn't pay for an extra coroutine per socket)"""
+    if getattr(websocket, BINARY_FLAG, False):
+        if not isinstance(frame, Frame):
+            frame = Frame(frame)
+        return websocket.send_bytes(frame.packed())
+    return websocket.send_text(frame.text if isinstance(frame, Frame) else frame)
+
+async def receive(websocket: WebSocket) -> Union[str, bytes]:
+    """Next text or binary frame, not decoded yet (so flood control runs before parsing)"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("text") is not None:
+        return message["text"]
+    return message.get("bytes") or b""
+
+def decode(websocket, data: Union[str, bytes]):
+    """Event of a received frame; ValueError if it can't be decoded"""
+    if isinstance(data, str):
+        return json.loads(data)
+    if not getattr(websocket, BINARY_FLAG, False):
+        raise ValueError("Binary frame on a JSON socket")
+    return unpack(data)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Move messages older than ARCHIVE_AFTER_DAYS out of MongoDB into the cold tier
+(compressed per-chat segment files under COLD_STORAGE_DIR).
+Run it periodically from the backend directory: python archive_messages.py [--days N]
+"""
+
+import argparse
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient
+
+from app import cold_storage
+from app.database import MONGODB_URL, DATABASE_NAME
+
+BATCH_SIZE = 5000
+
+def archive_chat(db, chat_id: str, cutoff: datetime) -> int:
+    """Archive one chat's old messages. Safe to re-run after a crash."""
+    archived = 0
+    while True:
+        batch = list(db.messages.find(
+            {"chat_id": chat_id, "created_at": {"$lt": cutoff}}
+        ).sort([("created_at", 1), ("_id", 1)]).limit(BATCH_SIZE))
+        if not batch:
+            return archived
+        
+        # Messages written to a segment by a run that died before deleting them
+        # are already archived - only delete those. They are the oldest ones left,
+        # so only the blocks reaching back to the start of the batch can hold them.
+        already_archived = cold_storage.archived_ids_since(chat_id, batch[0]["created_at"])
+        to_write = [m for m in batch if m["_id"] not in already_archived]
+        
+        archived += cold_storage.append_messages(chat_id, to_write)
+        db.messages.delete_many({"_id": {"$in": [m["_id"] for m in batch]}})
+
+def archive_old_messages(days: int) -> int:
+    client = MongoClient(MONGODB_URL)
+    db = client[DATABASE_NAME]
+    cutoff = datetime.now() - timedelta(days=days)
+    
+    try:
+        total = 0
+        for chat in db.chats.find({}, {"_id": 1}):
+            count = archive_chat(db, str(chat["_id"]), cutoff)
+            if count:
+                print(f"📦 {chat['_id']}: archived {count} messages")
+            total += count
+        return total
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=int, default=cold_storage.ARCHIVE_AFTER_DAYS,
+                        help="archive messages older than this many days")
+    args = parser.parse_args()
+    
+    print(f"🔄 Archiving messages older than {args.days} days...")
+    count = archive_old_messages(args.days)
+    print(f"✨ Done! {count} messages moved to {cold_storage.COLD_STORAGE_DIR}.")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Create the `chat_members` documents of existing chats (see app/memberships.py).
+A chat archived with the old per-chat is_archived flag stays archived for
+every member. Safe to re-run: existing member documents are left alone.
+Run from the backend directory: python backfill_chat_members.py
+"""
+
+from pymongo import MongoClient, UpdateOne
+
+from app.database import MONGODB_URL, DATABASE_NAME
+
+BATCH_SIZE = 1000
+
+def last_activity_by_chat(db) -> dict:
+    """Time of each chat's newest message, from either storage layout"""
+    latest = {}
+    for row in db.messages.aggregate([
+        {"$group": {"_id": "$chat_id", "last": {"$max": "$created_at"}}}
+    ], allowDiskUse=True):
+        latest[row["_id"]] = row["last"]
+    for row in db.message_buckets.aggregate([
+        {"$group": {"_id": "$chat_id", "last": {"$max": {"$max": "$messages.created_at"}}}}
+    ], allowDiskUse=True):
+        if row["last"] and (row["_id"] not in latest or row["last"] > latest[row["_id"]]):
+            latest[row["_id"]] = row["last"]
+    return latest
+
+def read_seqs(db, chat_id: str, participants: list) -> dict:
+    """Each participant's newest read seq in a chat"""
+    rows = db.messages.aggregate([
+        {"$match": {"chat_id": chat_id, "seq": {"$exists": True}, "read_by": {"$in": participants}}},
+        {"$unwind": "$read_by"},
+        {"$group": {"_id": "$read_by", "seq": {"$max": "$seq"}}}
+    ])
+    return {row["_id"]: row["seq"] for row in rows}
+
+def backfill() -> int:
+    client = MongoClient(MONGODB_URL)
+    db = client[DATABASE_NAME]
+    db.chat_members.create_index([("user_id", 1), ("chat_id", 1)], unique=True)
+
+    latest = last_activity_by_chat(db)
+    created = 0
+    operations = []
+    try:
+        for chat in db.chats.find({}, {"participants": 1, "admins": 1, "is_archived": 1, "created_at": 1}):
+            chat_id = str(chat["_id"])
+            participants = chat.get("participants", [])
+            admins = set(chat.get("admins", []))
+            last_read = read_seqs(db, chat_id, participants)
+            for user_id in participants:
+                operations.append(UpdateOne(
+                    {"user_id": user_id, "chat_id": chat_id},
+                    {"$setOnInsert": {
+                        "role": "admin" if user_id in admins else "member",
+                        "archived": bool(chat.get("is_archived")),
+                        "last_activity": latest.get(chat_id) or chat.get("created_at"),
+                        "last_read_seq": last_read.get(user_id, 0),
+                        "joined_at": chat.get("created_at")
+                    }},
+                    upsert=True
+                ))
+            if len(operations) >= BATCH_SIZE:
+                created += db.chat_members.bulk_write(operations, ordered=False).upserted_count
+                operations = []
+        if operations:
+            created += db.chat_members.bulk_write(operations, ordered=False).upserted_count
+        return created
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    print("🔄 Creating chat member documents...")
+    count = backfill()
+    print(f"✨ Done! {count} member documents created.")
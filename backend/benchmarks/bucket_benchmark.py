@@ -0,0 +1,110 @@
+"""
+Index size and history page latency of the two message storage layouts.
+
+Fills a scratch database per mode with one busy chat and reads random
+history pages through message_store.fetch_page. Needs a running MongoDB
+(MONGODB_URL); the scratch databases are dropped afterwards.
+
+Run from the backend directory:
+    python -m benchmarks.bucket_benchmark [--messages 200000]
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app import message_store
+from app.database import MONGODB_URL, DATABASE_NAME
+from app.main import MESSAGE_PROJECTION
+
+PAGE_SIZE = 50
+PAGES = 500
+
+def make_messages(chat_id, count):
+    senders = [str(ObjectId()) for _ in range(20)]
+    start = datetime.now() - timedelta(seconds=count)
+    return [{
+        "_id": ObjectId(),
+        "chat_id": chat_id,
+        "sender_id": senders[seq % len(senders)],
+        "message_type": "text",
+        "content": f"Message number {seq} of an ordinary length.",
+        "file_url": None,
+        "reply_to": None,
+        "reply_to_message": None,
+        "edited_at": None,
+        "is_deleted": False,
+        "status": "sent",
+        "reactions": {},
+        "read_by": [],
+        "seq": seq,
+        "created_at": start + timedelta(seconds=seq)
+    } for seq in range(1, count + 1)]
+
+async def fill(db, mode, chat_id, messages):
+    if mode == message_store.DOCUMENTS:
+        await db.messages.create_index([("chat_id", 1), ("created_at", -1)])
+        for i in range(0, len(messages), 10000):
+            await db.messages.insert_many(messages[i:i + 10000])
+        return "messages"
+
+    await db.message_buckets.create_index([("chat_id", 1), ("bucket_start", 1)], unique=True)
+    buckets = {}
+    for msg in messages:
+        buckets.setdefault(message_store.bucket_start(msg["seq"]), []).append(msg)
+    docs = [
+        {"chat_id": chat_id, "bucket_start": start, "count": len(msgs), "messages": msgs}
+        for start, msgs in buckets.items()
+    ]
+    for i in range(0, len(docs), 500):
+        await db.message_buckets.insert_many(docs[i:i + 500])
+    return "message_buckets"
+
+async def run_mode(client, mode, count):
+    db = client[f"{DATABASE_NAME}_bench_{mode}"]
+    await client.drop_database(db.name)
+    chat_id = str(ObjectId())
+    try:
+        collection = await fill(db, mode, chat_id, make_messages(chat_id, count))
+        stats = await db.command("collStats", collection)
+
+        timings = []
+        for _ in range(PAGES):
+            # Recent pages are read far more often than deep history
+            skip = int(random.expovariate(1 / (PAGE_SIZE * 4))) if random.random() < 0.9 else random.randrange(count)
+            start = time.perf_counter()
+            await message_store.fetch_page(db, chat_id, skip, PAGE_SIZE, MESSAGE_PROJECTION, mode=mode)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        return {
+            "documents": stats["count"],
+            "index_kb": stats["totalIndexSize"] / 1024,
+            "p50": statistics.median(timings),
+            "p99": timings[int(len(timings) * 0.99) - 1]
+        }
+    finally:
+        await client.drop_database(db.name)
+
+async def run(count):
+    client = AsyncIOMotorClient(MONGODB_URL)
+    print(f"{count} messages, bucket size {message_store.MESSAGE_BUCKET_SIZE}, pages of {PAGE_SIZE}")
+    print(f"{'mode':>10} {'documents':>10} {'index KB':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    try:
+        for mode in (message_store.DOCUMENTS, message_store.BUCKETS):
+            result = await run_mode(client, mode, count)
+            print(f"{mode:>10} {result['documents']:>10} {result['index_kb']:>10.0f} "
+                  f"{result['p50']:>8.2f} {result['p99']:>8.2f}")
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200000)
+    args = parser.parse_args()
+    asyncio.run(run(args.messages))
@@ -0,0 +1,104 @@
+"""
+Memory and throughput of a chat export: resident memory must stay flat however long the chat is.
+
+Fills one chat of a scratch database with --messages messages from a few
+hundred senders, then runs the export stream the endpoint returns and
+throws the output away, sampling the worker's RSS after every chunk.
+Needs a running MongoDB (MONGODB_URL); the scratch database is dropped
+afterwards. Seeding dominates the run time for big chats; --keep leaves
+the data in place for the next run.
+
+Run from the backend directory:
+    python -m benchmarks.export_benchmark [--messages 200000] [--gzip] [--keep]
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import app.main as main
+from app import export
+from app.database import MONGODB_URL, DATABASE_NAME
+from app.metrics import _resident_memory_bytes
+
+SENDERS = 300
+SEED_BATCH = 10000
+
+async def seed(db, count: int) -> tuple:
+    """One group chat with count messages; reuses what an earlier --keep run left"""
+    chat = await db.chats.find_one({"group_name": "Export benchmark"})
+    if chat and await db.messages.count_documents({"chat_id": str(chat["_id"])}) == count:
+        return str(chat["_id"]), chat["participants"][0]
+
+    await db.users.drop()
+    await db.chats.drop()
+    await db.messages.drop()
+    await db.messages.create_index([("chat_id", 1), ("created_at", -1)])
+    users = await db.users.insert_many([
+        {"username": f"user{i}", "full_name": f"User {i}", "email": f"user{i}@example.com"} for i in range(SENDERS)
+    ])
+    senders = [str(user_id) for user_id in users.inserted_ids]
+    result = await db.chats.insert_one({
+        "chat_type": "group", "group_name": "Export benchmark", "participants": senders, "created_at": datetime.now()
+    })
+    chat_id = str(result.inserted_id)
+
+    start = datetime.now() - timedelta(seconds=count)
+    for first in range(0, count, SEED_BATCH):
+        await db.messages.insert_many([{
+            "chat_id": chat_id,
+            "sender_id": senders[seq % SENDERS],
+            "message_type": "text",
+            "content": f"Message number {seq} of an ordinary length, exported once.",
+            "file_url": None,
+            "reply_to": None,
+            "reply_to_message": None,
+            "edited_at": None,
+            "is_deleted": False,
+            "status": "sent",
+            "reactions": {},
+            "seq": seq,
+            "created_at": start + timedelta(seconds=seq)
+        } for seq in range(first + 1, min(first + SEED_BATCH, count) + 1)], ordered=False)
+        print(f"\r   seeded {min(first + SEED_BATCH, count)}/{count}", end="", flush=True)
+    print()
+    return chat_id, senders[0]
+
+async def run(count: int, compress: bool, keep: bool):
+    client = AsyncIOMotorClient(MONGODB_URL)
+    db = client[f"{DATABASE_NAME}_bench_export"]
+    try:
+        chat_id, user_id = await seed(db, count)
+        print(f"Exporting {count} messages ({'gzip' if compress else 'plain'} NDJSON, "
+              f"batches of {export.EXPORT_BATCH_SIZE})")
+
+        rss_before = _resident_memory_bytes()
+        rss_peak = rss_before
+        written = 0
+        start = time.perf_counter()
+        async for chunk in export.stream(
+            db, user_id, [chat_id], main.build_message_row, main.display_name, main.MESSAGE_PROJECTION, compress
+        ):
+            written += len(chunk)
+            rss_peak = max(rss_peak, _resident_memory_bytes())
+        elapsed = time.perf_counter() - start
+
+        mb = 1024 * 1024
+        print(f"   {count / elapsed:,.0f} messages/s, {written / mb / elapsed:.1f} MB/s, {written / mb:,.1f} MB written")
+        print(f"   RSS {rss_before / mb:.1f} MB before, {rss_peak / mb:.1f} MB peak "
+              f"(+{(rss_peak - rss_before) / mb:.1f} MB)")
+    finally:
+        if not keep:
+            await client.drop_database(db.name)
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200000, help="size of the exported chat (try 10000000)")
+    parser.add_argument("--gzip", action="store_true", help="compress the export")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch database for the next run")
+    args = parser.parse_args()
+    asyncio.run(run(args.messages, args.gzip, args.keep))
@@ -0,0 +1,614 @@
+"""
+In-memory stand-ins for Motor and starlette's WebSocket, for benchmarks
+that run without a MongoDB.
+
+FakeDatabase covers the part of the Motor API that app/ uses: find /
+find_one with sort, skip, limit and projections (including $slice and
+$elemMatch), the insert / update / delete / find_one_and_update family
+with upserts and unique (partial) indexes, count_documents, simple
+aggregation pipelines and the query and update operators the handlers
+send. Every awaited call is one
+round trip and is counted, so a benchmark can check query counts as
+well as time.
+"""
+
+import copy
+import json
+import re
+from collections import Counter
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import DeleteOne, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+
+# ---------- query matching ----------
+
+def _values(doc, path: str) -> list:
+    """Values at a dotted path; arrays along the way are flattened like MongoDB does"""
+    current = [doc]
+    for part in path.split("."):
+        found = []
+        for value in current:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                else:
+                    found.extend(item[part] for item in value if isinstance(item, dict) and part in item)
+        current = found
+    return current
+
+def _expand(values: list) -> list:
+    """A field matches a value if it equals it or is an array containing it"""
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+def _compare(a, b, op: str) -> bool:
+    try:
+        if op == "$gt":
+            return a > b
+        if op == "$gte":
+            return a >= b
+        if op == "$lt":
+            return a < b
+        return a <= b
+    except TypeError:
+        return False
+
+_TYPES = {"string": str, "int": int, "double": float, "bool": bool, "object": dict, "array": list, "date": datetime, "objectId": ObjectId}
+
+def _match_condition(values: list, condition) -> bool:
+    if not (isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition)):
+        if condition is None:
+            return not values or None in _expand(values)
+        if isinstance(condition, re.Pattern):
+            return any(isinstance(v, str) and condition.search(v) for v in _expand(values))
+        return condition in _expand(values)
+
+    for op, arg in condition.items():
+        if op == "$eq":
+            ok = _match_condition(values, arg)
+        elif op == "$ne":
+            ok = not _match_condition(values, arg)
+        elif op == "$in":
+            ok = any(_match_condition(values, item) for item in arg)
+        elif op == "$nin":
+            ok = not any(_match_condition(values, item) for item in arg)
+        elif op in ("$gt", "$gte", "$lt", "$lte"):
+            ok = any(_compare(v, arg, op) for v in _expand(values))
+        elif op == "$exists":
+            ok = bool(values) == bool(arg)
+        elif op == "$regex":
+            flags = re.IGNORECASE if "i" in condition.get("$options", "") else 0
+            pattern = re.compile(arg, flags)
+            ok = any(isinstance(v, str) and pattern.search(v) for v in _expand(values))
+        elif op == "$options":
+            continue
+        elif op == "$type":
+            ok = any(isinstance(v, _TYPES[arg]) for v in values)
+        elif op == "$size":
+            ok = any(isinstance(v, list) and len(v) == arg for v in values)
+        elif op == "$all":
+            ok = all(_match_condition(values, item) for item in arg)
+        elif op == "$elemMatch":
+            ok = any(
+                isinstance(v, list) and any(_matches_element(item, arg) for item in v)
+                for v in values
+            )
+        else:
+            raise NotImplementedError(f"Query operator {op} is not supported by FakeDatabase")
+        if not ok:
+            return False
+    return True
+
+def _matches_element(item, condition) -> bool:
+    if isinstance(item, dict) and not all(k.startswith("$") for k in condition):
+        return matches(item, condition)
+    return _match_condition([item], condition)
+
+def matches(doc: dict, query: dict) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(doc, q) for q in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, q) for q in condition):
+                return False
+        elif not _match_condition(_values(doc, key), condition):
+            return False
+    return True
+
+# ---------- projection ----------
+
+def _include(source: dict, target: dict, parts: list):
+    head = parts[0]
+    if head not in source:
+        return
+    if len(parts) == 1:
+        target[head] = copy.deepcopy(source[head])
+        return
+    value = source[head]
+    if isinstance(value, dict):
+        _include(value, target.setdefault(head, {}), parts[1:])
+    elif isinstance(value, list):
+        existing = target.setdefault(head, [{} for _ in value])
+        for item, out in zip(value, existing):
+            if isinstance(item, dict):
+                _include(item, out, parts[1:])
+
+def project(doc: dict, projection) -> dict:
+    if not projection:
+        return copy.deepcopy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+
+    operators = {k: v for k, v in projection.items() if isinstance(v, dict)}
+    plain = {k: v for k, v in projection.items() if not isinstance(v, dict)}
+    inclusion = any(v for k, v in plain.items() if k != "_id")
+
+    if inclusion:
+        result = {}
+        if plain.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        for field, value in plain.items():
+            if value and field != "_id":
+                _include(doc, result, field.split("."))
+    else:
+        result = copy.deepcopy(doc)
+        for field, value in plain.items():
+            if not value:
+                result.pop(field, None)
+
+    for field, spec in operators.items():
+        array = doc.get(field)
+        if not isinstance(array, list):
+            continue
+        if "$slice" in spec:
+            count = spec["$slice"]
+            result[field] = copy.deepcopy(array[count:] if count < 0 else array[:count])
+        elif "$elemMatch" in spec:
+            matched = [item for item in array if _matches_element(item, spec["$elemMatch"])][:1]
+            if matched:
+                result[field] = copy.deepcopy(matched)
+            else:
+                result.pop(field, None)
+    return result
+
+# ---------- updates ----------
+
+def _parent(doc: dict, path: str, create: bool):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        if part not in doc:
+            if not create:
+                return None, parts[-1]
+            doc[part] = {}
+        doc = doc[part]
+    return doc, parts[-1]
+
+def _sort_key(spec):
+    def key(value):
+        if isinstance(spec, dict):
+            return tuple(_order(value.get(field)) for field in spec)
+        return _order(value)
+    return key
+
+def apply_update(doc: dict, update: dict, inserting: bool = False):
+    if isinstance(update, list):
+        raise NotImplementedError("Pipeline updates are not supported by FakeDatabase")
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            parent, name = _parent(doc, path, create=op not in ("$unset", "$pull"))
+            if parent is None:
+                continue
+            if op == "$set":
+                parent[name] = copy.deepcopy(arg)
+            elif op == "$setOnInsert":
+                if inserting:
+                    parent[name] = copy.deepcopy(arg)
+            elif op == "$unset":
+                parent.pop(name, None)
+            elif op == "$inc":
+                parent[name] = parent.get(name, 0) + arg
+            elif op in ("$max", "$min"):
+                current = parent.get(name, _MISSING)
+                if current is _MISSING or (arg > current if op == "$max" else arg < current):
+                    parent[name] = copy.deepcopy(arg)
+            elif op == "$currentDate":
+                parent[name] = datetime.now()
+            elif op in ("$push", "$addToSet"):
+                array = parent.setdefault(name, [])
+                items = arg["$each"] if isinstance(arg, dict) and "$each" in arg else [arg]
+                for item in items:
+                    if op == "$push" or item not in array:
+                        array.append(copy.deepcopy(item))
+                if isinstance(arg, dict) and "$sort" in arg:
+                    array.sort(key=_sort_key(arg["$sort"]), reverse=not isinstance(arg["$sort"], dict) and arg["$sort"] < 0)
+            elif op == "$pull":
+                array = parent.get(name)
+                if isinstance(array, list):
+                    if isinstance(arg, dict):
+                        parent[name] = [item for item in array if not _matches_element(item, arg)]
+                    else:
+                        parent[name] = [item for item in array if item != arg]
+            else:
+                raise NotImplementedError(f"Update operator {op} is not supported by FakeDatabase")
+
+def _order(value):
+    # Missing and null sort first, like MongoDB
+    if value is None or value is _MISSING:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, ObjectId):
+        return (3, value.binary)
+    if isinstance(value, datetime):
+        return (4, value)
+    return (5, str(value))
+
+def sort_documents(docs: list, sort) -> list:
+    if not sort:
+        return docs
+    for field, direction in reversed(list(sort)):
+        docs = sorted(docs, key=lambda d: _order(next(iter(_values(d, field)), None)), reverse=direction < 0)
+    return docs
+
+def _seed_from_query(query: dict) -> dict:
+    """Equality parts of a filter, copied into a document created by an upsert"""
+    doc = {}
+    for key, value in (query or {}).items():
+        if key.startswith("$") or (isinstance(value, dict) and any(k.startswith("$") for k in value)):
+            continue
+        parent, name = _parent(doc, key, create=True)
+        parent[name] = copy.deepcopy(value)
+    return doc
+
+# ---------- Motor-like objects ----------
+
+class Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+class FakeCursor:
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction=None):
+        self._sort = [(key, direction if direction is not None else 1)] if isinstance(key, str) else list(key)
+        return self
+
+    def skip(self, count: int):
+        self._skip = count
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def batch_size(self, count: int):
+        return self
+
+    def _results(self, length=None) -> list:
+        docs = sort_documents(self.collection._matching(self.query), self._sort)[self._skip:]
+        limit = min(x for x in (self._limit, length) if x) if (self._limit or length) else None
+        if limit:
+            docs = docs[:limit]
+        return [project(doc, self.projection) for doc in docs]
+
+    async def to_list(self, length=None):
+        self.collection.database._count(self.collection.name, "find")
+        return self._results(length)
+
+    def __aiter__(self):
+        self.collection.database._count(self.collection.name, "find")
+        self._iter = iter(self._results())
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+def _field_value(doc: dict, expression):
+    if not isinstance(expression, str) or not expression.startswith("$"):
+        return expression
+    values = _values(doc, expression[1:])
+    return values[0] if values else None
+
+def run_pipeline(docs: list, pipeline: list) -> list:
+    """$match, $sort, $limit, $project, $unwind of a field and $group with $sum / $first - the stages app/ sends"""
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            docs = [doc for doc in docs if matches(doc, spec)]
+        elif name == "$sort":
+            docs = sort_documents(docs, list(spec.items()))
+        elif name == "$limit":
+            docs = docs[:spec]
+        elif name == "$project":
+            docs = [project(doc, spec) for doc in docs]
+        elif name == "$unwind":
+            field = spec[1:]
+            docs = [{**doc, field: item} for doc in docs for item in (doc.get(field) or [])]
+        elif name == "$group":
+            groups = {}
+            for doc in docs:
+                key = _field_value(doc, spec["_id"])
+                new = key not in groups
+                group = groups.setdefault(key, {"_id": key})
+                for field, accumulator in spec.items():
+                    if field == "_id":
+                        continue
+                    (operator, expression), = accumulator.items()
+                    if operator == "$sum":
+                        group[field] = group.get(field, 0) + _field_value(doc, expression)
+                    elif operator == "$first":
+                        if new:
+                            group[field] = _field_value(doc, expression)
+                    else:
+                        raise NotImplementedError(f"Accumulator {operator} is not supported by FakeDatabase")
+            docs = list(groups.values())
+        else:
+            raise NotImplementedError(f"Pipeline stage {name} is not supported by FakeDatabase")
+    return docs
+
+class FakeAggregateCursor:
+    def __init__(self, collection, pipeline: list):
+        self.collection = collection
+        self.pipeline = pipeline
+
+    async def to_list(self, length=None):
+        self.collection.database._count(self.collection.name, "aggregate")
+        results = run_pipeline(list(self.collection.documents.values()), self.pipeline)
+        return results[:length] if length else results
+
+class FakeCollection:
+    def __init__(self, database, name: str):
+        self.database = database
+        self.name = name
+        self.documents = {}  # _id -> document, in insertion order
+        self.unique_indexes = []  # [(fields, partial filter, {key: _id})]
+
+    def _matching(self, query: dict) -> list:
+        _id = (query or {}).get("_id", _MISSING)
+        if _id is not _MISSING and not isinstance(_id, dict):
+            doc = self.documents.get(_id)
+            return [doc] if doc is not None and matches(doc, query) else []
+        return [doc for doc in self.documents.values() if matches(doc, query)]
+
+    def _index_key(self, fields, partial, doc):
+        if partial and not matches(doc, partial):
+            return None
+        return tuple(repr(next(iter(_values(doc, field)), None)) for field in fields)
+
+    def _check_unique(self, doc):
+        for fields, partial, entries in self.unique_indexes:
+            key = self._index_key(fields, partial, doc)
+            if key is not None and entries.get(key, doc["_id"]) != doc["_id"]:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {fields}", 11000)
+
+    def _reindex(self, doc, old=None):
+        for fields, partial, entries in self.unique_indexes:
+            if old is not None:
+                old_key = self._index_key(fields, partial, old)
+                if old_key is not None and entries.get(old_key) == old["_id"]:
+                    del entries[old_key]
+            if doc is not None:
+                key = self._index_key(fields, partial, doc)
+                if key is not None:
+                    entries[key] = doc["_id"]
+
+    def _insert(self, doc: dict):
+        doc = copy.deepcopy(doc)
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self.documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_", 11000)
+        self._check_unique(doc)
+        self.documents[doc["_id"]] = doc
+        self._reindex(doc)
+        return doc
+
+    def _update(self, doc: dict, update: dict):
+        updated = copy.deepcopy(doc)
+        apply_update(updated, update)
+        self._check_unique(updated)
+        self._reindex(updated, old=doc)
+        self.documents[doc["_id"]] = updated
+        return updated
+
+    def _upsert(self, query: dict, update: dict):
+        doc = _seed_from_query(query)
+        apply_update(doc, update, inserting=True)
+        return self._insert(doc)
+
+    def find(self, query=None, projection=None, **kwargs):
+        return FakeCursor(self, query, projection)
+
+    async def find_one(self, query=None, projection=None, sort=None, **kwargs):
+        self.database._count(self.name, "find_one")
+        docs = sort_documents(self._matching(query), sort)
+        return project(docs[0], projection) if docs else None
+
+    async def insert_one(self, doc: dict, **kwargs):
+        self.database._count(self.name, "insert_one")
+        inserted = self._insert(doc)
+        doc.setdefault("_id", inserted["_id"])
+        return Result(inserted_id=inserted["_id"], acknowledged=True)
+
+    async def insert_many(self, docs: list, ordered: bool = True, **kwargs):
+        self.database._count(self.name, "insert_many")
+        ids = []
+        for doc in docs:
+            inserted = self._insert(doc)
+            doc.setdefault("_id", inserted["_id"])
+            ids.append(inserted["_id"])
+        return Result(inserted_ids=ids, acknowledged=True)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False, **kwargs):
+        self.database._count(self.name, "update_one")
+        docs = self._matching(query)
+        if docs:
+            self._update(docs[0], update)
+            return Result(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            return Result(matched_count=0, modified_count=0, upserted_id=self._upsert(query, update)["_id"])
+        return Result(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def update_many(self, query: dict, update: dict, upsert: bool = False, **kwargs):
+        self.database._count(self.name, "update_many")
+        docs = self._matching(query)
+        for doc in docs:
+            self._update(doc, update)
+        return Result(matched_count=len(docs), modified_count=len(docs), upserted_id=None)
+
+    async def find_one_and_update(self, query: dict, update: dict, projection=None, sort=None,
+                                  upsert: bool = False, return_document=ReturnDocument.BEFORE, **kwargs):
+        self.database._count(self.name, "find_one_and_update")
+        docs = sort_documents(self._matching(query), sort)
+        if docs:
+            updated = self._update(docs[0], update)
+            return project(updated if return_document == ReturnDocument.AFTER else docs[0], projection)
+        if upsert:
+            inserted = self._upsert(query, update)
+            return project(inserted, projection) if return_document == ReturnDocument.AFTER else None
+        return None
+
+    async def delete_one(self, query: dict, **kwargs):
+        self.database._count(self.name, "delete_one")
+        docs = self._matching(query)[:1]
+        for doc in docs:
+            self._reindex(None, old=doc)
+            del self.documents[doc["_id"]]
+        return Result(deleted_count=len(docs))
+
+    async def delete_many(self, query: dict, **kwargs):
+        self.database._count(self.name, "delete_many")
+        docs = self._matching(query)
+        for doc in docs:
+            self._reindex(None, old=doc)
+            del self.documents[doc["_id"]]
+        return Result(deleted_count=len(docs))
+
+    async def bulk_write(self, requests: list, ordered: bool = True, **kwargs):
+        """InsertOne, UpdateOne and DeleteOne requests, in one round trip"""
+        self.database._count(self.name, "bulk_write")
+        inserted = upserted = modified = deleted = 0
+        for request in requests:
+            if isinstance(request, InsertOne):
+                self._insert(request._doc)
+                inserted += 1
+            elif isinstance(request, UpdateOne):
+                docs = self._matching(request._filter)
+                if docs:
+                    self._update(docs[0], request._doc)
+                    modified += 1
+                elif request._upsert:
+                    self._upsert(request._filter, request._doc)
+                    upserted += 1
+            elif isinstance(request, DeleteOne):
+                docs = self._matching(request._filter)[:1]
+                for doc in docs:
+                    self._reindex(None, old=doc)
+                    del self.documents[doc["_id"]]
+                deleted += len(docs)
+            else:
+                raise NotImplementedError(f"{type(request).__name__} is not supported by FakeDatabase")
+        return Result(inserted_count=inserted, upserted_count=upserted, modified_count=modified, deleted_count=deleted)
+
+    def aggregate(self, pipeline: list, **kwargs):
+        return FakeAggregateCursor(self, pipeline)
+
+    async def count_documents(self, query: dict, **kwargs):
+        self.database._count(self.name, "count_documents")
+        return len(self._matching(query))
+
+    async def create_index(self, keys, unique: bool = False, partialFilterExpression=None, **kwargs):
+        self.database._count(self.name, "create_index")
+        fields = [keys] if isinstance(keys, str) else [field for field, _ in keys]
+        if unique and not any(existing[0] == fields for existing in self.unique_indexes):
+            entries = {}
+            for doc in self.documents.values():
+                key = self._index_key(fields, partialFilterExpression, doc)
+                if key is not None:
+                    entries[key] = doc["_id"]
+            self.unique_indexes.append((fields, partialFilterExpression, entries))
+        return "_".join(fields)
+
+class FakeDatabase:
+    """Stands in for a Motor database; with_options() returns the same database"""
+    def __init__(self, name: str = "chatapp"):
+        self.name = name
+        self._collections = {}
+        self.round_trips = Counter()  # (collection, operation) -> count
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self, name)
+        return self._collections[name]
+
+    def _count(self, collection: str, operation: str):
+        self.round_trips[(collection, operation)] += 1
+
+    def reset_round_trips(self):
+        self.round_trips = Counter()
+
+    def with_options(self, **kwargs):
+        return self
+
+    async def list_collection_names(self):
+        self._count("", "listCollections")
+        return list(self._collections)
+
+    async def create_collection(self, name: str, **kwargs):
+        self._count("", "create")
+        return self[name]
+
+    async def command(self, name, *args, **kwargs):
+        self._count("", name if isinstance(name, str) else next(iter(name)))
+        return {"ok": 1.0}
+
+class FakeWebSocket:
+    """Stands in for starlette's WebSocket: counts what is sent, send_json encodes like starlette does"""
+    def __init__(self):
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, data):
+        await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+    async def send_text(self, data):
+        self.frames_sent += 1
+        self.bytes_sent += len(data)
+
+    async def send_bytes(self, data):
+        self.frames_sent += 1
+        self.bytes_sent += len(data)
+
+    async def close(self, code: int = 1000, reason: str = None):
+        self.closed = True
@@ -0,0 +1,101 @@
+"""
+CPU cost of fanning out one chat event to every socket of a group.
+
+Compares the previous path (send_json per socket, envelope re-encoded per
+global socket) with ConnectionManager.broadcast, which encodes once.
+
+Run from the backend directory:
+    python -m benchmarks.fanout_benchmark
+"""
+
+import asyncio
+import json
+import time
+from datetime import datetime
+
+from bson import ObjectId
+
+import app.main as main
+from app.main import ConnectionManager
+
+GROUP_SIZES = [10, 100, 1000]
+ROUNDS = 200
+
+class FakeWebSocket:
+    """Stands in for starlette's WebSocket: send_json encodes like starlette does"""
+    def __init__(self):
+        self.bytes_sent = 0
+
+    async def send_json(self, data):
+        await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+    async def send_text(self, data):
+        self.bytes_sent += len(data)
+
+class FakeChats:
+    def __init__(self, participants):
+        self.chat = {"_id": ObjectId(), "participants": participants}
+
+    async def find_one(self, *args, **kwargs):
+        return self.chat
+
+class FakeDatabase:
+    def __init__(self, participants):
+        self.chats = FakeChats(participants)
+
+def make_message(chat_id):
+    return {
+        "id": str(ObjectId()),
+        "chat_id": chat_id,
+        "sender_id": str(ObjectId()),
+        "sender_name": "Sender Name",
+        "message_type": "text",
+        "content": "Hello everyone, this is a message of ordinary length.",
+        "file_url": None,
+        "reply_to": None,
+        "reply_to_message": None,
+        "edited_at": None,
+        "is_deleted": False,
+        "status": "sent",
+        "reactions": {},
+        "seq": 1234,
+        "created_at": datetime.now().isoformat()
+    }
+
+async def legacy_broadcast(manager, message, chat_id, participants):
+    """The fan-out as it was: one encoding per chat socket and per global socket"""
+    for connection in manager.active_connections.get(chat_id, []):
+        await connection.send_json(message)
+    envelope = {"type": "new_message", "chat_id": chat_id, "message": message}
+    for participant_id in participants:
+        if participant_id in manager.global_connections:
+            await manager.global_connections[participant_id].send_json(envelope)
+
+def setup(group_size):
+    chat_id = str(ObjectId())
+    participants = [str(ObjectId()) for _ in range(group_size)]
+    manager = ConnectionManager()
+    # Every member has the chat open and the chat list socket connected
+    manager.active_connections[chat_id] = [FakeWebSocket() for _ in participants]
+    manager.global_connections = {pid: FakeWebSocket() for pid in participants}
+    return manager, chat_id, participants
+
+async def measure(broadcast, rounds):
+    start = time.process_time()
+    for _ in range(rounds):
+        await broadcast()
+    return (time.process_time() - start) / rounds * 1000
+
+async def run():
+    print(f"{'members':>8} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for group_size in GROUP_SIZES:
+        manager, chat_id, participants = setup(group_size)
+        main.get_database = lambda: FakeDatabase(participants)
+        message = make_message(chat_id)
+        
+        before = await measure(lambda: legacy_broadcast(manager, message, chat_id, participants), ROUNDS)
+        after = await measure(lambda: manager.broadcast(message, chat_id), ROUNDS)
+        print(f"{group_size:>8} {before:>10.3f} {after:>10.3f} {before / after:>7.1f}x")
+
+if __name__ == "__main__":
+    asyncio.run(run())
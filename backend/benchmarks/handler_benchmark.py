@@ -0,0 +1,268 @@
+"""
+Round trips and CPU time of the hot handlers, without a MongoDB.
+
+Runs the handlers in app.main against benchmarks.fakes.FakeDatabase at
+realistic sizes. Round trips are exact and checked against
+benchmarks/budgets.json; CPU time per call (handler plus the in-memory
+driver) is checked with a tolerance, since it depends on the machine.
+Exits with status 1 when a budget is exceeded, so it can gate CI; the
+round-trip budgets are also checked by tests/test_handler_budgets.py.
+
+Run from the backend directory:
+    python -m benchmarks.handler_benchmark [--iterations 10] [--cpu-tolerance 2.0] [--update-budgets]
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import app.database as database
+import app.login_strategy as login_strategy
+import app.main as main
+import app.recent_messages as recent_messages
+import app.tasks as tasks
+from app.models import User
+from benchmarks.fakes import FakeDatabase, FakeWebSocket
+
+BUDGETS_FILE = Path(__file__).with_name("budgets.json")
+WORDS = "hello there how are you doing today lets meet at the office tomorrow morning".split()
+
+def make_user(db, index: int) -> dict:
+    return db.users._insert({
+        "username": f"user{index}",
+        "email": f"user{index}@example.com",
+        "password": "x",
+        "full_name": f"User {index}",
+        "profile_image": None,
+        "is_online": False,
+        "last_seen": None,
+        "created_at": datetime.now()
+    })
+
+def make_chat(db, participants: list, chat_type: str = "group") -> str:
+    chat = db.chats._insert({
+        "chat_type": chat_type,
+        "group_name": "Group" if chat_type == "group" else None,
+        "group_image": None,
+        "participants": participants,
+        "admins": participants[:1],
+        "created_by": participants[0],
+        "created_at": datetime.now()
+    })
+    for user_id in participants:
+        db.chat_members._insert({
+            "user_id": user_id,
+            "chat_id": str(chat["_id"]),
+            "role": "admin" if user_id == participants[0] else "member",
+            "archived": False,
+            "last_activity": chat["created_at"],
+            "last_read_seq": 0,
+            "joined_at": chat["created_at"]
+        })
+    return str(chat["_id"])
+
+def make_messages(db, chat_id: str, senders: list, count: int, reader: str):
+    start = datetime.now() - timedelta(minutes=count)
+    previous = None
+    for seq in range(1, count + 1):
+        sender = senders[seq % len(senders)]
+        reply = previous if previous and seq % 10 == 0 else None
+        doc = db.messages._insert({
+            "chat_id": chat_id,
+            "sender_id": sender,
+            "message_type": "text",
+            "content": " ".join(random.choices(WORDS, k=8)),
+            "file_url": None,
+            "reply_to": str(reply["_id"]) if reply else None,
+            "reply_to_message": {
+                "id": str(reply["_id"]), "sender_id": reply["sender_id"], "sender_name": "User",
+                "content": reply["content"], "message_type": "text"
+            } if reply else None,
+            "edited_at": None,
+            "is_deleted": False,
+            "status": "sent",
+            "reactions": {},
+            # The reader has read all but the last few
+            "read_by": [reader] if seq < count - 3 else [],
+            "seq": seq,
+            "created_at": start + timedelta(minutes=seq)
+        })
+        previous = doc
+    db.counters._insert({"_id": f"chat:{chat_id}", "seq": count})
+    for member in db.chat_members.documents.values():
+        if member["chat_id"] == chat_id:
+            member["last_activity"] = previous["created_at"]
+
+def as_user(doc: dict) -> User:
+    return User(**{**doc, "id": str(doc["_id"])})
+
+def use_database(db):
+    """Point every get_database() the handlers reach at the in-memory stand-in"""
+    get = lambda profile=None: db
+    database.get_database = get
+    main.get_database = get
+    login_strategy.get_database = get
+
+async def build(db):
+    """One user with 80 direct chats and 20 groups, a busy group and a 1,000-member group"""
+    random.seed(7)
+    await main.ensure_indexes()
+
+    users = [make_user(db, i) for i in range(1000)]
+    ids = [str(u["_id"]) for u in users]
+    me = ids[0]
+
+    for i in range(80):
+        chat_id = make_chat(db, [me, ids[1 + i]], "single")
+        make_messages(db, chat_id, [me, ids[1 + i]], 30, me)
+    for i in range(20):
+        members = [me] + ids[100 + i * 19:100 + (i + 1) * 19]
+        make_messages(db, make_chat(db, members), members, 30, me)
+
+    busy_members = [me] + ids[500:519]
+    busy_chat = make_chat(db, busy_members)
+    make_messages(db, busy_chat, busy_members, 500, me)
+
+    big_chat = make_chat(db, ids)
+    return {"me": as_user(users[0]), "busy_chat": busy_chat, "big_chat": big_chat, "big_members": ids}
+
+def connect_sockets(chat_id: str, members: list):
+    """Every member has the chat open and the chat list socket connected"""
+    manager = main.manager
+    manager.active_connections = {chat_id: [FakeWebSocket() for _ in members]}
+    manager.global_connections = {member: FakeWebSocket() for member in members}
+
+def scenarios(data: dict) -> dict:
+    me = data["me"]
+    busy, big = data["busy_chat"], data["big_chat"]
+
+    async def send_message():
+        connect_sockets(busy, [str(me.id)] + data["big_members"][500:519])
+        await main.send_message(busy, "hello there", current_user=me)
+
+    async def first_page_from_database():
+        recent_messages.cache.clear()
+        await main.get_messages(busy, limit=50, skip=0, current_user=me, if_none_match=None)
+
+    async def broadcast_big_group():
+        connect_sockets(big, data["big_members"])
+        await main.manager.broadcast({"type": "typing", "chat_id": big, "user_id": str(me.id), "is_typing": True}, big)
+
+    return {
+        "get_user_chats (100 chats)": lambda: main.get_user_chats(current_user=me, if_none_match=None),
+        "get_user_chats (304)": lambda: main.get_user_chats(current_user=me, if_none_match=data["chat_list_etag"]),
+        "get_messages (page of 50)": first_page_from_database,
+        # Cached by the scenario before
+        "get_messages (cached page)": lambda: main.get_messages(busy, limit=50, skip=0, current_user=me, if_none_match=None),
+        "get_messages (deep page)": lambda: main.get_messages(busy, limit=50, skip=400, current_user=me, if_none_match=None),
+        "search_messages": lambda: main.search_messages(busy, "meet", current_user=me),
+        "send_message (20 members)": send_message,
+        "broadcast (1000 members)": broadcast_big_group,
+    }
+
+async def settle():
+    """Wait for work the handler left behind (delivery receipts, reply previews) so it counts too"""
+    current = asyncio.current_task()
+    while True:
+        await tasks.runner.join()
+        # The runner's workers never finish; everything else spawned must
+        workers = set(tasks.runner._workers)
+        pending = [task for task in asyncio.all_tasks() if task is not current and task not in workers]
+        if not pending and not tasks.runner.queued:
+            return
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def measure(db, call, iterations: int) -> dict:
+    db.reset_round_trips()
+    await call()
+    await settle()
+    round_trips = sum(db.round_trips.values())
+    by_collection = {}
+    for (collection, operation), count in sorted(db.round_trips.items()):
+        by_collection[f"{collection}.{operation}" if collection else operation] = count
+
+    # A full collection of the seeded database would land in whichever iteration triggers it
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.process_time()
+        for _ in range(iterations):
+            await call()
+            await settle()
+        cpu_ms = (time.process_time() - start) / iterations * 1000
+    finally:
+        gc.enable()
+    return {"round_trips": round_trips, "cpu_ms": cpu_ms, "by_collection": by_collection}
+
+async def run(iterations: int):
+    db = FakeDatabase()
+    use_database(db)
+    # Background work runs on this loop's workers, as under the app's lifespan
+    tasks.runner.start()
+    try:
+        data = await build(db)
+        response = await main.get_user_chats(current_user=data["me"], if_none_match=None)
+        data["chat_list_etag"] = response.headers["etag"]
+        results = {}
+        for name, call in scenarios(data).items():
+            results[name] = await measure(db, call, iterations)
+        return results
+    finally:
+        await tasks.runner.drain()
+
+def check(results: dict, budgets: dict, cpu_tolerance: float) -> list:
+    failures = []
+    for name, result in results.items():
+        budget = budgets.get(name)
+        if not budget:
+            continue
+        if result["round_trips"] > budget["round_trips"]:
+            failures.append(f"{name}: {result['round_trips']} round trips, budget {budget['round_trips']}")
+        if cpu_tolerance and result["cpu_ms"] > budget["cpu_ms"] * cpu_tolerance:
+            failures.append(f"{name}: {result['cpu_ms']:.2f} ms CPU, budget {budget['cpu_ms']:.2f} ms x {cpu_tolerance}")
+    return failures
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--cpu-tolerance", type=float, default=2.0,
+                        help="fail when CPU time exceeds the budget by this factor (0 = don't check CPU)")
+    parser.add_argument("--update-budgets", action="store_true", help="write the measured values as the new budgets")
+    parser.add_argument("--verbose", action="store_true", help="show round trips per collection")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.iterations))
+
+    print(f"{'handler':>28} {'round trips':>12} {'CPU ms':>9}")
+    for name, result in results.items():
+        print(f"{name:>28} {result['round_trips']:>12} {result['cpu_ms']:>9.2f}")
+        if args.verbose:
+            for operation, count in result["by_collection"].items():
+                print(f"{'':>30}{operation}: {count}")
+
+    if args.update_budgets:
+        budgets = {
+            name: {"round_trips": result["round_trips"], "cpu_ms": round(result["cpu_ms"], 2)}
+            for name, result in results.items()
+        }
+        BUDGETS_FILE.write_text(json.dumps(budgets, indent=2) + "\n")
+        print(f"\n✨ Budgets written to {BUDGETS_FILE}")
+        return
+
+    budgets = json.loads(BUDGETS_FILE.read_text()) if BUDGETS_FILE.exists() else {}
+    failures = check(results, budgets, args.cpu_tolerance)
+    if failures:
+        print("\n❌ Over budget:")
+        for failure in failures:
+            print(f"   {failure}")
+        sys.exit(1)
+    print("\n✅ Within budget")
+
+if __name__ == "__main__":
+    main_cli()
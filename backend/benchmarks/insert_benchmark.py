@@ -0,0 +1,104 @@
+"""
+Insert throughput and latency: one insert_one per message vs the batched write pipeline.
+
+Many concurrent senders insert messages into a handful of busy chats, the
+way send_message does during a big event. Needs a running MongoDB
+(MONGODB_URL); the scratch database is dropped afterwards.
+
+Run from the backend directory:
+    python -m benchmarks.insert_benchmark [--messages 20000] [--concurrency 200] [--windows 1,2,5]
+"""
+
+import argparse
+import asyncio
+import itertools
+import statistics
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app import write_pipeline
+from app.database import MONGODB_URL, DATABASE_NAME
+
+CHATS = 10
+
+def make_message(chat_id: str, sender_id: str, seq: int) -> dict:
+    return {
+        "chat_id": chat_id,
+        "sender_id": sender_id,
+        "message_type": "text",
+        "content": f"Message number {seq} of an ordinary length.",
+        "file_url": None,
+        "reply_to": None,
+        "reply_to_message": None,
+        "edited_at": None,
+        "is_deleted": False,
+        "status": "sent",
+        "reactions": {},
+        "read_by": [],
+        "seq": seq,
+        "client_msg_id": str(ObjectId()),
+        "created_at": datetime.now()
+    }
+
+async def run_mode(db, count: int, concurrency: int, window_ms: float = None):
+    await db.messages.drop()
+    await db.messages.create_index([("chat_id", 1), ("created_at", -1)])
+    await db.messages.create_index(
+        [("sender_id", 1), ("client_msg_id", 1)],
+        unique=True,
+        partialFilterExpression={"client_msg_id": {"$exists": True}}
+    )
+    chats = [str(ObjectId()) for _ in range(CHATS)]
+    seqs = {chat_id: itertools.count(1) for chat_id in chats}
+    batcher = write_pipeline.InsertBatcher(window_ms=window_ms) if window_ms is not None else None
+    timings = []
+    remaining = iter(range(count))
+
+    async def sender(sender_id: str):
+        for i in remaining:
+            chat_id = chats[i % CHATS]
+            doc = make_message(chat_id, sender_id, next(seqs[chat_id]))
+            start = time.perf_counter()
+            if batcher:
+                await batcher.insert(db.messages, doc)
+            else:
+                await db.messages.insert_one(doc)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[sender(str(ObjectId())) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    assert await db.messages.count_documents({}) == count
+
+    timings.sort()
+    return {
+        "per_second": count / elapsed,
+        "p50": statistics.median(timings),
+        "p99": timings[int(len(timings) * 0.99) - 1]
+    }
+
+async def run(count: int, concurrency: int, windows: list):
+    client = AsyncIOMotorClient(MONGODB_URL, maxPoolSize=max(100, concurrency))
+    db = client[f"{DATABASE_NAME}_bench_inserts"]
+    await client.drop_database(db.name)
+    print(f"{count} messages from {concurrency} concurrent senders into {CHATS} chats")
+    print(f"{'path':>18} {'msgs/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    try:
+        modes = [("insert_one", None)] + [(f"batched {w:g} ms", w) for w in windows]
+        for name, window_ms in modes:
+            result = await run_mode(db, count, concurrency, window_ms)
+            print(f"{name:>18} {result['per_second']:>9.0f} {result['p50']:>8.2f} {result['p99']:>8.2f}")
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--windows", default="1,2,5", help="batch windows to try, in milliseconds")
+    args = parser.parse_args()
+    asyncio.run(run(args.messages, args.concurrency, [float(w) for w in args.windows.split(",")]))
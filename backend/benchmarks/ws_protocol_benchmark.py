@@ -0,0 +1,117 @@
+"""
+Bytes per WebSocket event and encode cost: JSON text frames vs the MessagePack subprotocol.
+
+Encodes typical events the way the server sends them - a new message in a
+group (with a reply preview), an edit, a reaction, a read receipt, typing
+and presence frames, the chat-list envelope and a resume batch - and
+prints the frame size in each format plus the time to build it. No
+database needed.
+
+Run from the backend directory:
+    python -m benchmarks.ws_protocol_benchmark [--iterations 20000] [--threshold 512]
+"""
+
+import argparse
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import orjson
+from bson import ObjectId
+
+from app import ws_protocol
+from app.serialization import encode_frame, encode_global_frame, encode_sync_batch
+
+def new_message(chat_id: str, seq: int, content: str, reply: bool = False) -> dict:
+    created_at = datetime(2026, 3, 14, 9, 26, 53, 589000) + timedelta(seconds=seq)
+    return {
+        "id": str(ObjectId()),
+        "chat_id": chat_id,
+        "sender_id": str(ObjectId()),
+        "sender_name": "Samira Rahimi",
+        "message_type": "text",
+        "content": content,
+        "file_url": None,
+        "reply_to": str(ObjectId()) if reply else None,
+        "reply_to_message": {
+            "id": str(ObjectId()),
+            "sender_id": str(ObjectId()),
+            "sender_name": "Daniel Okafor",
+            "content": "Are we still on for the release review tomorrow?",
+            "message_type": "text"
+        } if reply else None,
+        "edited_at": None,
+        "is_deleted": False,
+        "status": "sent",
+        "reactions": {},
+        "seq": seq,
+        "client_msg_id": str(ObjectId()),
+        "created_at": created_at.isoformat(),
+        "event_seq": seq + 40
+    }
+
+def events() -> dict:
+    chat_id = str(ObjectId())
+    message = new_message(chat_id, 1204, "Yes - 10:30 in the big room, I'll bring the rollout plan.", reply=True)
+    message_frame = encode_frame(message)
+    edited = dict(message, content="Yes - 11:00 in the big room.", edited_at=datetime(2026, 3, 14, 9, 28, 1).isoformat())
+    batch = {
+        "frames": [encode_frame(new_message(chat_id, seq, f"Catching up on message {seq}, nothing unusual in it.")) for seq in range(1, 51)],
+        "last_seq": 50,
+        "has_more": False,
+        "reset": False
+    }
+    return {
+        "new_message": message_frame,
+        "message_edited": encode_frame({"type": "message_edited", "message": edited, "event_seq": 1245}),
+        "message_reaction": encode_frame({
+            "type": "message_reaction", "message_id": message["id"], "chat_id": chat_id,
+            "emoji": "👍", "user_id": str(ObjectId()), "added": True, "count": 3, "event_seq": 1246
+        }),
+        "message_status": encode_frame({
+            "type": "message_status", "chat_id": chat_id, "message_id": message["id"],
+            "status": "read", "user_id": str(ObjectId()), "event_seq": 1247
+        }),
+        "typing": encode_frame({"type": "typing", "chat_id": chat_id, "user_id": str(ObjectId()), "is_typing": True}),
+        "user_status": encode_frame({"type": "user_status", "chat_id": chat_id, "user_id": str(ObjectId()), "is_online": False}),
+        "chat list envelope": encode_global_frame("new_message", chat_id, message_frame),
+        "resume (50 messages)": encode_sync_batch(chat_id, batch)
+    }
+
+def deflated_size(data: bytes) -> int:
+    """Size after raw deflate, as permessage-deflate without context takeover would send it"""
+    compressor = zlib.compressobj(wbits=-15)
+    return len(compressor.compress(data) + compressor.flush())
+
+def per_call_us(call, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call()
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+def run(iterations: int, threshold: int):
+    print(f"Deflate threshold {threshold} bytes, {iterations} encodes per event")
+    print(f"{'event':>22} {'json':>7} {'json+defl':>10} {'msgpack':>8} {'binary':>7} {'saved':>6} {'json us':>8} {'pack us':>8}")
+    for name, text in events().items():
+        json_bytes = len(text.encode())
+        ws_protocol.WS_DEFLATE_THRESHOLD_BYTES = 0
+        msgpack_bytes = len(ws_protocol.Frame(text).packed())
+        ws_protocol.WS_DEFLATE_THRESHOLD_BYTES = threshold
+        binary_bytes = len(ws_protocol.Frame(text).packed())
+
+        # The JSON frame is built once per broadcast either way; the binary form is built from it
+        event = orjson.loads(text)
+        json_us = per_call_us(lambda: encode_frame(event), iterations)
+        pack_us = per_call_us(lambda: ws_protocol.Frame(text).packed(), iterations)
+        print(
+            f"{name:>22} {json_bytes:>7} {deflated_size(text.encode()):>10} {msgpack_bytes:>8} {binary_bytes:>7}"
+            f" {1 - binary_bytes / json_bytes:>6.0%} {json_us:>8.1f} {pack_us:>8.1f}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--threshold", type=int, default=ws_protocol.WS_DEFLATE_THRESHOLD_BYTES,
+                        help="deflate binary bodies larger than this many bytes")
+    args = parser.parse_args()
+    run(args.iterations, args.threshold)
@@ -0,0 +1,385 @@
+"""
+Load generator for the chat backend: REST traffic plus held-open /ws/global
+and /ws/{chat_id} sockets, driven by a JSON scenario file.
+
+Start the backend first (docker-compose up, or python run.py with a local
+mongod), then from the backend directory:
+    pip install -r loadtest/requirements.txt
+    python -m loadtest.run loadtest/scenarios/group_1000.json [--base-url http://localhost:8009] [--json report.json]
+
+Users are named lt_<n> and reused across runs; chats are created per run.
+Sockets per GB comes from the server's /metrics, so run the backend with a
+single worker for that figure to mean anything.
+
+Scenario keys (all optional except users):
+    users                  number of simulated users
+    groups                 [{"members": 1000, "count": 1}] - group chats, members include the creator
+    direct_chats           {"owners": 1, "per_owner": 500} - single chats of the first users
+    sockets                {"global": true, "chat": true, "max_chat_sockets_per_user": 5}
+    traffic                {"duration_seconds": 60, "senders": 20, "messages_per_second": 10,
+                            "typing": true, "read_ratio": 0.1}
+    chat_list              {"users": 1, "fetches_per_second": 5}
+    reconnect_storm        {"at_seconds": 20, "jitter_ms": 0, "refetch": true}
+"""
+
+import argparse
+import asyncio
+import random
+import re
+import resource
+import statistics
+import time
+import uuid
+
+import httpx
+import orjson
+import websockets
+
+PASSWORD = "loadtest-password"
+CONTENT_PREFIX = "lt|"
+
+class Stats:
+    def __init__(self):
+        self.samples = {}
+        self.counters = {}
+
+    def add(self, name: str, seconds: float):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self) -> dict:
+        result = {}
+        for name, values in self.samples.items():
+            values = sorted(values)
+            result[name] = {
+                "count": len(values),
+                "p50_ms": statistics.median(values) * 1000,
+                "p99_ms": values[max(0, int(len(values) * 0.99) - 1)] * 1000,
+                "max_ms": values[-1] * 1000
+            }
+        return result
+
+def parse_metrics(text: str) -> dict:
+    """Unlabelled gauges of the Prometheus text format"""
+    values = {}
+    for match in re.finditer(r"^([a-z_]+) ([0-9.e+-]+)$", text, re.MULTILINE):
+        values[match.group(1)] = float(match.group(2))
+    return values
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+class LoadTest:
+    def __init__(self, scenario: dict, base_url: str, concurrency: int):
+        self.scenario = scenario
+        self.base_url = base_url.rstrip("/")
+        self.ws_url = re.sub(r"^http", "ws", self.base_url)
+        self.http = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=60,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        )
+        self.setup_limit = asyncio.Semaphore(concurrency)
+        self.stats = Stats()
+        self.users = []  # {"username", "id", "token"}
+        self.chats = []  # {"id", "members": [user index]}
+        self.user_chats = {}  # user index -> [chat ids]
+        self.sockets = []  # (user index, chat_id or None, websocket, reader task)
+        self.stopping = False
+        self.run_id = uuid.uuid4().hex[:8]
+
+    def headers(self, user: int) -> dict:
+        return {"Authorization": f"Bearer {self.users[user]['token']}"}
+
+    # ---------- setup ----------
+
+    async def login_or_register(self, index: int) -> dict:
+        username = f"lt_{index}"
+        email = f"{username}@loadtest.example.com"
+        async with self.setup_limit:
+            response = await self.http.post("/api/auth/login", json={"email": email, "password": PASSWORD})
+            if response.status_code != 200:
+                response = await self.http.post(
+                    "/api/auth/register", json={"username": username, "email": email, "password": PASSWORD}
+                )
+            response.raise_for_status()
+        data = response.json()
+        return {"username": username, "id": data["user"]["id"], "token": data["access_token"]}
+
+    async def create_group(self, members: list) -> dict:
+        async with self.setup_limit:
+            response = await self.http.post(
+                "/api/chats/group",
+                data={
+                    "name": f"loadtest {self.run_id}",
+                    "participant_emails": ",".join(self.users[m]["username"] for m in members[1:])
+                },
+                headers=self.headers(members[0])
+            )
+        response.raise_for_status()
+        return {"id": response.json()["chat_id"], "members": members}
+
+    async def create_direct_chat(self, owner: int, other: int) -> dict:
+        async with self.setup_limit:
+            response = await self.http.post(
+                "/api/chats/single",
+                params={"identifier": self.users[other]["username"]},
+                headers=self.headers(owner)
+            )
+        response.raise_for_status()
+        return {"id": response.json()["chat_id"], "members": [owner, other]}
+
+    async def setup(self):
+        count = self.scenario["users"]
+        start = time.perf_counter()
+        self.users = await asyncio.gather(*(self.login_or_register(i) for i in range(count)))
+        print(f"👥 {count} users ready in {time.perf_counter() - start:.1f}s")
+
+        tasks = []
+        offset = 0
+        for group in self.scenario.get("groups", []):
+            for _ in range(group.get("count", 1)):
+                members = [(offset + i) % count for i in range(min(group["members"], count))]
+                offset = (offset + len(members)) % count
+                tasks.append(self.create_group(members))
+        direct = self.scenario.get("direct_chats")
+        if direct:
+            for owner in range(direct.get("owners", 1)):
+                for i in range(direct["per_owner"]):
+                    other = (owner + 1 + i) % count
+                    if other != owner:
+                        tasks.append(self.create_direct_chat(owner, other))
+        self.chats = await asyncio.gather(*tasks)
+        for chat in self.chats:
+            for member in chat["members"]:
+                self.user_chats.setdefault(member, []).append(chat["id"])
+        print(f"💬 {len(self.chats)} chats ready")
+
+    # ---------- sockets ----------
+
+    async def read_socket(self, user: int, chat_id, websocket, measure: bool):
+        """Record fan-out latency of load test messages and answer some with read receipts"""
+        read_ratio = self.scenario.get("traffic", {}).get("read_ratio", 0)
+        try:
+            async for raw in websocket:
+                try:
+                    frame = orjson.loads(raw)
+                except orjson.JSONDecodeError:
+                    continue
+                if frame.get("type") == "reconnect":
+                    self.stats.count("reconnect_hints")
+                    continue
+                message = frame.get("message") if frame.get("type") == "new_message" else frame
+                if not isinstance(message, dict):
+                    continue
+                content = message.get("content")
+                if not measure or not isinstance(content, str) or not content.startswith(CONTENT_PREFIX):
+                    continue
+                self.stats.add("fanout", time.perf_counter() - float(content[len(CONTENT_PREFIX):]))
+                if chat_id and read_ratio and random.random() < read_ratio:
+                    await websocket.send(orjson.dumps({"type": "read", "message_id": message["id"]}).decode())
+        except websockets.ConnectionClosed:
+            pass
+
+    async def open_user_sockets(self, user: int):
+        config = self.scenario.get("sockets", {})
+        token = self.users[user]["token"]
+        chat_ids = self.user_chats.get(user, [])[:config.get("max_chat_sockets_per_user", 5)] if config.get("chat", True) else []
+        opened = []
+        try:
+            if config.get("global", True):
+                websocket = await websockets.connect(f"{self.ws_url}/ws/global?token={token}", max_size=None)
+                opened.append((user, None, websocket))
+            for chat_id in chat_ids:
+                websocket = await websockets.connect(f"{self.ws_url}/ws/{chat_id}?token={token}", max_size=None)
+                opened.append((user, chat_id, websocket))
+        except (OSError, websockets.WebSocketException):
+            self.stats.count("socket_failures")
+        for user_index, chat_id, websocket in opened:
+            # Users with chat sockets are measured there, the rest on their global socket
+            measure = chat_id is not None or not chat_ids
+            task = asyncio.create_task(self.read_socket(user_index, chat_id, websocket, measure))
+            self.sockets.append((user_index, chat_id, websocket, task))
+
+    async def open_sockets(self):
+        start = time.perf_counter()
+        limit = asyncio.Semaphore(200)
+
+        async def open_one(user):
+            async with limit:
+                await self.open_user_sockets(user)
+
+        await asyncio.gather(*(open_one(user) for user in range(len(self.users))))
+        print(f"🔌 {len(self.sockets)} sockets open in {time.perf_counter() - start:.1f}s")
+
+    async def close_sockets(self):
+        sockets, self.sockets = self.sockets, []
+        await asyncio.gather(*(websocket.close() for _, _, websocket, _ in sockets), return_exceptions=True)
+        for _, _, _, task in sockets:
+            task.cancel()
+
+    def chat_socket(self, user: int, chat_id: str):
+        for user_index, socket_chat_id, websocket, _ in self.sockets:
+            if user_index == user and socket_chat_id == chat_id:
+                return websocket
+        return None
+
+    # ---------- traffic ----------
+
+    async def sender(self, user: int, interval: float, deadline: float):
+        config = self.scenario.get("traffic", {})
+        chat_ids = self.user_chats.get(user)
+        if not chat_ids:
+            return
+        while time.perf_counter() < deadline and not self.stopping:
+            await asyncio.sleep(random.expovariate(1 / interval))
+            chat_id = random.choice(chat_ids)
+            if config.get("typing", True):
+                websocket = self.chat_socket(user, chat_id)
+                if websocket is not None:
+                    try:
+                        await websocket.send('{"type":"typing","is_typing":true}')
+                    except websockets.ConnectionClosed:
+                        pass
+            start = time.perf_counter()
+            try:
+                response = await self.http.post(
+                    f"/api/chats/{chat_id}/messages",
+                    params={"content": f"{CONTENT_PREFIX}{start:.6f}", "client_msg_id": uuid.uuid4().hex},
+                    headers=self.headers(user)
+                )
+                response.raise_for_status()
+                self.stats.add("send_message", time.perf_counter() - start)
+            except httpx.HTTPError:
+                self.stats.count("send_failures")
+
+    async def chat_list_fetcher(self, user: int, interval: float, deadline: float):
+        while time.perf_counter() < deadline and not self.stopping:
+            await asyncio.sleep(random.expovariate(1 / interval))
+            start = time.perf_counter()
+            try:
+                response = await self.http.get("/api/chats", headers=self.headers(user))
+                response.raise_for_status()
+                self.stats.add("chat_list", time.perf_counter() - start)
+            except httpx.HTTPError:
+                self.stats.count("chat_list_failures")
+
+    async def reconnect_user(self, user: int, storm: dict):
+        """What a client does after losing its sockets: reconnect, reload the chat list and the open chat"""
+        start = time.perf_counter()
+        if storm.get("jitter_ms"):
+            await asyncio.sleep(random.uniform(0, storm["jitter_ms"]) / 1000)
+        await self.open_user_sockets(user)
+        if storm.get("refetch", True):
+            try:
+                response = await self.http.get("/api/chats", headers=self.headers(user))
+                response.raise_for_status()
+                chat_ids = self.user_chats.get(user)
+                if chat_ids:
+                    response = await self.http.get(f"/api/chats/{chat_ids[0]}/messages", headers=self.headers(user))
+                    response.raise_for_status()
+            except httpx.HTTPError:
+                self.stats.count("reconnect_failures")
+                return
+        self.stats.add("reconnect", time.perf_counter() - start)
+
+    async def reconnect_storm(self, storm: dict):
+        await asyncio.sleep(storm.get("at_seconds", 10))
+        print(f"🌩️  Dropping {len(self.sockets)} sockets")
+        await self.close_sockets()
+        start = time.perf_counter()
+        await asyncio.gather(*(self.reconnect_user(user, storm) for user in range(len(self.users))))
+        print(f"🔌 Everyone back in {time.perf_counter() - start:.1f}s")
+
+    async def run_traffic(self):
+        traffic = self.scenario.get("traffic", {})
+        duration = traffic.get("duration_seconds", 60)
+        deadline = time.perf_counter() + duration
+        tasks = []
+
+        senders = [user for user in range(len(self.users)) if self.user_chats.get(user)][:traffic.get("senders", 0)]
+        if senders and traffic.get("messages_per_second"):
+            interval = len(senders) / traffic["messages_per_second"]
+            tasks += [self.sender(user, interval, deadline) for user in senders]
+
+        chat_list = self.scenario.get("chat_list")
+        if chat_list:
+            interval = 1 / chat_list.get("fetches_per_second", 1)
+            tasks += [self.chat_list_fetcher(user, interval, deadline) for user in range(chat_list.get("users", 1))]
+
+        if self.scenario.get("reconnect_storm"):
+            tasks.append(self.reconnect_storm(self.scenario["reconnect_storm"]))
+
+        print(f"🚀 Running traffic for {duration}s")
+        await asyncio.gather(*tasks)
+        # Let the last fan-outs arrive
+        await asyncio.sleep(2)
+
+    async def scrape_metrics(self) -> dict:
+        try:
+            response = await self.http.get("/metrics")
+            response.raise_for_status()
+            return parse_metrics(response.text)
+        except httpx.HTTPError:
+            return {}
+
+    async def run(self) -> dict:
+        try:
+            await self.setup()
+            before = await self.scrape_metrics()
+            await self.open_sockets()
+            await asyncio.sleep(2)
+            after = await self.scrape_metrics()
+            await self.run_traffic()
+        finally:
+            self.stopping = True
+            await self.close_sockets()
+            await self.http.aclose()
+
+        report = {"scenario": self.scenario.get("name"), "latency": self.stats.summary(), "counters": self.stats.counters}
+        socket_gauges = ("websocket_chat_sockets", "websocket_global_sockets", "websocket_device_sockets")
+        if "process_resident_memory_bytes" in before and "process_resident_memory_bytes" in after:
+            sockets = sum(after.get(g, 0) - before.get(g, 0) for g in socket_gauges)
+            memory = after["process_resident_memory_bytes"] - before["process_resident_memory_bytes"]
+            report["server"] = {
+                "sockets": sockets,
+                "memory_delta_mb": memory / 2**20,
+                "sockets_per_gb": sockets / (memory / 2**30) if memory > 0 else None
+            }
+        return report
+
+def print_report(report: dict):
+    print(f"\n📊 {report['scenario']}")
+    print(f"{'metric':>14} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, values in report["latency"].items():
+        print(f"{name:>14} {values['count']:>8} {values['p50_ms']:>9.1f} {values['p99_ms']:>9.1f} {values['max_ms']:>9.1f}")
+    for name, value in report["counters"].items():
+        print(f"{name:>14} {value:>8}")
+    server = report.get("server")
+    if server:
+        per_gb = f"{server['sockets_per_gb']:.0f}" if server["sockets_per_gb"] else "n/a"
+        print(f"\n🧠 {server['sockets']:.0f} server sockets, +{server['memory_delta_mb']:.1f} MB RSS, {per_gb} sockets/GB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", help="scenario JSON file")
+    parser.add_argument("--base-url", default="http://localhost:8009")
+    parser.add_argument("--concurrency", type=int, default=50, help="parallel HTTP requests")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    with open(args.scenario, "rb") as f:
+        scenario = orjson.loads(f.read())
+    raise_file_limit()
+    report = asyncio.run(LoadTest(scenario, args.base_url, args.concurrency).run())
+    print_report(report)
+    if args.json:
+        with open(args.json, "wb") as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Move messages from the one-document-per-message `messages` collection into
+`message_buckets` (MESSAGE_STORAGE_MODE=buckets).
+Stop the backend (or switch it to buckets mode) first, then run from the
+backend directory: python migrate_to_buckets.py [--chat CHAT_ID]
+"""
+
+import argparse
+
+from pymongo import MongoClient, UpdateOne
+
+from app import message_store
+from app.database import MONGODB_URL, DATABASE_NAME
+
+BATCH_SIZE = 5000
+
+def number_legacy_messages(db, chat_id: str) -> int:
+    """Give messages sent before per-chat seqs existed a seq of 0, -1, -2... (newest first)"""
+    lowest = db.messages.find_one(
+        {"chat_id": chat_id, "seq": {"$exists": True}}, {"seq": 1}, sort=[("seq", 1)]
+    )
+    lowest_bucket = db.message_buckets.find_one(
+        {"chat_id": chat_id}, {"messages": {"$slice": 1}}, sort=[("bucket_start", 1)]
+    )
+    # Continue below whatever is already numbered, so a re-run after a crash doesn't collide
+    next_seq = min(
+        lowest["seq"] if lowest else 1,
+        lowest_bucket["messages"][0]["seq"] if lowest_bucket and lowest_bucket.get("messages") else 1,
+        1
+    ) - 1
+
+    numbered = 0
+    while True:
+        batch = list(db.messages.find(
+            {"chat_id": chat_id, "seq": {"$exists": False}}, {"_id": 1}
+        ).sort("created_at", -1).limit(BATCH_SIZE))
+        if not batch:
+            return numbered
+        db.messages.bulk_write([
+            UpdateOne({"_id": msg["_id"]}, {"$set": {"seq": next_seq - i}})
+            for i, msg in enumerate(batch)
+        ], ordered=False)
+        next_seq -= len(batch)
+        numbered += len(batch)
+
+def migrate_chat(db, chat_id: str) -> int:
+    """Bucket one chat's messages. Safe to re-run after a crash."""
+    number_legacy_messages(db, chat_id)
+
+    migrated = 0
+    while True:
+        batch = list(db.messages.find({"chat_id": chat_id}).sort("seq", 1).limit(BATCH_SIZE))
+        if not batch:
+            return migrated
+
+        buckets = {}
+        for msg in batch:
+            buckets.setdefault(message_store.bucket_start(msg["seq"]), []).append(msg)
+
+        for start, messages in buckets.items():
+            bucket_filter = {"chat_id": chat_id, "bucket_start": start}
+            ids = [msg["_id"] for msg in messages]
+            # Drop copies left by a run that died before deleting the originals
+            db.message_buckets.update_one(bucket_filter, {"$pull": {"messages": {"_id": {"$in": ids}}}})
+            db.message_buckets.update_one(
+                bucket_filter,
+                {"$push": {"messages": {"$each": messages, "$sort": {"seq": 1}}}},
+                upsert=True
+            )
+            db.message_buckets.update_one(bucket_filter, [{"$set": {"count": {"$size": "$messages"}}}])
+
+        db.messages.delete_many({"_id": {"$in": [msg["_id"] for msg in batch]}})
+        migrated += len(batch)
+
+def migrate(chat_id: str = None) -> int:
+    client = MongoClient(MONGODB_URL)
+    db = client[DATABASE_NAME]
+    db.message_buckets.create_index([("chat_id", 1), ("bucket_start", 1)], unique=True)
+
+    try:
+        chat_ids = [chat_id] if chat_id else [str(chat["_id"]) for chat in db.chats.find({}, {"_id": 1})]
+        total = 0
+        for cid in chat_ids:
+            count = migrate_chat(db, cid)
+            if count:
+                print(f"📦 {cid}: moved {count} messages into buckets")
+            total += count
+        return total
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chat", help="only migrate this chat")
+    args = parser.parse_args()
+
+    print(f"🔄 Migrating messages into buckets of {message_store.MESSAGE_BUCKET_SIZE}...")
+    count = migrate(args.chat)
+    print(f"✨ Done! {count} messages migrated.")
@@ -0,0 +1,43 @@
+"""
+Test setup: the app runs against an in-memory mongomock database, so the
+tests need no MongoDB server. Run from the backend directory:
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+
+import mongomock.database
+import pytest
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient, AsyncMongoMockDatabase
+
+from app import database
+
+@pytest.fixture
+def client(monkeypatch):
+    # mongomock knows no read preferences, write concerns or capped collections
+    monkeypatch.setattr(mongomock.database.Database, "with_options", lambda self, **kwargs: self)
+    monkeypatch.setattr(AsyncMongoMockDatabase, "with_options", lambda self, **kwargs: self, raising=False)
+    create_collection = mongomock.database.Database.create_collection
+    monkeypatch.setattr(
+        mongomock.database.Database, "create_collection",
+        lambda self, name, **kwargs: create_collection(self, name)
+    )
+    mongo = AsyncMongoMockClient()
+    monkeypatch.setattr(database, "client", mongo)
+    monkeypatch.setattr(database, "database", mongo["chatapp_test"])
+
+    from app.main import app
+    with TestClient(app) as test_client:
+        yield test_client
+
+@pytest.fixture
+def register(client):
+    """register(username) -> (user id, auth headers)"""
+    def register_user(username: str):
+        response = client.post("/api/auth/register", json={
+            "username": username, "email": f"{username}@example.com", "password": "secret"
+        })
+        assert response.status_code == 200, response.text
+        data = response.json()
+        return data["user"]["id"], {"Authorization": f"Bearer {data['access_token']}"}
+    return register_user
@@ -0,0 +1,92 @@
+"""
+The hot endpoints build their rows by hand instead of through the response
+models. These tests pin those rows to the models: same keys, in the same
+order, with values the model would serialize the same way.
+"""
+
+from datetime import datetime
+
+from app.models import MessageResponse, UserResponse
+
+# GET /api/chats has no response model; this is the row layout clients rely on
+CHAT_ROW_FIELDS = [
+    "id", "chat_type", "group_name", "group_image", "participants", "last_message", "unread_count", "created_at"
+]
+LAST_MESSAGE_FIELDS = ["id", "content", "message_type", "sender_id", "sender_name", "created_at"]
+
+def assert_matches_model(row: dict, model):
+    assert list(row) == list(model.model_fields)
+    assert model.model_validate(row).model_dump(mode="json") == row
+
+def assert_timestamp(value):
+    assert isinstance(value, str)
+    assert datetime.fromisoformat(value).isoformat() == value
+
+def seed_chat(client, register):
+    """A chat between alice and bob with a reply, an edit, a deleted message and a reaction"""
+    alice, alice_headers = register("alice")
+    bob, bob_headers = register("bob")
+    chat_id = client.post("/api/chats/single", params={"identifier": "bob"}, headers=alice_headers).json()["chat_id"]
+    first = client.post(f"/api/chats/{chat_id}/messages", params={"content": "hi"}, headers=alice_headers).json()["id"]
+    reply = client.post(
+        f"/api/chats/{chat_id}/messages", params={"content": "hello", "reply_to": first}, headers=bob_headers
+    ).json()["id"]
+    client.put(f"/api/chats/{chat_id}/messages/{reply}", json={"content": "hello there"}, headers=bob_headers)
+    gone = client.post(f"/api/chats/{chat_id}/messages", params={"content": "oops"}, headers=alice_headers).json()["id"]
+    client.delete(f"/api/chats/{chat_id}/messages/{gone}", headers=alice_headers)
+    client.post(f"/api/chats/{chat_id}/messages/{first}/react", json={"emoji": "👍"}, headers=bob_headers)
+    return chat_id, alice_headers, bob_headers
+
+def test_message_rows_match_message_response(client, register):
+    chat_id, _, bob_headers = seed_chat(client, register)
+
+    response = client.get(f"/api/chats/{chat_id}/messages", headers=bob_headers)
+    assert response.status_code == 200
+    page = response.json()
+    assert list(page) == ["messages", "total", "has_more", "skip", "limit"]
+
+    rows = page["messages"]
+    assert [row["content"] for row in rows] == ["hi", "hello there", "This message was deleted"]
+    for row in rows:
+        assert_matches_model(row, MessageResponse)
+        assert_timestamp(row["created_at"])
+    first, reply, gone = rows
+    assert first["reactions"] == {"👍": [reply["sender_id"]]}
+    assert_timestamp(reply["edited_at"])
+    assert list(reply["reply_to_message"]) == ["id", "sender_id", "sender_name", "content", "message_type"]
+    assert reply["reply_to_message"]["id"] == first["id"]
+    assert gone["is_deleted"] is True
+
+def test_user_search_rows_match_user_response(client, register):
+    register("alice")
+    _, bob_headers = register("bob")
+    register("carol")
+
+    response = client.get("/api/users/search", params={"query": "a"}, headers=bob_headers)
+    assert response.status_code == 200
+    rows = response.json()
+    assert sorted(row["username"] for row in rows) == ["alice", "carol"]
+    for row in rows:
+        assert_matches_model(row, UserResponse)
+
+def test_chat_list_rows(client, register):
+    chat_id, _, bob_headers = seed_chat(client, register)
+
+    response = client.get("/api/chats", headers=bob_headers)
+    assert response.status_code == 200
+    rows = response.json()
+    assert len(rows) == 1
+
+    row = rows[0]
+    assert list(row) == CHAT_ROW_FIELDS
+    assert row["id"] == chat_id
+    assert isinstance(row["unread_count"], int)
+    assert_timestamp(row["created_at"])
+    assert [participant["username"] for participant in row["participants"]] == ["alice"]
+    for participant in row["participants"]:
+        assert_matches_model(participant, UserResponse)
+
+    last_message = row["last_message"]
+    assert list(last_message) == LAST_MESSAGE_FIELDS
+    assert last_message["content"] == "This message was deleted"
+    assert_timestamp(last_message["created_at"])
@@ -0,0 +1,27 @@
+"""
+Round-trip budgets of the hot handlers (benchmarks/budgets.json), so a
+change that adds queries fails the test suite, not only a hand-run of
+benchmarks/handler_benchmark.py. CPU time depends on the machine and is
+left to the script.
+"""
+
+import asyncio
+import json
+
+import app.database as database
+import app.login_strategy as login_strategy
+import app.main as main
+from benchmarks import handler_benchmark
+
+def test_handlers_stay_within_round_trip_budgets(monkeypatch):
+    # The benchmark points the handlers at its in-memory database and fake sockets; undo that afterwards
+    for module in (database, main, login_strategy):
+        monkeypatch.setattr(module, "get_database", module.get_database)
+    monkeypatch.setattr(main.manager, "active_connections", main.manager.active_connections)
+    monkeypatch.setattr(main.manager, "global_connections", main.manager.global_connections)
+
+    results = asyncio.run(handler_benchmark.run(iterations=1))
+
+    budgets = json.loads(handler_benchmark.BUDGETS_FILE.read_text())
+    assert set(results) == set(budgets)
+    assert handler_benchmark.check(results, budgets, cpu_tolerance=0) == []
@@ -456,10 +456,21 @@ function ChatWindow({ chatId: propChatId, onBackClick }) {
             setMessages(prev => prev.map(msg => 
               msg.id === data.message_id ? { ...msg, is_deleted: true, content: 'This message was deleted' } : msg
             ));
-          } else if (data.type === 'message_reaction' && data.message_id) {
-            setMessages(prev => prev.map(msg => 
-              msg.id === data.message_id ? { ...msg, reactions: data.reactions || {} } : msg
-            ));
+          } else if (data.type === 'message_reaction' && data.message_id && data.emoji) {
+            // Reactions arrive as deltas: {emoji, user_id, added}
+            setMessages(prev => prev.map(msg => {
+              if (msg.id !== data.message_id) return msg;
+              const reactions = { ...(msg.reactions || {}) };
+              const users = (Array.isArray(reactions[data.emoji]) ? reactions[data.emoji] : [])
+                .filter(id => id !== data.user_id);
+              if (data.added) users.push(data.user_id);
+              if (users.length > 0) {
+                reactions[data.emoji] = users;
+              } else {
+                delete reactions[data.emoji];
+              }
+              return { ...msg, reactions };
+            }));
           } else if (data.type === 'message_status' && data.message_id) {
             setMessages(prev => prev.map(msg => {
               if (msg.id === data.message_id && msg.sender_id === user?.id) {
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 Script to unarchive all chats in the database
-Run this script to remove is_archived flag from all chats
+Run this script to unarchive every chat for every member
 """
 
 from pymongo import MongoClient
@@ -20,8 +20,13 @@ def unarchive_all_chats():
     db = client[DATABASE_NAME]
     
     try:
-        # Update all chats with is_archived: True to is_archived: False
-        result = db.chats.update_many(
+        # Archiving is per user, in chat_members
+        result = db.chat_members.update_many(
+            {"archived": True},
+            {"$set": {"archived": False}}
+        )
+        # Chats archived with the old per-chat flag
+        db.chats.update_many(
             {"is_archived": True},
             {"$set": {"is_archived": False}}
         )